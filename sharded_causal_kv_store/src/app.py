@@ -1,21 +1,31 @@
 from fastapi import FastAPI
 from packages.gossip import Gossip
+from helper import AsyncHelper
+from packages.health import Health
+from packages.broadcast import Replicator
+from packages.stability import Stability
+from packages.read_cache import ReadCache
+from packages.storage import Storage
+from packages.render import FastJSONResponse
 from contextlib import asynccontextmanager
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    """Runs the gossip protocol in the background."""
-    async with Gossip.gossip():
-        yield
+    """Opens the shared inter-node HTTP client and the storage engine, and runs replication, the gossip protocol, health probes, metadata GC and read cache pushes in the background."""
+    async with AsyncHelper.client_session(), Storage.persisting():
+        # a restarted node serves the data and view it recovered right away
+        restore_view()
+        async with Replicator.replicating(), Gossip.gossip(), Health.probing(), Stability.collecting(), ReadCache.pushing():
+            yield
 
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 
 # Import and register routers (equivalent to Flask's blueprints)
 
 from routers.ping import ping_router # /ping endpoint
 app.include_router(ping_router)
 
-from routers.view import view_router # /view endpoints
+from routers.view import view_router, restore_view # /view endpoints
 app.include_router(view_router)
 
 from routers.get_data import get_data_router # GET endpoints for /data and /data/<key>
@@ -24,9 +34,18 @@ app.include_router(get_data_router)
 from routers.put_data import put_data_router # PUT endpoints for /data/<key>
 app.include_router(put_data_router)
 
+from routers.batch import batch_router # POST endpoint for /data/batch
+app.include_router(batch_router)
+
 from routers.update import update_data_router # Internal endpoints for relaying PUT
 app.include_router(update_data_router)
 
+from routers.gossip import gossip_router # Internal endpoints for anti-entropy
+app.include_router(gossip_router)
+
+from routers.cache import cache_router # Internal endpoints for the read cache
+app.include_router(cache_router)
+
 # Entry point for the app
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=8081)
@@ -1,14 +1,37 @@
 """Useful Request and Asynchronous Helpers."""
 
 from typing import Dict
+from contextlib import asynccontextmanager
+from urllib.parse import urlsplit
 from shared_data import SharedData  
+from packages.health import Health
+from packages.wire import Wire
+from packages.render import FastJSONResponse
 import httpx
-from fastapi.responses import JSONResponse
+import asyncio
+import os
+import time
+from log import get_logger
 
 # Configure number of retries & timeout (in secs) here. 
 RETRIES = 3
 TIMEOUT = 2
 
+# Connection pool used for all inter-node traffic (see `AsyncHelper.client_session`).
+#   MAX_CONNECTIONS_PER_PEER: max in-flight requests (and so open connections) to a single node
+#   MAX_KEEPALIVE_CONNECTIONS: idle connections kept open across all peers
+#   KEEPALIVE_EXPIRY: seconds an idle connection is kept before being closed
+#   HTTP2: "true" to talk HTTP/2 (prior knowledge) to peers, needs the `h2` package and an HTTP/2 server
+MAX_CONNECTIONS_PER_PEER = int(os.environ.get("MAX_CONNECTIONS_PER_PEER", 16))
+MAX_KEEPALIVE_CONNECTIONS = int(os.environ.get("MAX_KEEPALIVE_CONNECTIONS", 64))
+KEEPALIVE_EXPIRY = float(os.environ.get("KEEPALIVE_EXPIRY", 30))
+HTTP2 = os.environ.get("HTTP2", "false").lower() == "true"
+
+# Delay (in secs) before the 2nd retry of a failed connection, doubled on every retry after.
+RETRY_BACKOFF = 0.5
+
+logger = get_logger(__name__)
+
 class ReqHelper:
   @staticmethod
   def extract_msg_num_header(request) -> int | None:
@@ -37,12 +60,117 @@ class ReqHelper:
 
   
 class AsyncHelper:
+  # One long-lived client (and keep-alive connection pool) shared by every request this node makes.
+  client: httpx.AsyncClient | None = None
+
+  # {<peer address>: asyncio.Semaphore} - caps concurrent requests/connections per peer.
+  peer_limits: Dict[str, asyncio.Semaphore] = {}
+
+  @staticmethod
+  def create_client() -> httpx.AsyncClient:
+    """Creates the pooled client configured at the top of this file."""
+    http2 = HTTP2
+    if http2:
+      try:
+        import h2 # noqa: F401 - only checking that HTTP/2 support is installed
+      except ImportError:
+        logger.warning("HTTP2 is enabled but the h2 package is not installed, falling back to HTTP/1.1")
+        http2 = False
+    limits = httpx.Limits(
+      max_connections=None, # Bounded per peer instead, by `peer_limits`
+      max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS,
+      keepalive_expiry=KEEPALIVE_EXPIRY,
+    )
+    return httpx.AsyncClient(limits=limits, http1=not http2, http2=http2)
+
+  @staticmethod
+  def get_client() -> httpx.AsyncClient:
+    """Returns the shared client, creating it if the app's lifespan hasn't yet."""
+    if AsyncHelper.client is None or AsyncHelper.client.is_closed:
+      AsyncHelper.client = AsyncHelper.create_client()
+    return AsyncHelper.client
+
+  @staticmethod
+  @asynccontextmanager
+  async def client_session():
+    """Opens the shared client for the lifetime of the app (used in app.py's lifespan)."""
+    client = AsyncHelper.get_client()
+    try:
+      yield client
+    finally:
+      AsyncHelper.client = None
+      AsyncHelper.peer_limits = {}
+      await client.aclose()
+
   @staticmethod
-  def config_retries(retries=RETRIES):
-    """Used to create a transport object with the specified retries."""
-    if not retries:
-      return None
-    return httpx.AsyncHTTPTransport(retries=retries)
+  def peer_limit(url) -> asyncio.Semaphore:
+    """Returns the semaphore bounding concurrent requests to the peer `url` points at."""
+    peer = urlsplit(url).netloc
+    limit = AsyncHelper.peer_limits.get(peer)
+    if limit is None:
+      limit = AsyncHelper.peer_limits[peer] = asyncio.Semaphore(MAX_CONNECTIONS_PER_PEER)
+    return limit
+
+  @staticmethod
+  async def request(method, url, body=None, headers=None, timeout=TIMEOUT, retries=RETRIES, content=None):
+    """Sends a request over the shared client.
+
+    The body is `body`, encoded as the peer takes it (binary or JSON, see packages/wire.py),
+    or the raw bytes `content` if given (e.g. NDJSON).
+
+    Failures to connect are retried up to `retries` times (immediately, then with
+    exponential backoff starting at RETRY_BACKOFF), like httpx's transport retries.
+    Peers the health table (packages/health.py) considers down get no retries.
+
+    Every attempt's outcome is recorded in the health table.
+    """
+    client = AsyncHelper.get_client()
+    peer = urlsplit(url).netloc
+    if Health.is_down(peer):
+      retries = 0
+    headers = dict(Wire.request_headers(), **(headers or {}))
+    sent_binary = False
+    if content is None and body is not None:
+      content, body_headers = Wire.encode_request(peer, body)
+      headers.update(body_headers)
+      sent_binary = Wire.is_binary(body_headers)
+    attempt = 0
+    async with AsyncHelper.peer_limit(url):
+      while True:
+        start = time.monotonic()
+        try:
+          response = await client.request(method, url, content=content, headers=headers, timeout=timeout)
+        except httpx.TransportError as e:
+          Health.record_failure(peer)
+          if not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout)) or attempt >= (retries or 0):
+            raise
+          if attempt:
+            await asyncio.sleep(RETRY_BACKOFF * (2 ** (attempt - 1)))
+          attempt += 1
+        else:
+          Health.record_success(peer, time.monotonic() - start)
+          Wire.learn(peer, response, sent_binary)
+          return response
+
+  @staticmethod
+  @asynccontextmanager
+  async def stream(method, url, headers=None, timeout=TIMEOUT):
+    """Sends a request over the shared client, and yields the response before its body is read
+    (read it with `response.aiter_bytes()`; `timeout` applies to each read, not the whole body).
+
+    Not retried. The outcome is recorded in the health table.
+    """
+    client = AsyncHelper.get_client()
+    peer = urlsplit(url).netloc
+    async with AsyncHelper.peer_limit(url):
+      start = time.monotonic()
+      try:
+        async with client.stream(method, url, headers=headers, timeout=timeout) as response:
+          Health.record_success(peer, time.monotonic() - start)
+          yield response
+      except httpx.TransportError:
+        Health.record_failure(peer)
+        raise
 
   @staticmethod
   async def async_get(url, body={}, headers=None, timeout=TIMEOUT, retries=RETRIES):
@@ -53,42 +181,37 @@ class AsyncHelper:
       timeout: timeout in seconds (set default at top of file here)
       retries number of retries (set default at top of file here)
     """
-    async with httpx.AsyncClient(transport=AsyncHelper.config_retries(retries)) as client:
-      response = await client.request("GET", url, json=body, headers=headers, timeout=timeout)
-      return response
+    return await AsyncHelper.request("GET", url, body, headers=headers, timeout=timeout, retries=retries)
   
   @staticmethod
   async def async_post(url, body, headers=None, timeout=TIMEOUT, retries=RETRIES):
-    async with httpx.AsyncClient(transport=AsyncHelper.config_retries(retries)) as client:
-      print("body is", body)
-      response = await client.post(url, json=body, headers=headers, timeout=timeout)
-      return response
+    return await AsyncHelper.request("POST", url, body, headers=headers, timeout=timeout, retries=retries)
 
   @staticmethod
   async def async_put(url, body, headers=None, timeout=TIMEOUT, retries=RETRIES):
-    async with httpx.AsyncClient(transport=AsyncHelper.config_retries(retries)) as client:
-      response = await client.put(url, json=body, headers=headers, timeout=timeout)
-      return response
+    return await AsyncHelper.request("PUT", url, body, headers=headers, timeout=timeout, retries=retries)
 
+  @staticmethod
   async def async_delete(url, body=None, headers=None, timeout=TIMEOUT, retries=RETRIES):
-    async with httpx.AsyncClient(transport=AsyncHelper.config_retries(retries)) as client:
-      response = await client.delete(url, headers=headers, timeout=timeout)
-      return response
+    return await AsyncHelper.request("DELETE", url, headers=headers, timeout=timeout, retries=retries)
 
   @staticmethod
   def extract_res(response):
     """Returns a tuple of (body, status_code, headers)."""
-    body = response.json()
+    body = Wire.body(response)
     status_code = response.status_code
     headers = response.headers
     return (body, status_code, headers)
   
   @staticmethod
-  def format_fast_api_res(httpx_res) -> JSONResponse:
+  def format_fast_api_res(httpx_res) -> FastJSONResponse:
     """Given an httpx response (returned from `async_get, async_put, etc),
-       return a JSONResponse that can be used as a FastAPI Response.
+       return a FastJSONResponse that can be used as a FastAPI Response.
 
        Use this for relaying the response from a request to the client.
     """
     body, status, headers = AsyncHelper.extract_res(httpx_res)
-    return JSONResponse(content=body, status_code=status, headers=headers)
+    # the body is encoded again below (as JSON if it came in binary), so its length may differ
+    dropped = ("content-type", "content-length", "content-encoding") if Wire.is_binary(headers) else ("content-length",)
+    headers = {name: value for name, value in headers.items() if name not in dropped}
+    return FastJSONResponse(content=body, status_code=status, headers=headers)
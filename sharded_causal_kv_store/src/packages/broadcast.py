@@ -1,25 +1,189 @@
 import asyncio
+import os
+from contextlib import asynccontextmanager
 from shared_data import SharedData
-from helper import TIMEOUT, RETRIES, AsyncHelper, ReqHelper
+from helper import TIMEOUT, AsyncHelper, ReqHelper
 import util
-from packages.vector_clock import VectorClock
+from packages.health import Health
+from packages.stability import Stability
+from packages.wire import Wire
+from log import get_logger
 
-"""Helpers for broadcasting/relaying PUT/DELETE requests to other nodes."""
+"""Helpers for broadcasting/relaying PUT requests to the other nodes of the shard.
 
-async def broadcast_info(background_tasks, operation, causal_metadata, key, value=None):
-    """Called by PUT / DELETE endpoints - broadcast info to all other nodes.
+Writes are not sent one request each: every peer has an outbound queue of pending updates,
+keyed by kvs key, so several writes to the same key before a flush are coalesced into the
+latest one (which keeps the place, and seq, of the first: none of them was delivered yet). The queues are flushed in batches to the peers' /update/batch endpoint, as soon as
+a batch is full or after a short linger once the first update was queued.
 
-    It starts one background task (separate thread) per node that it needs to
-        communicate to.
+Queues are kept in the order of the writes' sequence numbers, and an update only leaves the
+queue for good once the peer acked (and applied) it. So the head of a peer's queue tells up to
+which of our writes the peer has everything (`Replicator.delivered_floor`, used by packages/stability.py).
+Updates for a peer that is down are kept (coalesced) until it is back, rather than dropped.
+"""
+
+# Max updates in one batch request.
+REPLICATION_BATCH_SIZE = int(os.environ.get("REPLICATION_BATCH_SIZE", 256))
+
+# Secs to wait after the first queued update, for more to join the batch.
+REPLICATION_LINGER = float(os.environ.get("REPLICATION_LINGER", 0.002))
+
+# Secs between attempts to flush the queues of peers that are down.
+RETRY_INTERVAL = 1
+
+logger = get_logger(__name__)
+
+class Replicator:
+    # {<peer address>: {<kvs key>: (<seq of the first write not delivered>, <update dict>, <seq of the update>)}},
+    # in seq order (of the first write)
+    queues = {}
+
+    # {<peer address>: <lowest seq in the batch>} for peers with a batch in flight (at most one at
+    # a time per peer, the next batch builds up meanwhile)
+    in_flight = {}
+
+    # Set when there is something to flush
+    wakeup = asyncio.Event()
+
+    tasks = set()
+
+    @staticmethod
+    def enqueue(address: str, key: str, seq: int, update: dict):
+        """Queues `update` of `key` (our write number `seq`) for the peer at `address`, replacing a queued update of the key."""
+        queue = Replicator.queues.setdefault(address, {})
+        queued = queue.get(key)
+        # the key keeps its place: the floor must stay below the first of its writes the peer hasn't got
+        queue[key] = (seq if queued is None else queued[0], update, seq)
+        Replicator.wakeup.set()
+
+    @staticmethod
+    def delivered_floor(address: str) -> int:
+        """Our writes up to this seq that were queued for `address` have all been acked by it."""
+        pending = []
+        if address in Replicator.in_flight:
+            pending.append(Replicator.in_flight[address])
+        queue = Replicator.queues.get(address)
+        if queue:
+            pending.append(next(iter(queue.values()))[0])
+        return min(pending) - 1 if pending else Stability.seq
+
+    @staticmethod
+    def discard_through(address: str, seq: int):
+        """Drops the queued updates for `address` of our writes up to `seq`, which it got some other way."""
+        queue = Replicator.queues.get(address)
+        for key, (first, update, last) in list((queue or {}).items()):
+            if first > seq:
+                break
+            if last <= seq:
+                del queue[key]
+            else:
+                # a later write of the key is still to be delivered
+                queue[key] = (seq + 1, update, last)
+
+    @staticmethod
+    def flush():
+        """Sends one batch to every peer that has queued updates, no batch in flight and isn't down."""
+        for address, queue in Replicator.queues.items():
+            if not queue or address in Replicator.in_flight or Health.is_down(address):
+                continue
+            if len(queue) <= REPLICATION_BATCH_SIZE:
+                batch = list(queue.items())
+                queue.clear()
+            else:
+                keys = list(queue)[:REPLICATION_BATCH_SIZE]
+                batch = [(key, queue.pop(key)) for key in keys]
+            Replicator.in_flight[address] = batch[0][1][0]
+            task = asyncio.create_task(Replicator._send(address, batch))
+            Replicator.tasks.add(task)
+            task.add_done_callback(Replicator.tasks.discard)
+
+    @staticmethod
+    async def _send(address: str, batch: list):
+        sent = False
+        try:
+            payload = {"updates": [update for _, (_, update, _) in batch], "stable": Stability.report()}
+            res = await AsyncHelper.async_post(f"http://{address}/update/batch", payload, headers=ReqHelper.create_req_headers(), timeout=TIMEOUT)
+            logger.debug("Replicated %d updates to %s: %s", len(batch), address, res.status_code)
+            if res.status_code != 200:
+                raise RuntimeError(f"status {res.status_code}")
+            reply = Wire.body(res)
+            Stability.learn(reply.get("stable"))
+            # updates the peer failed to apply aren't delivered: they are sent again on the next retry
+            failed = [batch[index] for index in reply.get("failed", ()) if 0 <= index < len(batch)]
+            if failed:
+                logger.warning("%s failed to apply %d updates, keys %s", address, len(failed), [key for key, _ in failed])
+                Replicator._requeue(address, failed)
+            sent = not failed
+        except Exception as e:
+            logger.warning("Replicating %d updates to %s failed: %r", len(batch), address, e)
+            Replicator._requeue(address, batch)
+        finally:
+            Replicator.in_flight.pop(address, None)
+            # after a failure, the flush loop retries within RETRY_INTERVAL
+            if sent and Replicator.queues.get(address):
+                Replicator.wakeup.set()
+
+    @staticmethod
+    def _requeue(address: str, entries: list):
+        """Puts undelivered `entries` of a batch back in front of anything queued meanwhile (a later write
+        of the same key supersedes an entry's update, but not its place), unless the peer has left the shard."""
+        if not any(node["address"] == address for node in SharedData.gossip_nodes):
+            return
+        queue = Replicator.queues.get(address, {})
+        requeued = {}
+        for key, (first, update, last) in entries:
+            newer = queue.pop(key, None)
+            requeued[key] = (first, update, last) if newer is None else (first, newer[1], newer[2])
+        requeued.update(queue)
+        Replicator.queues[address] = requeued
+
+    @staticmethod
+    def forget_others(addresses):
+        """Drops the queues of peers not in `addresses` (called on a view change)."""
+        addresses = set(addresses)
+        for address in list(Replicator.queues):
+            if address not in addresses:
+                del Replicator.queues[address]
+
+    @staticmethod
+    @asynccontextmanager
+    async def replicating():
+        """Runs the flush loop in the background for the lifetime of the app."""
+        task = asyncio.create_task(Replicator._flush_loop())
+        try:
+            yield
+        finally:
+            task.cancel()
+            for pending in list(Replicator.tasks):
+                pending.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    async def _flush_loop():
+        while True:
+            try:
+                await asyncio.wait_for(Replicator.wakeup.wait(), RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            Replicator.wakeup.clear()
+            # Linger so a burst of writes goes out together, unless a batch is already full
+            if all(len(queue) < REPLICATION_BATCH_SIZE for queue in Replicator.queues.values()):
+                await asyncio.sleep(REPLICATION_LINGER)
+            Replicator.flush()
+
+def broadcast_info(operation, causal_metadata, key, value=None):
+    """Called by the PUT endpoint - queues the update for every other node in the shard.
 
     Args:
-        background_tasks: fastapi's BackgroundTasks
-        operation: "PUT" or "DELETE"
+        operation: "PUT"
         causal_metadata: {<kvs key>: <VectorClock>, ...} for the specific key
         key: key to perform the operation on
         value: only for PUT
     """
-    print("Starting broadcast for key", key, "val", value)
+    logger.debug("Starting broadcast for key %s", key)
     if not causal_metadata or causal_metadata == {}:
         causal_metadata_json = {}
 
@@ -27,16 +191,20 @@ async def broadcast_info(background_tasks, operation, causal_metadata, key, valu
     else:
         causal_metadata_json = util.causal_data_to_dict(causal_metadata)
 
-    # Assemble payload to be attached to internal update endpoint.
-    payload = {
+    # Our slot in the key's clock is the write's sequence number
+    seq = causal_metadata_json.get(key, {}).get(str(SharedData.NODE_IDENTIFIER), 0)
+
+    # Assemble the update to be sent to the internal update endpoint.
+    update = {
         "operation": operation,
         "key": key,
         "causal-metadata": causal_metadata_json
     }
     if operation == "PUT":
-        payload["value"] = value
-    
-    # Iterate for all nodes in the same shard execept itself.
+        update["value"] = value
+
+    # Iterate for all nodes in the same shard execept itself (including ones that are down:
+    # the update waits in their queue until they're back).
     for node in SharedData.gossip_nodes:
         # Get node address / id.
         node_addr = node["address"]
@@ -44,32 +212,5 @@ async def broadcast_info(background_tasks, operation, causal_metadata, key, valu
         if int(node_id) == int(SharedData.NODE_IDENTIFIER):
             continue
 
-        headers = ReqHelper.create_req_headers()
-
-        # Start a background task to send an update request to node.
-        background_tasks.add_task(unicast_info, f"http://{node_addr}", payload, headers)
-    print("Finished broadcast for key", key, "val", value)
+        Replicator.enqueue(node_addr, key, seq, update)
     return True
-
-async def unicast_info(node_addr, payload, headers):
-    """Unicast to the node for a PUT/DELETE using best effort reliable delivery.
-
-    It will timeout after an interval, and a finite number of times.
-        - timeout and retries are configured at the top of `src/helper.py`
-    
-    Args:
-        node_addr: address to send the request to.
-        payload: JSON consisting of {
-                "operation": "PUT" or "DELETE",
-                "key": "<key>",
-                "value": "<val>" # only for PUT,
-                "causal-metadata": {<kvs key>: <VectorClock>, ...}
-            }
-        headers: JSON consisting of {
-                "Node-Id": <current node's ID>
-            }
-    """
-    print(f"Starting unicast to {node_addr}")
-    r = await AsyncHelper.async_post(f"{node_addr}/update", payload, headers=headers)
-    print(f"Unicast to {node_addr} done. {AsyncHelper.extract_res(r)}")
-
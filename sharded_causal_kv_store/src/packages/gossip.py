@@ -2,9 +2,17 @@ import asyncio
 from contextlib import asynccontextmanager
 from shared_data import SharedData
 from helper import AsyncHelper, ReqHelper
+from packages.health import Health
+from packages.stability import Stability
 import util
 import httpx
-import httpcore
+from log import get_logger
+
+# Max number of Merkle tree nodes to ask a peer for in one request, before falling back to
+# comparing per-key digests of the whole (differing) subtrees.
+MAX_MERKLE_INDICES = 4096
+
+logger = get_logger(__name__)
 
 class Gossip:
     @staticmethod
@@ -21,20 +29,92 @@ class Gossip:
             try:
                 await task
             except asyncio.CancelledError:
-                print("Gossip task cancelled gracefully.")
-            except Exception as e:
-                print("Error in gossip", e)
+                logger.info("Gossip task cancelled gracefully.")
+            except Exception:
+                logger.exception("Error in gossip")
+
+    @staticmethod
+    async def find_divergent_ranges(node_addr, headers):
+        """Walks down our and the peer's Merkle trees (one request per level) to find where they differ.
+
+        Returns the list of [first, last) leaf ranges whose hashes differ ([] if the trees are
+        identical), or None if the peer couldn't answer.
+        """
+        merkle = SharedData.merkle
+        indices = [0]
+        for level in range(merkle.depth + 1):
+            payload = {"level": level, "indices": indices}
+            if level == 0:
+                # exchange stability reports on the first request of every round
+                payload["stable"] = Stability.report()
+            res = await AsyncHelper.async_post(f"http://{node_addr}/merkle/nodes", payload, headers=headers, timeout=4)
+            body, status_code, _ = AsyncHelper.extract_res(res)
+            if status_code != 200:
+                return None
+            Stability.learn(body.get("stable"))
+            differing = [i for i, local, remote in zip(indices, merkle.nodes(level, indices), body["hashes"]) if local != remote]
+            if not differing:
+                return []
+            # Stop at the leaves, or early if the replicas differ nearly everywhere (e.g. a new replica)
+            if level == merkle.depth or len(differing) << merkle.fanout_bits > MAX_MERKLE_INDICES:
+                return [merkle.leaf_range(level, i) for i in differing]
+            indices = [child for i in differing for child in merkle.children(i)]
+
+    @staticmethod
+    async def exchange(node_addr, headers):
+        """One round of push-pull anti-entropy with the node at `node_addr`.
+
+        1. Compare Merkle trees with the peer to find the key ranges where we differ.
+        2. POST our digest ({<key>: <version>}) of those ranges to the peer's /gossip/digest.
+        3. Merge the entries it sends back (the ones where its version differs from ours).
+        4. PUT the entries it asked for to its /copy.
+
+        Once the peer has all our versions, it has every write we made before the round started
+        (see packages/stability.py).
+        """
+        seq, view_id = Stability.seq, Stability.view_id
+        def synced():
+            if Stability.view_id == view_id:
+                Stability.mark_synced(node_addr, seq)
+
+        ranges = await Gossip.find_divergent_ranges(node_addr, headers)
+        if ranges == []:
+            logger.debug("Gossip with %s: in sync", node_addr)
+            synced()
+            return
+        payload = {"digest": util.shard_digest(ranges), "ranges": ranges}
+        res = await AsyncHelper.async_post(f"http://{node_addr}/gossip/digest", payload, headers=headers, timeout=4)
+        body, status_code, _ = AsyncHelper.extract_res(res)
+        if status_code != 200:
+            logger.warning("Gossip digest to %s failed. Status = %s, Body = %s", node_addr, status_code, body)
+            return
+
+        # Merge kvs & causal metadata from response into our own
+        server_kvstore: dict = body.get("kvstore")
+        server_metadata: dict = body.get("causal-metadata")
+        if server_kvstore and server_metadata:
+            util.merge_data(server_kvstore, server_metadata)
+
+        # Push back the entries the peer is missing or behind on
+        want = body.get("want")
+        if want:
+            payload = util.assemble_copy_payload(want)
+            res = await AsyncHelper.async_put(f"http://{node_addr}/copy", payload, headers=headers, timeout=4)
+            if res.status_code == 200:
+                synced()
+        else:
+            synced()
+        logger.debug("Gossip with %s: received %d keys, sent %d keys", node_addr, len(server_kvstore or {}), len(want or []))
 
     @staticmethod
     async def _gossip_loop():
         # Index specifying which node we should talk to next
         ind = 0
         while True:
-            print("This is the gossip protocol, ind is", ind)
 
             # No nodes in view or ind out of bound (view change occurred) - wait
             if len(SharedData.gossip_nodes) < 1 or ind >= len(SharedData.gossip_nodes):
-                print("View change occurred, invalid ind - sleep a bit")
+                logger.debug("View change occurred, invalid ind - sleep a bit")
                 ind = 0
                 await asyncio.sleep(3)
                 continue
@@ -47,53 +127,27 @@ class Gossip:
                 ind = (ind + 1) % len(SharedData.gossip_nodes)
                 await asyncio.sleep(3)
                 continue
-            # Assemble payload & headers
-            payload = {
-                "kvstore": SharedData.kvstore,
-                "causal-metadata": util.server_metadata_to_dict(SharedData.causal_data)
-            }
-            headers = ReqHelper.create_req_headers()
-            
-            # Send request
-            print("Starting gossip to node ", node_id)
-            try:
-                res = await AsyncHelper.async_put(f"http://{node_addr}/copy", payload, headers=headers, timeout=4)
-                body, status_code, headers = AsyncHelper.extract_res(res)
-                print("Gossip to node ", node_id, "received. Status =", status_code, ", Body =", body)
-
-            except TimeoutError:
-                print("Gossip to node ", node_id, "timed out. v1")
+            # Skip nodes that are down (the health prober notices when they're back)
+            if Health.is_down(node_addr):
                 ind = (ind + 1) % len(SharedData.gossip_nodes)
                 continue
-            except httpx.ConnectTimeout:
-                print("Gossip to node ", node_id, "timed out. v2")
+            # Send our per-key versions; the peer replies with its entries that differ from ours,
+            # plus the keys it wants ours for (anti-entropy only ships what diverged)
+            headers = ReqHelper.create_req_headers()
+            logger.debug("Starting gossip to node %s", node_id)
+            try:
+                await Gossip.exchange(node_addr, headers)
+            except httpx.TimeoutException:
+                logger.warning("Gossip to node %s timed out.", node_id)
                 ind = (ind + 1) % len(SharedData.gossip_nodes)
                 continue
-            except httpcore.ConnectTimeout:
-                print("Gossip to node ", node_id, "timed out. v3")
+            except Exception as e:
+                logger.warning("Gossip error after sending request: %r", e)
                 ind = (ind + 1) % len(SharedData.gossip_nodes)
+                await asyncio.sleep(1)
                 continue
-            except Exception as e:
-                print("Gossip error after sending request:", e)
-
-            # Extract kvs and metadata from response
-            server_kvstore: dict = body.get("kvstore")
-            server_metadata: dict = body.get("causal-metadata")
-            
-            # Merge kvs & causal metadata from response into our own
-            if server_kvstore is not None and server_metadata is not None:
-                server_metadata = util.dict_to_server_metadata(server_metadata)
-                for key, server_dependencies in server_metadata.items():
-                    # If the key doesn't belong in our shard, don't merge
-                    if not util.key_in_current_shard(key):
-                        continue
-
-                    # convert dicts in dependencies to vector clocks
-                    self_dependencies = SharedData.causal_data.get(key, {})
-                    util.update_metadata(self_dependencies, server_dependencies, SharedData.kvstore, server_kvstore, key)
-                    SharedData.causal_data[key] = self_dependencies
-
-            print(f"Gossip to node {node_id} finished.")
+
+            logger.debug("Gossip to node %s finished.", node_id)
 
             # Update ind
             ind = (ind + 1) % len(SharedData.gossip_nodes)
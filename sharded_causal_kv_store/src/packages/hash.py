@@ -1,84 +1,422 @@
 import hashlib
 import bisect
+import math
+import os
+from array import array
+from functools import lru_cache
+
+try:
+    import numpy as np
+except ImportError: # bulk routing falls back to routing one key at a time
+    np = None
+
+# Max keys whose shard is cached per circle (the cache is dropped whenever the shards change).
+ROUTING_CACHE_SIZE = int(os.environ.get("ROUTING_CACHE_SIZE", 65536))
+
+# How keys are placed on shards (one of HashCircle.STRATEGIES), and for "bounded", how far above
+# its weighted share of the circle a shard may go. A view change can pick others (PUT /view).
+HASH_STRATEGY = os.environ.get("HASH_STRATEGY", "ring")
+HASH_CAPACITY = float(os.environ.get("HASH_CAPACITY", 1.25))
+
+# Sample keys routed for `HashCircle.report`.
+REPORT_SAMPLES = 1 << 14
+
+MASK_64 = (1 << 64) - 1
+
+def jump_hash(key: int, buckets: int) -> int:
+    """Jump consistent hash (Lamping & Veach) of a 64-bit integer into [0, buckets)."""
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & MASK_64
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+def mix(x: int) -> int:
+    """Scrambles a 64-bit integer (the splitmix64 finalizer)."""
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & MASK_64
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & MASK_64
+    return x ^ (x >> 31)
 
 class HashCircle:
-    def __init__(self, virtual_nodes: int = 100):
+    # Number of bits in a position on the circle (see `position`).
+    HASH_BITS = 64
+
+    # How keys are placed on shards, all by the key's position:
+    #   ring       - consistent hashing, with virtual nodes per shard in proportion to its weight
+    #   bounded    - the ring, but no shard owns more than `capacity` times its weighted share of it
+    #   jump       - jump consistent hash over the shards in view order (weights are ignored)
+    #   rendezvous - weighted rendezvous (highest random weight) hashing
+    STRATEGIES = ("ring", "bounded", "jump", "rendezvous")
+    RING_STRATEGIES = ("ring", "bounded")
+
+    def __init__(self, virtual_nodes: int = 100, strategy: str = None, capacity: float = None):
         """
         Initialize an empty consistent hash circle.
-        
+
         Args:
-            virtual_nodes (int): Number of virtual nodes to create per physical shard.
+            virtual_nodes (int): Number of virtual nodes to create per physical shard (of weight 1).
+            strategy (str): One of STRATEGIES (default: HASH_STRATEGY).
+            capacity (float): Load bound of the "bounded" strategy, >= 1 (default: HASH_CAPACITY).
         """
-        # The circle is a sorted list of tuples: (hash_position, shard_name)
-        self.circle = []
+        # The circle is a flat sorted list of virtual node positions (bisect on a list of ints
+        # beats an array("Q"), whose items are boxed on every probe), and the index (into
+        # self.shard_names) of the shard of each virtual node in a parallel array
+        self.positions = []
+        self.owners = array("H")
+        self.shard_names = []
+        self.weights = {}
         self.virtual_nodes = virtual_nodes
+        self.strategy, self.capacity = HashCircle.check_strategy(strategy, capacity)
+        self._index_ring()
+
+    @staticmethod
+    def check_strategy(strategy: str = None, capacity: float = None) -> tuple[str, float]:
+        """The strategy and capacity to use (defaults filled in). Raises ValueError if they are invalid."""
+        strategy = HASH_STRATEGY if strategy is None else strategy
+        capacity = HASH_CAPACITY if capacity is None else capacity
+        if strategy not in HashCircle.STRATEGIES:
+            raise ValueError(f"Unknown hashing strategy {strategy!r}, expected one of {', '.join(HashCircle.STRATEGIES)}")
+        if isinstance(capacity, bool) or not isinstance(capacity, (int, float)) or capacity < 1:
+            raise ValueError(f"Capacity must be a number >= 1, got {capacity!r}")
+        return strategy, float(capacity)
+
+    @staticmethod
+    def position(item: str) -> int:
+        """Compute the position (an integer hash in [0, 2**HASH_BITS)) of a string on the circle using 64-bit BLAKE2b."""
+        return int.from_bytes(hashlib.blake2b(item.encode("utf-8"), digest_size=8).digest(), "big")
 
     def _hash(self, item: str) -> int:
-        """Compute an integer hash for a given string using MD5."""
-        md5_digest = hashlib.md5(item.encode("utf-8")).hexdigest()
-        return int(md5_digest, 16)
+        return HashCircle.position(item)
+
+    def _index_ring(self):
+        """Rebuilds what is derived from the placement: the routing cache, and numpy copies for bulk routing."""
+        self._cached_shard = lru_cache(maxsize=ROUTING_CACHE_SIZE)(self._shard_for_key)
+        # rendezvous: per shard seed and weight
+        self._seeds = [self._hash(name) for name in self.shard_names]
+        self._shard_weights = [self.weights.get(name, 1.0) for name in self.shard_names]
+        if np is not None:
+            self._ring_positions = np.array(self.positions, dtype=np.uint64)
+            self._ring_owners = np.frombuffer(self.owners, dtype=np.uint16) if self.owners else np.zeros(0, dtype=np.uint16)
 
-    def add_shard(self, shard_name: str):
+    @property
+    def circle(self) -> list[tuple[int, str]]:
+        """The circle as a sorted list of (position, shard_name) tuples (empty unless the strategy is ring based)."""
+        return [(position, self.shard_names[owner]) for position, owner in zip(self.positions, self.owners)]
+
+    def _set_circle(self, circle: list[tuple[int, str]], shard_names: list[str]):
+        circle = sorted(circle)
+        self.shard_names = list(dict.fromkeys(shard_names))
+        index = {shard: i for i, shard in enumerate(self.shard_names)}
+        self.positions = [position for position, _ in circle]
+        self.owners = array("H", (index[shard] for _, shard in circle))
+        self._index_ring()
+
+    def config(self) -> dict:
+        """Everything the placement of keys depends on."""
+        return {"strategy": self.strategy, "capacity": self.capacity, "shards": self.shard_names, "weights": self.weights}
+
+    def add_shard(self, shard_name: str, weight: float = 1):
         """
         Add a physical shard to the circle by creating virtual nodes.
-        
+
         Each virtual node is represented by the string "{shard_name}#{i}".
         """
-        for i in range(self.virtual_nodes):
-            vnode_key = f"{shard_name}#{i}"
-            position = self._hash(vnode_key)
-            # Insert the tuple (position, shard_name) into the sorted circle.
-            bisect.insort(self.circle, (position, shard_name))
+        self.update_shards(self.shard_names + [shard_name], dict(self.weights, **{shard_name: weight}), self.strategy, self.capacity)
 
     def remove_shard(self, shard_name: str):
         """
         Remove a physical shard (and all its virtual nodes) from the circle.
         """
-        self.circle = [(pos, s) for pos, s in self.circle if s != shard_name]
+        self.update_shards([s for s in self.shard_names if s != shard_name], self.weights, self.strategy, self.capacity)
 
     def get_shard_for_key(self, key: str) -> str:
         """
         Given a key, hash it and find the physical shard that should store it.
-        
-        The key is assigned to the shard corresponding to the virtual node with the
+
+        On the ring, the key is assigned to the shard corresponding to the virtual node with the
         smallest hash value greater than or equal to the key's hash (wrapping around if necessary).
+        Recently routed keys are served from a bounded LRU cache.
         """
-        key_hash = self._hash(key)
-        index = bisect.bisect_right(self.circle, (key_hash, ""))
-        if index == len(self.circle):
+        return self._cached_shard(key)
+
+    def _shard_for_key(self, key: str) -> str:
+        return self.shard_at(self._hash(key))
+
+    def shard_at(self, position: int) -> str:
+        """The shard owning `position` (see `get_shard_for_key`)."""
+        return self.shard_names[self._owner_at(position)]
+
+    def _owner_at(self, position: int) -> int:
+        if self.strategy == "jump":
+            return jump_hash(position, len(self.shard_names))
+        if self.strategy == "rendezvous":
+            best, best_score = 0, -1.0
+            for owner, (seed, weight) in enumerate(zip(self._seeds, self._shard_weights)):
+                # uniform in (0, 1) from the key and the shard, so the score is -weight / ln(u)
+                u = ((mix(position ^ seed) >> 11) + 0.5) / (1 << 53)
+                score = -weight / math.log(u)
+                if score > best_score:
+                    best, best_score = owner, score
+            return best
+        index = bisect.bisect_left(self.positions, position)
+        if index == len(self.positions):
             index = 0  # Wrap around.
-        return self.circle[index][1]
+        return self.owners[index]
+
+    def copy(self) -> "HashCircle":
+        circle = HashCircle(self.virtual_nodes, self.strategy, self.capacity)
+        circle.positions = list(self.positions)
+        circle.owners = array("H", self.owners)
+        circle.shard_names = list(self.shard_names)
+        circle.weights = dict(self.weights)
+        circle._index_ring()
+        return circle
+
+    def moved_arcs(self, old: "HashCircle") -> list[tuple[int, int, str, str]]:
+        """
+        Diffs this circle against `old` (the circle before a view change).
+
+        Returns the arcs whose owner changed, as (first, last, old_shard, new_shard) with
+        first <= last (positions, inclusive), in order around the circle. An arc that
+        wraps around is split in two.
+        Neighbouring arcs with the same old and new owner are merged.
 
-    def update_shards(self, shard_names: list[str]):
+        Strategies other than the ring don't place keys in arcs: unless nothing changed, any
+        key may have moved, which is one arc over the whole circle per (old, new) pair of shards.
+        """
+        if not self.shard_names or not old.shard_names:
+            return []
+        end = (1 << HashCircle.HASH_BITS) - 1
+        if self.strategy not in HashCircle.RING_STRATEGIES or old.strategy not in HashCircle.RING_STRATEGIES:
+            if self.config() == old.config():
+                return []
+            return [(0, end, old_shard, new_shard) for old_shard in old.shard_names for new_shard in self.shard_names if old_shard != new_shard]
+        # Between two consecutive virtual nodes of either circle, both circles have a single owner
+        boundaries = sorted(set(self.positions) | set(old.positions))
+        arcs = []
+        first = 0
+        for last in boundaries:
+            old_shard, new_shard = old.shard_at(last), self.shard_at(last)
+            if old_shard != new_shard:
+                if arcs and arcs[-1][1] == first - 1 and arcs[-1][2:] == (old_shard, new_shard):
+                    arcs[-1] = (arcs[-1][0], last, old_shard, new_shard)
+                else:
+                    arcs.append((first, last, old_shard, new_shard))
+            first = last + 1
+        # Past the last virtual node the circle wraps around to the owner of the first one
+        if first <= end:
+            old_shard, new_shard = old.shard_at(first), self.shard_at(first)
+            if old_shard != new_shard:
+                arcs.append((first, end, old_shard, new_shard))
+        return arcs
+
+    def update_shards(self, shard_names: list[str], weights: dict = None, strategy: str = None, capacity: float = None):
         """
         Replace the current circle with the given list of physical shard names.
-        
-        For each shard, create the configured number of virtual nodes.
+
+        For each shard, create the configured number of virtual nodes, scaled by its weight
+        relative to the mean weight (`weights` is {<shard>: <weight>}, shards not in it weigh 1).
+        The strategy and capacity default to HASH_STRATEGY and HASH_CAPACITY.
         """
+        self.strategy, self.capacity = HashCircle.check_strategy(strategy, capacity)
+        weights = weights or {}
+        self.weights = {shard: float(weights.get(shard, 1)) for shard in shard_names}
         new_circle = []
-        for shard in shard_names:
-            for i in range(self.virtual_nodes):
-                vnode_key = f"{shard}#{i}"
-                position = self._hash(vnode_key)
-                new_circle.append((position, shard))
-        self.circle = sorted(new_circle)
+        if self.strategy in HashCircle.RING_STRATEGIES and shard_names:
+            mean = sum(self.weights.values()) / len(self.weights)
+            for shard in shard_names:
+                for i in range(max(1, round(self.virtual_nodes * self.weights[shard] / mean))):
+                    vnode_key = f"{shard}#{i}"
+                    position = self._hash(vnode_key)
+                    new_circle.append((position, shard))
+        self._set_circle(new_circle, shard_names)
+        if self.strategy == "bounded" and self.positions:
+            self._bound_loads()
+
+    def _bound_loads(self):
+        """
+        Caps the arc each shard owns at `capacity` times its weighted share of the circle.
+
+        Walking around the circle, a virtual node whose shard is full passes its arc on to the
+        next virtual node whose shard still has room: the forwarding rule of consistent hashing
+        with bounded loads, applied to arcs (which a shard's expected load is proportional to),
+        so that every node derives the same placement from the view alone.
+        """
+        size = 1 << HashCircle.HASH_BITS
+        total = sum(self.weights.values())
+        room = [self.capacity * self.weights[name] / total * size for name in self.shard_names]
+        count = len(self.positions)
+        owners = array("H", self.owners)
+        for i in range(count):
+            arc = (self.positions[i] - self.positions[i - 1]) % size or size
+            for step in range(count):
+                owner = self.owners[(i + step) % count]
+                if room[owner] >= arc:
+                    break
+            else:
+                owner = max(range(len(room)), key=room.__getitem__)
+            room[owner] -= arc
+            owners[i] = owner
+        self.owners = owners
+        self._index_ring()
+
+    def arc_shares(self) -> dict[str, float]:
+        """Fraction of the circle each shard owns (ring strategies only, else empty)."""
+        size = 1 << HashCircle.HASH_BITS
+        shares = dict.fromkeys(self.shard_names, 0.0) if self.positions else {}
+        for i, position in enumerate(self.positions):
+            arc = (position - self.positions[i - 1]) % size or size
+            shares[self.shard_names[self.owners[i]]] += arc / size
+        return shares
+
+    def _positions_of(self, keys: list[str]):
+        if np is None:
+            return [self._hash(key) for key in keys]
+        # the same 8-byte digests as `position`, decoded all at once
+        blake2b = hashlib.blake2b
+        digests = b"".join([blake2b(key.encode("utf-8"), digest_size=8).digest() for key in keys])
+        return np.frombuffer(digests, dtype=">u8").astype(np.uint64)
+
+    def _owners_at(self, positions):
+        """Index (into self.shard_names) of the shard owning each position, vectorized if numpy is installed."""
+        if np is None:
+            return [self._owner_at(position) for position in positions]
+        if self.strategy == "jump":
+            return np.array([jump_hash(position, len(self.shard_names)) for position in positions.tolist()], dtype=np.int64)
+        if self.strategy == "rendezvous":
+            best = np.zeros(len(positions), dtype=np.int64)
+            best_score = np.full(len(positions), -1.0)
+            for owner, (seed, weight) in enumerate(zip(self._seeds, self._shard_weights)):
+                x = positions ^ np.uint64(seed)
+                x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+                x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+                x = x ^ (x >> np.uint64(31))
+                score = -weight / np.log(((x >> np.uint64(11)).astype(np.float64) + 0.5) / (1 << 53))
+                better = score > best_score
+                best[better] = owner
+                best_score[better] = score[better]
+            return best
+        index = np.searchsorted(self._ring_positions, positions, side="left")
+        index[index == len(self.positions)] = 0  # Wrap around.
+        return self._ring_owners[index]
+
+    def route(self, keys: list[str]) -> list[str]:
+        """The shard of every key in `keys` (like `get_shard_for_key`, in bulk and without the cache)."""
+        keys = list(keys)
+        if not keys:
+            return []
+        owners = self._owners_at(self._positions_of(keys))
+        return [self.shard_names[owner] for owner in (owners if np is None else owners.tolist())]
+
+    def distribution(self, keys: list[str]) -> dict[str, int]:
+        """Number of `keys` each shard of the circle owns."""
+        keys = list(keys)
+        counts = dict.fromkeys(self.shard_names, 0)
+        if not keys or not self.shard_names:
+            return counts
+        owners = self._owners_at(self._positions_of(keys))
+        if np is None:
+            for owner in owners:
+                counts[self.shard_names[owner]] += 1
+            return counts
+        return dict(zip(self.shard_names, np.bincount(owners, minlength=len(self.shard_names)).tolist()))
+
+    def moved_keys(self, keys: list[str], old: "HashCircle") -> dict[tuple[str, str], set[str]]:
+        """
+        The `keys` whose owner differs between `old` and this circle.
+
+        Returns {(old_shard, new_shard): {key, ...}, ...}. Every key is hashed once for both circles.
+        """
+        keys = list(keys)
+        if not keys or not self.shard_names or not old.shard_names:
+            return {}
+        positions = self._positions_of(keys)
+        new_owners, old_owners = self._owners_at(positions), old._owners_at(positions)
+        moved = {}
+        if np is None:
+            for key, old_owner, new_owner in zip(keys, old_owners, new_owners):
+                old_shard, new_shard = old.shard_names[old_owner], self.shard_names[new_owner]
+                if old_shard != new_shard:
+                    moved.setdefault((old_shard, new_shard), set()).add(key)
+            return moved
+        # old shard index -> index of the same shard in this circle (-1 if it is gone)
+        names = {name: i for i, name in enumerate(self.shard_names)}
+        translate = np.array([names.get(name, -1) for name in old.shard_names], dtype=np.int64)
+        changed = np.flatnonzero(translate[old_owners] != new_owners)
+        pairs = old_owners[changed].astype(np.int64) * len(self.shard_names) + new_owners[changed]
+        for i, pair in zip(changed.tolist(), pairs.tolist()):
+            old_owner, new_owner = divmod(pair, len(self.shard_names))
+            moved.setdefault((old.shard_names[old_owner], self.shard_names[new_owner]), set()).add(keys[i])
+        return moved
+
+    def report(self, old: "HashCircle" = None, samples: int = REPORT_SAMPLES) -> dict:
+        """
+        How evenly keys are spread over the shards, and how many moved since `old`, estimated
+        by routing `samples` synthetic keys:
+
+        {"strategy", "capacity", "max_load": <highest sampled / expected share>,
+         "shards": {<shard>: {"weight", "expected", "sampled", "arc" (ring strategies)}},
+         "moved": <fraction of keys whose shard differs from `old`'s> (if `old` is given)}
+        """
+        keys = [f"sample{i}" for i in range(samples)]
+        counts = self.distribution(keys)
+        arcs = self.arc_shares()
+        total = sum(self.weights.values()) or 1
+        shards = {}
+        for shard in self.shard_names:
+            shards[shard] = {"weight": self.weights.get(shard, 1.0), "expected": self.weights.get(shard, 1.0) / total, "sampled": counts[shard] / samples}
+            if arcs:
+                shards[shard]["arc"] = arcs[shard]
+        report = {
+            "strategy": self.strategy,
+            "capacity": self.capacity,
+            "max_load": max((entry["sampled"] / entry["expected"] for entry in shards.values()), default=0),
+            "shards": shards,
+        }
+        if old is not None and old.shard_names:
+            report["moved"] = sum(len(moved) for moved in self.moved_keys(keys, old).values()) / samples
+        return report
 
     def redistribute_keys(self, key_list: list[str]) -> dict:
         """
         Given a list of keys, return a dictionary mapping each physical shard
         to the list of keys that should be stored on that shard.
-        
+
         Example output: {"Shard1": ["key1", "key5"], "Shard2": ["key2", "key3"], ...}
         """
         distribution = {}
         # Initialize dictionary for each shard present in the circle.
-        for _, shard in self.circle:
+        for shard in self.shard_names:
             distribution.setdefault(shard, [])
-        for key in key_list:
-            shard = self.get_shard_for_key(key)
+        for key, shard in zip(key_list, self.route(key_list)):
             distribution[shard].append(key)
-        
+
         return distribution
 
     def __str__(self):
-        return f"HashCircle({self.circle})"
+        return f"HashCircle({self.strategy}, {self.circle if self.positions else self.shard_names})"
+
+if __name__ == "__main__":
+    # Microbenchmark of key -> shard routing: python -m packages.hash (from src/)
+    import timeit
+
+    circle = HashCircle()
+    circle.update_shards([f"shard{i}" for i in range(16)])
+    keys = [f"key{i}" for i in range(ROUTING_CACHE_SIZE)]
+    for label, route in (("uncached", circle._shard_for_key), ("cached", circle.get_shard_for_key)):
+        route_all = lambda: [route(key) for key in keys]
+        route_all()
+        seconds = min(timeit.repeat(route_all, number=1, repeat=5))
+        print(f"{label:>8}: {seconds / len(keys) * 1e9:7.0f} ns/key")
+    seconds = min(timeit.repeat(lambda: circle.route(keys), number=1, repeat=5))
+    print(f"{'bulk':>8}: {seconds / len(keys) * 1e9:7.0f} ns/key ({'numpy' if np is not None else 'no numpy'})")
+
+    # Placement of every strategy, and what adding a 17th shard (of weight 2) moves
+    for strategy in HashCircle.STRATEGIES:
+        grown = circle.copy()
+        grown.update_shards(circle.shard_names, strategy=strategy, capacity=1.1)
+        before = grown.copy()
+        grown.add_shard("shard16", weight=2)
+        report = grown.report(before)
+        print(f"{strategy:>10}: max load {report['max_load']:.2f}, moved {report['moved']:.3f}, new shard {report['shards']['shard16']['sampled']:.3f} of {report['shards']['shard16']['expected']:.3f}")
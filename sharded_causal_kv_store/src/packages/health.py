@@ -0,0 +1,150 @@
+"""
+Node-local health table for the other nodes in the view, used to skip or deprioritize slow and dead peers.
+
+- Fed passively by every inter-node request (`AsyncHelper.request` records its outcome),
+- and actively by `/ping` probes (`Health.probing`, run in app.py's lifespan) to peers we
+  haven't heard from recently, so a dead peer is noticed - and a recovered one brought back -
+  without client requests paying for it.
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from log import get_logger
+
+# Weight of the newest sample in the latency / error rate averages (EWMA).
+LATENCY_ALPHA = 0.3
+ERROR_ALPHA = 0.2
+
+# A peer is considered down after this many failed requests in a row (until it answers again).
+DOWN_AFTER_FAILURES = int(os.environ.get("DOWN_AFTER_FAILURES", 3))
+
+# Probe peers we haven't heard from in PROBE_INTERVAL secs, giving up on a probe after PROBE_TIMEOUT secs.
+PROBE_INTERVAL = float(os.environ.get("PROBE_INTERVAL", 1))
+PROBE_TIMEOUT = float(os.environ.get("PROBE_TIMEOUT", 0.5))
+
+logger = get_logger(__name__)
+
+class PeerHealth:
+    __slots__ = ("latency", "error_rate", "last_seen", "failures")
+
+    def __init__(self):
+        self.latency = None    # Average response time (in secs), None until the first response
+        self.error_rate = 0.0  # Average of 1 (failed) / 0 (answered) over recent requests
+        self.last_seen = None  # time.monotonic() of the last response
+        self.failures = 0      # Failed requests in a row
+
+    @property
+    def down(self) -> bool:
+        return self.failures >= DOWN_AFTER_FAILURES
+
+    def score(self) -> float:
+        """Expected cost of sending to this peer (lower is better). Unmeasured peers score 0, to measure them."""
+        if self.down:
+            return float("inf")
+        return (self.latency or 0) * (1 + 4 * self.error_rate)
+
+    def to_dict(self) -> dict:
+        return {
+            "latency": self.latency,
+            "error-rate": round(self.error_rate, 3),
+            "last-seen": None if self.last_seen is None else round(time.monotonic() - self.last_seen, 3),
+            "failures": self.failures,
+            "down": self.down,
+        }
+
+class Health:
+    # {<node address>: PeerHealth}
+    peers = {}
+
+    @staticmethod
+    def get(address: str) -> PeerHealth:
+        peer = Health.peers.get(address)
+        if peer is None:
+            peer = Health.peers[address] = PeerHealth()
+        return peer
+
+    @staticmethod
+    def record_success(address: str, latency: float):
+        """A response (of any status) came back from `address` after `latency` secs."""
+        peer = Health.get(address)
+        peer.latency = latency if peer.latency is None else (1 - LATENCY_ALPHA) * peer.latency + LATENCY_ALPHA * latency
+        peer.error_rate *= 1 - ERROR_ALPHA
+        peer.last_seen = time.monotonic()
+        peer.failures = 0
+
+    @staticmethod
+    def record_failure(address: str):
+        """A request to `address` failed to connect or timed out."""
+        peer = Health.get(address)
+        peer.error_rate = (1 - ERROR_ALPHA) * peer.error_rate + ERROR_ALPHA
+        peer.failures += 1
+        if peer.failures == DOWN_AFTER_FAILURES:
+            logger.warning("Peer %s is down after %d failed requests", address, peer.failures)
+
+    @staticmethod
+    def is_down(address: str) -> bool:
+        peer = Health.peers.get(address)
+        return peer is not None and peer.down
+
+    @staticmethod
+    def latency(address: str) -> float:
+        peer = Health.peers.get(address)
+        return 0 if peer is None or peer.latency is None else peer.latency
+
+    @staticmethod
+    def rank(nodes: list) -> list:
+        """Orders view nodes ({"address", "id"}) best first: fast and reliable, then slow, then down."""
+        return sorted(nodes, key=lambda node: Health.get(node["address"]).score())
+
+    @staticmethod
+    def forget_others(addresses):
+        """Drops the peers that are not in `addresses` (called on a view change)."""
+        addresses = set(addresses)
+        for address in list(Health.peers):
+            if address not in addresses:
+                del Health.peers[address]
+
+    @staticmethod
+    def table() -> dict:
+        return {address: peer.to_dict() for address, peer in Health.peers.items()}
+
+    @staticmethod
+    @asynccontextmanager
+    async def probing():
+        """Runs the probe loop in the background for the lifetime of the app."""
+        task = asyncio.create_task(Health._probe_loop())
+        try:
+            yield
+        finally:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    async def _probe_loop():
+        # helper imports this module (to feed the table), so import it lazily here
+        from shared_data import SharedData
+        from helper import AsyncHelper
+
+        async def probe(address):
+            try:
+                await AsyncHelper.async_get(f"http://{address}/ping", timeout=PROBE_TIMEOUT, retries=0)
+            except Exception:
+                pass # recorded by AsyncHelper.request
+
+        while True:
+            await asyncio.sleep(PROBE_INTERVAL)
+            now = time.monotonic()
+            stale = []
+            for nodes in SharedData.current_view.values():
+                for node in nodes:
+                    if int(node["id"]) == int(SharedData.NODE_IDENTIFIER):
+                        continue
+                    peer = Health.peers.get(node["address"])
+                    if peer is None or peer.last_seen is None or peer.down or now - peer.last_seen >= PROBE_INTERVAL:
+                        stale.append(node["address"])
+            if stale:
+                await asyncio.gather(*(probe(address) for address in stale))
@@ -0,0 +1,80 @@
+"""
+Hot-key detection: which keys this node sees the most requests for.
+
+A space-saving top-k summary (Metwally et al.) over a sample of the GETs and PUTs of
+/data/<key>: HOT_KEYS_CAPACITY counters, and a key that isn't counted yet takes over the
+counter of the least counted key (inheriting its count as the error bound). Counts are halved
+every HOT_KEYS_WINDOW secs, so keys that cooled down drop out.
+
+A key is hot once its estimated requests per window reach HOT_KEY_THRESHOLD. Reads of hot
+keys of other shards are mostly served from the read cache (packages/read_cache.py, unless
+READ_CACHE_KEYS caches all keys regardless).
+"""
+import os
+import random
+import time
+
+# Counters kept, fraction of requests counted, secs between halvings of the counts, and
+# estimated requests per window from which a key is hot.
+HOT_KEYS_CAPACITY = int(os.environ.get("HOT_KEYS_CAPACITY", 128))
+HOT_KEYS_SAMPLE = float(os.environ.get("HOT_KEYS_SAMPLE", 0.25))
+HOT_KEYS_WINDOW = float(os.environ.get("HOT_KEYS_WINDOW", 10))
+HOT_KEY_THRESHOLD = float(os.environ.get("HOT_KEY_THRESHOLD", 50))
+
+class HotKeys:
+    # {<key>: [<count>, <error>]} sampled requests for the key (overestimated by at most error)
+    counters = {}
+    last_decay = time.monotonic()
+
+    @staticmethod
+    def record(key: str):
+        """Counts a request for `key` (if it is sampled)."""
+        if HOT_KEYS_SAMPLE < 1 and random.random() >= HOT_KEYS_SAMPLE:
+            return
+        HotKeys._decay()
+        counter = HotKeys.counters.get(key)
+        if counter is not None:
+            counter[0] += 1
+        elif len(HotKeys.counters) < HOT_KEYS_CAPACITY:
+            HotKeys.counters[key] = [1, 0]
+        else:
+            coldest = min(HotKeys.counters, key=lambda other: HotKeys.counters[other][0])
+            count = HotKeys.counters.pop(coldest)[0]
+            HotKeys.counters[key] = [count + 1, count]
+
+    @staticmethod
+    def _decay():
+        now = time.monotonic()
+        if now - HotKeys.last_decay < HOT_KEYS_WINDOW:
+            return
+        # one halving per window passed (all of them at once after a quiet spell)
+        halvings = min(int((now - HotKeys.last_decay) // HOT_KEYS_WINDOW), 64)
+        HotKeys.last_decay = now
+        for key in list(HotKeys.counters):
+            counter = HotKeys.counters[key]
+            counter[0] >>= halvings
+            counter[1] >>= halvings
+            if not counter[0]:
+                del HotKeys.counters[key]
+
+    @staticmethod
+    def estimate(key: str) -> float:
+        """Estimated requests for `key` per window (0 if it isn't among the top keys)."""
+        counter = HotKeys.counters.get(key)
+        return 0 if counter is None else counter[0] / HOT_KEYS_SAMPLE
+
+    @staticmethod
+    def is_hot(key: str) -> bool:
+        return HotKeys.estimate(key) >= HOT_KEY_THRESHOLD
+
+    @staticmethod
+    def top(count: int = 20) -> list[dict]:
+        """The `count` most requested keys: [{"key", "requests", "error", "hot"}, ...] (estimates per window)."""
+        HotKeys._decay()
+        keys = sorted(HotKeys.counters, key=lambda key: HotKeys.counters[key][0], reverse=True)[:count]
+        return [{
+            "key": key,
+            "requests": HotKeys.counters[key][0] / HOT_KEYS_SAMPLE,
+            "error": HotKeys.counters[key][1] / HOT_KEYS_SAMPLE,
+            "hot": HotKeys.is_hot(key),
+        } for key in keys]
@@ -0,0 +1,128 @@
+"""
+Hash tree (Merkle tree) index over the keys a node holds of its shard.
+
+Used by anti-entropy to find which key ranges two replicas disagree on in a few round
+trips, instead of comparing every key.
+
+- Keys are placed into leaves by the top bits of their position on the hash ring, so every
+  node of the tree covers a contiguous range of the ring.
+- Each key contributes one 64-bit entry hash (computed by `util.entry_hash` from its value
+  and vector clock). A tree node's hash is the XOR of the entry hashes of all keys under it,
+  so adding/changing/removing a key only touches one node per level.
+"""
+from packages.hash import HashCircle
+
+# Each tree node has 2**FANOUT_BITS children; leaves are at level DEPTH.
+FANOUT_BITS = 4
+DEPTH = 4
+
+class MerkleIndex:
+    def __init__(self, fanout_bits: int = FANOUT_BITS, depth: int = DEPTH):
+        self.fanout_bits = fanout_bits
+        self.depth = depth
+        self.leaf_bits = fanout_bits * depth
+
+        # levels[d][i] = hash of node i at level d (level 0 is the root).
+        self.levels = [[0] * (1 << (fanout_bits * d)) for d in range(depth + 1)]
+
+        # {<key>: (<leaf>, <entry hash>)} and {<leaf>: {<key>: <entry hash>}}
+        self.entries = {}
+        self.buckets = {}
+
+    def leaf_of(self, key: str) -> int:
+        return HashCircle.position(key) >> (HashCircle.HASH_BITS - self.leaf_bits)
+
+    def _apply(self, leaf: int, delta: int):
+        """XOR `delta` into the leaf and every one of its ancestors."""
+        for level, hashes in enumerate(self.levels):
+            hashes[leaf >> (self.fanout_bits * (self.depth - level))] ^= delta
+
+    def update(self, key: str, entry_hash: int):
+        """Sets the entry hash of `key` (adding it if it's not indexed yet)."""
+        entry = self.entries.get(key)
+        if entry is None:
+            leaf = self.leaf_of(key)
+            delta = entry_hash
+        else:
+            leaf, old_hash = entry
+            delta = old_hash ^ entry_hash
+        self.entries[key] = (leaf, entry_hash)
+        self.buckets.setdefault(leaf, {})[key] = entry_hash
+        if delta:
+            self._apply(leaf, delta)
+
+    def remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        leaf, old_hash = entry
+        bucket = self.buckets[leaf]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[leaf]
+        self._apply(leaf, old_hash)
+
+    def clear(self):
+        self.__init__(self.fanout_bits, self.depth)
+
+    def entry_hash(self, key: str) -> int | None:
+        entry = self.entries.get(key)
+        return entry[1] if entry else None
+
+    def root(self) -> int:
+        return self.levels[0][0]
+
+    def nodes(self, level: int, indices: list[int]) -> list[int]:
+        """Hashes of the given nodes at `level`."""
+        hashes = self.levels[level]
+        return [hashes[i] for i in indices]
+
+    def children(self, index: int) -> range:
+        """Indices (on the next level) of the children of node `index`."""
+        first = index << self.fanout_bits
+        return range(first, first + (1 << self.fanout_bits))
+
+    def leaf_range(self, level: int, index: int) -> tuple[int, int]:
+        """The [first, last) leaves under node `index` of `level`."""
+        shift = self.fanout_bits * (self.depth - level)
+        return (index << shift, (index + 1) << shift)
+
+    def keys_in_ranges(self, ranges) -> list[str]:
+        """All indexed keys whose leaf is in one of the [first, last) leaf ranges."""
+        keys = []
+        for first, last in ranges:
+            if last - first > len(self.buckets):
+                # Wide range - cheaper to scan the (sparse) non-empty buckets
+                for leaf, bucket in self.buckets.items():
+                    if first <= leaf < last:
+                        keys.extend(bucket)
+            else:
+                for leaf in range(first, last):
+                    bucket = self.buckets.get(leaf)
+                    if bucket:
+                        keys.extend(bucket)
+        return keys
+
+    def keys_in_arcs(self, arcs) -> list[str]:
+        """All indexed keys whose position on the hash ring is in one of the arcs ((first, last, ...), inclusive)."""
+        shift = HashCircle.HASH_BITS - self.leaf_bits
+        # overlapping arcs (e.g. the whole circle, once per pair of shards) are scanned once
+        spans = []
+        for first, last in sorted((arc[0], arc[1]) for arc in arcs):
+            if spans and first <= spans[-1][1] + 1:
+                spans[-1][1] = max(spans[-1][1], last)
+            else:
+                spans.append([first, last])
+        keys = []
+        for first, last in spans:
+            for key in self.keys_in_ranges([(first >> shift, (last >> shift) + 1)]):
+                if first <= HashCircle.position(key) <= last:
+                    keys.append(key)
+        return keys
+
+    def in_ranges(self, key: str, ranges) -> bool:
+        leaf = self.leaf_of(key)
+        return any(first <= leaf < last for first, last in ranges)
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,331 @@
+"""
+View changes as a background state machine, numbered by epoch (routers/view.py starts it).
+
+    prepare  - the new view is installed (routing, replication targets, the hash ring) and we plan
+               which keys go to which nodes. Done inside PUT /view, which then returns right away.
+    transfer - the keys are streamed to their new holders (packages/transfer.py).
+    cutover  - we tell the nodes that were waiting on our data that we are done with them.
+    cleanup  - the keys that left our shard are dropped, once their new shard acked them.
+
+Until a node has heard "done" from every node it expects data from (or MIGRATION_TIMEOUT
+passes), keys it doesn't hold yet may still be on their old holders: a read or write of such
+a key first pulls it from the nodes of its old shard (`Migration.pull`), and GET /data waits
+for the transfers to finish (`Migration.wait_incoming`).
+
+A node joining a shard that had replicas pulls a snapshot of it from one of them (see
+packages/snapshot.py) rather than being sent the shard's keys by each, and waits for it likewise.
+
+A newer view change cancels the running one. The keys it didn't hand over are kept in
+SharedData.handoff, so the next plan retries them.
+"""
+import asyncio
+import os
+from shared_data import SharedData
+from helper import AsyncHelper, ReqHelper
+from packages.hash import HashCircle
+from packages.stability import Stability
+from packages.wire import Wire
+from packages.transfer import Transfer
+from packages.snapshot import Snapshot, SNAPSHOT_BOOTSTRAP
+import util
+from log import get_logger
+
+# Secs a node keeps pulling missing keys from their old holders while waiting for transfers.
+MIGRATION_TIMEOUT = float(os.environ.get("MIGRATION_TIMEOUT", 60))
+
+# Secs before a pull of a single key from an old holder times out.
+PULL_TIMEOUT = 1
+
+# Id the snapshot a node joining a shard pulls goes by among the senders it expects
+BOOTSTRAP = "snapshot"
+
+logger = get_logger(__name__)
+
+class Migration:
+    # Epoch of the last view change, and the state of its migration on this node
+    epoch = 0
+    state = "idle"
+
+    # Sending side: [(<keys>, <addresses>), ...] planned, keys acked so far, addresses that failed
+    transfers = []
+    sent = 0
+    failed = set()
+    task = None
+    bootstrap = None
+
+    # Receiving side: ids of the nodes we expect data from, and who told us they are done
+    # ({<view id>: {<node id: str>, ...}}, kept for views we haven't installed yet too)
+    expected = set()
+    done = {}
+    old_view = {}
+    old_circle = None
+    deadline = 0
+    incoming = asyncio.Event()
+    incoming.set()
+
+    @staticmethod
+    def start(epoch: int | None, old_view: dict, old_shard: str, old_circle: HashCircle, synced_peers: set, moved: list):
+        """Plans the migration to the view just installed, and runs it in the background.
+        `moved` are the keys of our old shard that moved to another one (as returned by install_view)."""
+        Migration.cancel()
+        Migration.epoch = Migration.epoch + 1 if epoch is None else epoch
+        arcs = SharedData.hash_circle.moved_arcs(old_circle)
+
+        Migration.state = "prepare"
+        Migration.transfers = plan_transfers(old_view, old_shard, moved)
+        Migration.sent = 0
+        Migration.failed = set()
+
+        Migration.old_view = old_view
+        Migration.old_circle = old_circle
+        Migration.expected = expected_senders(old_view, old_circle, arcs)
+        Migration.done = {Stability.view_id: Migration.done.get(Stability.view_id, set())}
+        Migration.deadline = asyncio.get_running_loop().time() + MIGRATION_TIMEOUT
+        Migration.incoming = asyncio.Event()
+
+        # joining a shard: pull a snapshot of it
+        sources = bootstrap_sources(old_view)
+        if sources:
+            Migration.expected.add(BOOTSTRAP)
+            Migration.bootstrap = asyncio.create_task(Migration._bootstrap(Stability.view_id, sources))
+        Migration.check_incoming()
+
+        receivers = notified_nodes(old_view, old_shard, arcs)
+        Migration.task = asyncio.create_task(Migration._run(Migration.epoch, old_view, old_shard, synced_peers, receivers))
+
+    @staticmethod
+    def cancel():
+        """Stops the running migration. Keys it planned to hand over are retried by the next one."""
+        if Migration.bootstrap is not None:
+            # (what it installed so far stays, the next view change decides whether to pull again)
+            Migration.bootstrap.cancel()
+            Migration.bootstrap = None
+        if Migration.task is None or Migration.task.done():
+            return
+        Migration.task.cancel()
+        for keys, _ in Migration.transfers:
+            for key in keys:
+                if key in SharedData.kvstore and not util.key_in_current_shard(key):
+                    SharedData.handoff.add(key)
+        logger.info("Cancelled the migration of epoch %d in state %s", Migration.epoch, Migration.state)
+
+    @staticmethod
+    async def _run(epoch: int, old_view: dict, old_shard: str, synced_peers: set, receivers: list[dict]):
+        # transfer: everything in parallel, one chunk in flight per transfer
+        Migration.state = "transfer"
+        copies = []
+        for group, (keys, addresses) in enumerate(Migration.transfers):
+            for address in addresses:
+                transfer_id = f"{Stability.view_id}:{SharedData.NODE_IDENTIFIER}:{group}"
+                copies.append((address, Transfer.send(address, transfer_id, keys, progress=Migration._acked)))
+        results = await asyncio.gather(*(copy for _, copy in copies))
+        Migration.failed = {address for (address, _), ok in zip(copies, results) if not ok}
+
+        # our writes so far are on the other replicas of our shard, unless a copy to them failed or they
+        # are staying on and hadn't caught up on them before
+        old_members = {node["address"] for node in old_view.get(old_shard, [])} if old_shard == SharedData.current_shard else set()
+        # (nodes that joined us pull a snapshot from any of us: gossip tells when they have our writes)
+        pulling = {node["address"] for node in joined(old_view, old_shard)} if old_members and SNAPSHOT_BOOTSTRAP else set()
+        for node in SharedData.gossip_nodes:
+            address = node["address"]
+            if int(node["id"]) == SharedData.NODE_IDENTIFIER or address in Migration.failed or address in pulling:
+                continue
+            if address not in old_members or address in synced_peers:
+                Stability.mark_synced(address)
+
+        # cutover: the nodes waiting on our data can stop pulling from us
+        Migration.state = "cutover"
+        body = {"view": Stability.view_id, "node": str(SharedData.NODE_IDENTIFIER)}
+        await asyncio.gather(*(
+            AsyncHelper.async_post(f"http://{node['address']}/view/transferred", body, headers=ReqHelper.create_req_headers(), timeout=PULL_TIMEOUT)
+            for node in receivers
+        ), return_exceptions=True)
+
+        # cleanup: drop the keys that left our shard, once every node of their new shard has them
+        Migration.state = "cleanup"
+        if util.in_current_view():
+            for keys, addresses in Migration.transfers:
+                for key in keys:
+                    if util.key_in_current_shard(key):
+                        SharedData.handoff.discard(key)
+                        continue
+                    if Migration.failed.intersection(addresses):
+                        SharedData.handoff.add(key)
+                        continue
+                    SharedData.handoff.discard(key)
+                    if key in SharedData.kvstore:
+                        util.key_changing(key)
+                        del SharedData.kvstore[key]
+                        del SharedData.causal_data[key]
+                        util.key_changed(key)
+            if SharedData.handoff:
+                logger.warning("%d keys that left shard %s are kept until their new shard acknowledges them", len(SharedData.handoff), SharedData.current_shard)
+        Migration.state = "idle"
+        logger.info("Migration of epoch %d done: %d keys sent, %d transfers failed", epoch, Migration.sent, len(Migration.failed))
+
+    @staticmethod
+    async def _bootstrap(view_id: str, sources: list[dict]):
+        # if no replica served one, gossip fills the shard in instead
+        await Snapshot.bootstrap(sources)
+        Migration.transferred(view_id, BOOTSTRAP)
+
+    @staticmethod
+    def _acked(count: int):
+        Migration.sent += count
+
+    @staticmethod
+    def transferred(view_id: str, node_id: str):
+        """`node_id` has sent us everything it had for us in the view `view_id`."""
+        Migration.done.setdefault(view_id, set()).add(node_id)
+        Migration.check_incoming()
+
+    @staticmethod
+    def check_incoming():
+        if Migration.expected <= Migration.done.get(Stability.view_id, set()):
+            Migration.incoming.set()
+
+    @staticmethod
+    def receiving() -> bool:
+        """Whether keys we own may still be on their old holders."""
+        if Migration.incoming.is_set():
+            return False
+        if asyncio.get_running_loop().time() >= Migration.deadline:
+            logger.warning("Stopped waiting for transfers from %s", sorted(Migration.expected - Migration.done.get(Stability.view_id, set())))
+            Migration.incoming.set()
+            return False
+        return True
+
+    @staticmethod
+    async def wait_incoming(timeout: float = None) -> bool:
+        """Waits until every transfer to us is done (or MIGRATION_TIMEOUT). False if `timeout` passed first."""
+        if not Migration.receiving():
+            return True
+        remaining = Migration.deadline - asyncio.get_running_loop().time()
+        try:
+            await asyncio.wait_for(Migration.incoming.wait(), remaining if timeout is None else min(timeout, remaining))
+        except asyncio.TimeoutError:
+            return not Migration.receiving()
+        return True
+
+    @staticmethod
+    async def pull(key: str):
+        """If `key` may still be on its old holders, merges their copies of it in first."""
+        if key in SharedData.kvstore or not Migration.receiving():
+            return
+        if Migration.old_view:
+            nodes = Migration.old_view.get(Migration.old_circle.shard_at(HashCircle.position(key)), [])
+        else:
+            # we had no view (a new or restarted node pulling a snapshot): the key's replicas have it, if anyone does
+            nodes = SharedData.current_view.get(SharedData.hash_circle.get_shard_for_key(key), [])
+        addresses = [node["address"] for node in nodes if int(node["id"]) != SharedData.NODE_IDENTIFIER]
+        results = await asyncio.gather(*(
+            AsyncHelper.async_get(f"http://{address}/view/key/{key}", headers=ReqHelper.create_req_headers(), timeout=PULL_TIMEOUT, retries=0)
+            for address in addresses
+        ), return_exceptions=True)
+        for res in results:
+            if isinstance(res, Exception) or res.status_code != 200:
+                continue
+            payload = Wire.body(res)
+            if payload.get("kvstore"):
+                util.merge_data(payload["kvstore"], payload["causal-metadata"], view_change=True)
+
+    @staticmethod
+    def status() -> dict:
+        return {
+            "epoch": Migration.epoch,
+            "state": Migration.state,
+            "view": Stability.view_id,
+            "outgoing": {
+                "keys": sum(len(keys) * len(addresses) for keys, addresses in Migration.transfers),
+                "sent": Migration.sent,
+                "failed": sorted(Migration.failed),
+            },
+            "incoming": {
+                "expected": sorted(Migration.expected),
+                "done": sorted(Migration.done.get(Stability.view_id, set()) & Migration.expected),
+                "complete": not Migration.receiving(),
+            },
+            "handoff": len(SharedData.handoff),
+            "bootstrap": Snapshot.status(),
+        }
+
+def plan_transfers(old_view: dict, old_shard: str, moved: list) -> list[tuple[list[str], list[str]]]:
+    """Which of our keys must be copied to which nodes after the view changed from `old_view`.
+
+    Returns [(<keys>, <addresses to copy them to>), ...]:
+    - keys of our old shard that moved to another shard (`moved`) go to every node of their new shard,
+    - if we moved to another shard (or left the view), the keys our old shard keeps go to all its nodes,
+    - if our shard gained nodes, they get the keys that stay in it,
+    - keys that left our shard in an earlier view change without being acknowledged are retried.
+    Only the third one looks at every key we hold.
+    """
+    circle = SharedData.hash_circle
+    own_id = SharedData.NODE_IDENTIFIER
+    if not circle.shard_names:
+        # an empty view: nowhere to copy keys to
+        return []
+
+    def addresses(nodes, skip=()):
+        return [node["address"] for node in nodes if int(node["id"]) != own_id and node["address"] not in skip]
+
+    # route the keys in bulk (vectorized if numpy is installed, see HashCircle.route)
+    by_shard = {}
+    handoff = list(moved) + [key for key in SharedData.handoff if key in SharedData.kvstore]
+    for key, shard in zip(handoff, circle.route(handoff)):
+        by_shard.setdefault(shard, set()).add(key)
+
+    transfers = [(sorted(keys), addresses(SharedData.current_view.get(shard, []))) for shard, keys in by_shard.items()]
+
+    if old_shard and old_shard in SharedData.current_view:
+        moved = set().union(*by_shard.values())
+        nodes = SharedData.current_view[old_shard]
+        if old_shard != SharedData.current_shard:
+            targets = addresses(nodes)
+        else:
+            targets = addresses(nodes, skip={node["address"] for node in old_view.get(old_shard, [])})
+        if targets and old_shard == SharedData.current_shard and SNAPSHOT_BOOTSTRAP:
+            # the nodes that joined our shard pull a snapshot of it instead
+            targets = []
+        if targets:
+            keys = [key for key in SharedData.kvstore if key not in moved]
+            staying = [key for key, shard in zip(keys, circle.route(keys)) if shard == old_shard]
+            transfers.append((staying, targets))
+    return [(keys, targets) for keys, targets in transfers if keys and targets]
+
+def joined(old_view: dict, shard: str) -> list[dict]:
+    """Nodes of `shard` in the current view that weren't in it in `old_view`."""
+    old_ids = {int(node["id"]) for node in old_view.get(shard, [])}
+    return [node for node in SharedData.current_view.get(shard, []) if int(node["id"]) not in old_ids]
+
+def bootstrap_sources(old_view: dict) -> list[dict]:
+    """The nodes to pull a snapshot of our shard from, if we just joined it: the ones that were in it
+    before (all the others if we had no view, e.g. after a restart). None if SNAPSHOT_BOOTSTRAP is off."""
+    shard = SharedData.current_shard
+    own_id = SharedData.NODE_IDENTIFIER
+    if not SNAPSHOT_BOOTSTRAP or not shard or not any(int(node["id"]) == own_id for node in joined(old_view, shard)):
+        return []
+    old_ids = {int(node["id"]) for node in old_view.get(shard, [])}
+    return [node for node in SharedData.current_view[shard] if int(node["id"]) != own_id and (not old_view or int(node["id"]) in old_ids)]
+
+def expected_senders(old_view: dict, old_circle: HashCircle, arcs: list) -> set[str]:
+    """Ids of the nodes that may hold keys we now own but don't have: the nodes of the shards
+    that owned arcs our shard took over, and the old nodes of our shard if we just joined it."""
+    shard = SharedData.current_shard
+    if not shard:
+        return set()
+    shards = {old for _, _, old, new in arcs if new == shard}
+    if any(int(node["id"]) == SharedData.NODE_IDENTIFIER for node in joined(old_view, shard)):
+        shards.add(shard)
+    own_id = str(SharedData.NODE_IDENTIFIER)
+    return {str(node["id"]) for old in shards for node in old_view.get(old, []) if str(node["id"]) != own_id}
+
+def notified_nodes(old_view: dict, old_shard: str, arcs: list) -> list[dict]:
+    """The nodes that expect data from us (see `expected_senders`), whether or not we had any for them."""
+    if not old_shard:
+        return []
+    shards = {new for _, _, old, new in arcs if old == old_shard}
+    nodes = [node for shard in shards for node in SharedData.current_view.get(shard, [])]
+    nodes += joined(old_view, old_shard)
+    unique = {int(node["id"]): node for node in nodes}
+    unique.pop(SharedData.NODE_IDENTIFIER, None)
+    return list(unique.values())
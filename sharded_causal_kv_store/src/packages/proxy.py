@@ -0,0 +1,107 @@
+"""
+Forwarding (proxying) of client requests to the shard that owns a key.
+
+- The request first goes to the best replica according to the health table (packages/health.py):
+  the fastest and most reliable one, with dead ones last.
+- Reads are hedged: if that replica hasn't answered within a hedge delay (a small multiple
+  of its usual latency), or it failed, the request is raced against the remaining replicas.
+  The first usable response wins and the other in-flight requests are cancelled.
+- Writes are not idempotent (every replica that applies a PUT assigns it its own clock), so
+  they are never raced: they fail over to the next replica only once the previous one failed.
+- Requests and responses carry the sender's stability report (packages/stability.py), so both
+  shards learn which of the other's writes are stable.
+- If no replica gives a usable response, it's retried with fresh requests and exponential backoff.
+"""
+import asyncio
+from shared_data import SharedData
+from helper import AsyncHelper
+from packages.health import Health
+from packages.stability import Stability
+import util
+from log import get_logger
+
+# Wait HEDGE_FACTOR x the preferred replica's average latency (but at least HEDGE_DELAY_MIN
+# secs) before racing the other replicas.
+HEDGE_FACTOR = 2
+HEDGE_DELAY_MIN = 0.05
+
+# Backoff (in secs) between rounds of retries, doubled each round up to RETRY_BACKOFF_MAX.
+RETRY_BACKOFF = 0.1
+RETRY_BACKOFF_MAX = 1
+
+logger = get_logger(__name__)
+
+class Proxy:
+    @staticmethod
+    def usable(response) -> bool:
+        """Any answer below 500 is authoritative (e.g. 404 means the key doesn't exist)."""
+        return response is not None and response.status_code < 500
+
+    @staticmethod
+    async def _send(method: str, node: dict, path: str, body, timeout: float, headers: dict = None):
+        """Sends the request to one replica. Returns the response, or None if it couldn't be reached."""
+        address = node["address"]
+        try:
+            response = await AsyncHelper.request(method, f"http://{address}{path}", body, headers=dict(Stability.headers(), **(headers or {})), timeout=timeout, retries=0)
+        except Exception as e:
+            logger.warning("Proxy %s %s to %s failed: %r", method, path, address, e)
+            return None
+        # The owning shard's stable frontier comes back with the response
+        Stability.learn_header(response.headers)
+        return response
+
+    @staticmethod
+    async def _race(method: str, nodes: list, path: str, body, timeout: float, hedge: bool, headers: dict = None):
+        """One round across `nodes` (ranked best first), hedged if `hedge`, else one replica at a time.
+
+        Returns the first usable response, else the last response received (None if no replica answered).
+        """
+        waiting = list(nodes)
+        pending = set()
+        last_response = None
+
+        def launch(count):
+            for node in waiting[:count]:
+                pending.add(asyncio.create_task(Proxy._send(method, node, path, body, timeout, headers)))
+            del waiting[:count]
+
+        launch(1)
+        hedge_delay = max(HEDGE_DELAY_MIN, HEDGE_FACTOR * Health.latency(nodes[0]["address"])) if hedge else None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=hedge_delay if waiting else None, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    response = task.result()
+                    if Proxy.usable(response):
+                        return response
+                    last_response = response or last_response
+                # The preferred replica is slow or failed - race all the others (or fail over to the next one)
+                launch(len(waiting) if hedge else 1)
+        finally:
+            for task in pending:
+                task.cancel()
+        return last_response
+
+    @staticmethod
+    async def forward(method: str, shard: str, path: str, body, timeout: float = 3, deadline: float = None, headers: dict = None):
+        """Forwards a request (with extra `headers`, if any) to the replicas of `shard`, returning the first usable httpx response.
+
+        Only GETs are hedged. Retries until a replica answers. If `deadline` (event loop time) is given and passes first,
+        returns the last (unusable) response received, or None if no replica answered at all.
+        """
+        loop = asyncio.get_running_loop()
+        backoff = RETRY_BACKOFF
+        last_response = None
+        while True:
+            nodes = Health.rank(util.get_nodes_by_shard(SharedData.current_view, shard))
+            if nodes:
+                response = await Proxy._race(method, nodes, path, body, timeout, hedge=method == "GET", headers=headers)
+                if Proxy.usable(response):
+                    return response
+                last_response = response or last_response
+
+            if deadline is not None and loop.time() + backoff >= deadline:
+                return last_response
+            logger.info("Proxying %s %s to %s: no usable reply, retrying in %ss", method, path, shard, backoff)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, RETRY_BACKOFF_MAX)
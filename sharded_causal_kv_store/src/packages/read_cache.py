@@ -0,0 +1,259 @@
+"""
+Cache of keys of other shards, so reads of them don't all pay a hop to the owning shard.
+READ_CACHE_KEYS picks the keys cached: the hot ones (see packages/hotkeys.py), or all of them.
+
+- A GET of a key we don't own asks the owner for its entry along with the value
+  (`ENTRY_HEADER` on the proxied request, carrying our node id). The owner sends back the
+  key's dependency map in the same header, and we keep (value, dependency map) for
+  READ_CACHE_TTL secs. At most READ_CACHE_SIZE entries are kept, least recently used out first.
+- A later GET of the key is served from the entry only if the entry is at least as recent as
+  the client's causal-metadata for the key (as the owner would check it). Otherwise it is
+  proxied as usual, which refreshes the entry.
+- With READ_CACHE_PUSH, the owner remembers who asked for the entry (for READ_CACHE_TTL secs)
+  and pushes the key's new entry to them (POST /cache/refresh) when it changes, in batches.
+  Pushes are best effort: a lost one leaves the entry to expire.
+- The cache is dropped on view changes, and an entry is dropped when we forward a write of its key.
+"""
+import asyncio
+import json
+import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from shared_data import SharedData
+from packages.vector_clock import VectorClock
+from helper import AsyncHelper, ReqHelper
+from packages.wire import Wire
+from packages.render import Fragments
+from packages.hotkeys import HotKeys
+from log import get_logger
+import util
+
+# Header asking the owner of a key for its entry (on the request), and carrying it (on the response).
+ENTRY_HEADER = "Cache-Entry"
+
+# Secs a cached entry is served for, and max entries kept (0 turns the cache off).
+READ_CACHE_TTL = float(os.environ.get("READ_CACHE_TTL", 1))
+READ_CACHE_SIZE = int(os.environ.get("READ_CACHE_SIZE", 10000))
+
+# Keys of other shards cached: "hot" (see packages/hotkeys.py) or "all".
+READ_CACHE_KEYS = os.environ.get("READ_CACHE_KEYS", "hot").lower()
+
+# Push the new entry of a key to the nodes caching it when it changes.
+READ_CACHE_PUSH = os.environ.get("READ_CACHE_PUSH", "true").lower() in ("1", "true", "yes")
+
+# Secs to wait after the first change, for more to join the push, and before a push times out.
+PUSH_LINGER = 0.005
+PUSH_TIMEOUT = 1
+
+logger = get_logger(__name__)
+
+class ReadCache:
+    # {<key>: (<value>, <dependency map: {<key>: VectorClock}>, <expiry (monotonic secs)>)}, least recently used first
+    entries = OrderedDict()
+    hits = 0
+    misses = 0
+    refreshes = 0
+
+    # Owner side: {<key>: {<address of a node caching it>: <expiry (monotonic secs)>}}, least recently asked first
+    subscribers = OrderedDict()
+    # {<address>: {<key>, ...}} changed keys to push
+    pending = {}
+    wakeup = asyncio.Event()
+    tasks = set()
+
+    @staticmethod
+    def enabled() -> bool:
+        return READ_CACHE_SIZE > 0
+
+    @staticmethod
+    def caches(key: str) -> bool:
+        """Whether reads of `key` (of another shard) go through the cache (see READ_CACHE_KEYS)."""
+        return ReadCache.enabled() and (READ_CACHE_KEYS == "all" or HotKeys.is_hot(key))
+
+    @staticmethod
+    def request_header() -> dict:
+        """`ENTRY_HEADER` to put on a proxied GET, to get the owner's entry back."""
+        return {ENTRY_HEADER: str(SharedData.NODE_IDENTIFIER)} if ReadCache.enabled() else {}
+
+    @staticmethod
+    def entry_header(key: str, requester: str = None) -> dict:
+        """`ENTRY_HEADER` with our entry for `key` (owner side).
+
+        `requester` is the node id sent on the request; the node is pushed the key's changes
+        for READ_CACHE_TTL secs.
+        """
+        dependencies = SharedData.causal_data.get(key)
+        if dependencies is None:
+            return {}
+        if READ_CACHE_PUSH and requester:
+            ReadCache._subscribe(key, requester)
+        return {ENTRY_HEADER: Fragments.dependencies(key)}
+
+    @staticmethod
+    def store(key: str, response):
+        """Caches the owner's answer to a proxied GET of `key`, if it came with its entry."""
+        entry = response.headers.get(ENTRY_HEADER)
+        if response.status_code != 200 or not entry or not ReadCache.enabled():
+            return
+        try:
+            dependencies = util.dict_to_causal_data(json.loads(entry))
+            value = Wire.body(response)["value"]
+        except (ValueError, KeyError, TypeError):
+            return
+        if key in dependencies:
+            ReadCache._put(key, value, dependencies)
+
+    @staticmethod
+    def _put(key: str, value: str, dependencies: dict):
+        ReadCache.entries[key] = (value, dependencies, time.monotonic() + READ_CACHE_TTL)
+        ReadCache.entries.move_to_end(key)
+        while len(ReadCache.entries) > READ_CACHE_SIZE:
+            ReadCache.entries.popitem(last=False)
+
+    @staticmethod
+    def lookup(key: str, client_clock: VectorClock | None):
+        """The cached (value, dependency map) of `key`, if it is fresh and at least as recent as `client_clock`."""
+        entry = ReadCache.entries.get(key)
+        if entry is None or entry[2] < time.monotonic():
+            ReadCache.entries.pop(key, None)
+            ReadCache.misses += 1
+            return None
+        value, dependencies, _ = entry
+        if not newer_or_same(dependencies[key], client_clock):
+            ReadCache.misses += 1
+            return None
+        ReadCache.entries.move_to_end(key)
+        ReadCache.hits += 1
+        return value, dependencies
+
+    @staticmethod
+    def refresh(entries: dict):
+        """Applies entries pushed by an owner: {<key>: {"value", "causal-metadata"} or None if it was deleted}.
+
+        Only keys we still cache are touched, and an entry never goes back to an older clock
+        (the push may come from a replica behind the one we read from).
+        """
+        for key, pushed in entries.items():
+            cached = ReadCache.entries.get(key)
+            if cached is None:
+                continue
+            if pushed is None:
+                del ReadCache.entries[key]
+                continue
+            dependencies = util.dict_to_causal_data(pushed.get("causal-metadata", {}))
+            if key in dependencies and newer_or_same(dependencies[key], cached[1][key]):
+                ReadCache.entries[key] = (pushed["value"], dependencies, time.monotonic() + READ_CACHE_TTL)
+                ReadCache.refreshes += 1
+
+    @staticmethod
+    def invalidate(key: str):
+        ReadCache.entries.pop(key, None)
+
+    @staticmethod
+    def clear():
+        """Drops the cache and the subscriptions (called on a view change)."""
+        ReadCache.entries.clear()
+        ReadCache.subscribers.clear()
+        ReadCache.pending.clear()
+
+    @staticmethod
+    def _subscribe(key: str, requester: str):
+        try:
+            address = util.get_node_address_by_id(int(requester))
+        except ValueError:
+            return
+        if address is None:
+            return
+        now = time.monotonic()
+        ReadCache.subscribers.setdefault(key, {})[address] = now + READ_CACHE_TTL
+        ReadCache.subscribers.move_to_end(key)
+        # forget the keys nobody asked for since their entries expired
+        while ReadCache.subscribers:
+            oldest = next(iter(ReadCache.subscribers))
+            if max(ReadCache.subscribers[oldest].values()) >= now:
+                break
+            del ReadCache.subscribers[oldest]
+
+    @staticmethod
+    def notify(key: str):
+        """Queues a push of `key`'s new entry to the nodes caching it (called by util.key_changed)."""
+        subscribers = ReadCache.subscribers.get(key)
+        if not subscribers:
+            return
+        now = time.monotonic()
+        for address, expiry in list(subscribers.items()):
+            if expiry < now:
+                del subscribers[address]
+            else:
+                ReadCache.pending.setdefault(address, set()).add(key)
+        if not subscribers:
+            del ReadCache.subscribers[key]
+        ReadCache.wakeup.set()
+
+    @staticmethod
+    def flush():
+        """Sends the queued pushes, one request per node."""
+        pending, ReadCache.pending = ReadCache.pending, {}
+        for address, keys in pending.items():
+            entries = {}
+            for key in keys:
+                if key in SharedData.kvstore and key in SharedData.causal_data:
+                    entries[key] = {"value": SharedData.kvstore[key], "causal-metadata": util.causal_data_to_dict(SharedData.causal_data[key])}
+                else:
+                    entries[key] = None
+            task = asyncio.create_task(ReadCache._push(address, entries))
+            ReadCache.tasks.add(task)
+            task.add_done_callback(ReadCache.tasks.discard)
+
+    @staticmethod
+    async def _push(address: str, entries: dict):
+        try:
+            await AsyncHelper.async_post(f"http://{address}/cache/refresh", {"entries": entries}, headers=ReqHelper.create_req_headers(), timeout=PUSH_TIMEOUT, retries=0)
+        except Exception as e:
+            # the entries expire there anyway
+            logger.debug("Pushing %d cache entries to %s failed: %r", len(entries), address, e)
+
+    @staticmethod
+    @asynccontextmanager
+    async def pushing():
+        """Runs the push loop in the background for the lifetime of the app."""
+        task = asyncio.create_task(ReadCache._push_loop())
+        try:
+            yield
+        finally:
+            task.cancel()
+            for pending in list(ReadCache.tasks):
+                pending.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    async def _push_loop():
+        while True:
+            await ReadCache.wakeup.wait()
+            ReadCache.wakeup.clear()
+            # Linger so a burst of writes goes out together
+            await asyncio.sleep(PUSH_LINGER)
+            ReadCache.flush()
+
+    @staticmethod
+    def stats() -> dict:
+        return {
+            "entries": len(ReadCache.entries),
+            "size": READ_CACHE_SIZE,
+            "hits": ReadCache.hits,
+            "misses": ReadCache.misses,
+            "refreshes": ReadCache.refreshes,
+            "subscribed-keys": len(ReadCache.subscribers),
+            "ttl": READ_CACHE_TTL,
+            "keys": READ_CACHE_KEYS,
+        }
+
+def newer_or_same(clock: VectorClock, other: VectorClock | None) -> bool:
+    """Whether a read of a version at `clock` satisfies a client that has seen `other` (as the owner checks it)."""
+    if other is None:
+        return True
+    return not (other > clock or (clock.isConcurrent(other) and clock.concurrent_break_ties(other) == other))
@@ -0,0 +1,158 @@
+"""
+Rendering of JSON responses.
+
+- `FastJSONResponse` encodes with orjson if it is installed (with the standard library's encoder
+  otherwise), and sends bytes it is given as they are (a body rendered in advance). The app and
+  its routers use it for every JSON response.
+- `Fragments` caches the parts of responses that only depend on a key's entry, encoded:
+  `"<key>":<value>` and `"<key>":<the key's clock>` (members of GET /data's "items" and
+  "causal-metadata"), and the key's dependency map (the read cache's entry header, see
+  packages/read_cache.py). They are encoded on first use and dropped when the key changes
+  (`util.key_changed`), so reading a key again doesn't encode it again. At most
+  FRAGMENT_CACHE_SIZE keys have fragments, least recently used out first.
+"""
+import json
+import os
+from collections import OrderedDict
+from fastapi.responses import JSONResponse
+from shared_data import SharedData
+
+try:
+    import orjson
+except ImportError: # optional, the standard library's encoder is used instead
+    orjson = None
+
+# Keys whose encoded fragments are cached (LRU); 0 turns the cache off.
+FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 100000))
+
+def dumps(content) -> bytes:
+    """`content` as compact JSON (UTF-8)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            # e.g. ints past 64 bits, which only the standard library encodes
+            pass
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        if isinstance(content, bytes):
+            return content
+        return dumps(content)
+
+# Slots of a key's fragments: `"<key>":<value>`, where the value starts in it, `"<key>":<clock>`
+# and the dependency map (each None until first used)
+ITEM, VALUE_AT, CLOCK, DEPENDENCIES = range(4)
+
+class Fragments:
+    # {<key>: [<fragment> or None, ...]} (see the slots above), least recently used first
+    entries = OrderedDict()
+
+    hits = 0
+    misses = 0
+
+    @staticmethod
+    def _slots(key: str) -> list:
+        if FRAGMENT_CACHE_SIZE <= 0:
+            return [None, None, None, None]
+        entries = Fragments.entries
+        slots = entries.get(key)
+        if slots is None:
+            slots = entries[key] = [None, None, None, None]
+            if len(entries) > FRAGMENT_CACHE_SIZE:
+                entries.popitem(last=False)
+        else:
+            entries.move_to_end(key)
+        return slots
+
+    @staticmethod
+    def _missing(slots: list, slot: int) -> bool:
+        """Whether `slot` is yet to be encoded (counting a hit if not)."""
+        if slots[slot] is None:
+            Fragments.misses += 1
+            return True
+        Fragments.hits += 1
+        return False
+
+    @staticmethod
+    def _item(key: str) -> list:
+        slots = Fragments._slots(key)
+        if Fragments._missing(slots, ITEM):
+            key_json = dumps(key)
+            slots[ITEM] = key_json + b":" + dumps(SharedData.kvstore[key])
+            slots[VALUE_AT] = len(key_json) + 1
+        return slots
+
+    @staticmethod
+    def item(key: str) -> bytes:
+        """`"<key>":<value>` (the key must be in SharedData.kvstore)."""
+        return Fragments._item(key)[ITEM]
+
+    @staticmethod
+    def value(key: str) -> bytes:
+        """The key's value, encoded (the key must be in SharedData.kvstore)."""
+        slots = Fragments._item(key)
+        return slots[ITEM][slots[VALUE_AT]:]
+
+    @staticmethod
+    def clock(key: str) -> bytes:
+        """`"<key>":<the key's own clock>` (the key must be in SharedData.causal_data)."""
+        slots = Fragments._slots(key)
+        if Fragments._missing(slots, CLOCK):
+            slots[CLOCK] = dumps(key) + b":" + dumps(SharedData.causal_data[key][key].to_dict())
+        return slots[CLOCK]
+
+    @staticmethod
+    def dependencies(key: str) -> str:
+        """The key's dependency map as (ASCII) JSON, to send in a header (the key must be in SharedData.causal_data)."""
+        slots = Fragments._slots(key)
+        if Fragments._missing(slots, DEPENDENCIES):
+            dependencies = SharedData.causal_data[key]
+            slots[DEPENDENCIES] = json.dumps({dep: clock.to_dict() for dep, clock in dependencies.items()}, separators=(",", ":"))
+        return slots[DEPENDENCIES]
+
+    @staticmethod
+    def invalidate(key: str):
+        Fragments.entries.pop(key, None)
+
+    @staticmethod
+    def clear():
+        Fragments.entries.clear()
+
+    @staticmethod
+    def render_all(keys, clock_keys) -> bytes:
+        """Body of GET /data: {"items": {<key>: <value> for keys}, "causal-metadata": {<key>: <its clock> for clock_keys}}."""
+        return b"".join((
+            b'{"items":{', Fragments._join(keys, ITEM, Fragments.item),
+            b'},"causal-metadata":{', Fragments._join(clock_keys, CLOCK, Fragments.clock), b"}}",
+        ))
+
+    @staticmethod
+    def _join(keys, slot: int, encode) -> bytes:
+        """The `slot` fragments of `keys`, comma separated (`encode` gives those not cached yet)."""
+        # `_slots` and `_missing` inlined: a warm cache costs a lookup per key
+        entries = Fragments.entries
+        get, move_to_end = entries.get, entries.move_to_end
+        parts = []
+        hits = 0
+        for key in keys:
+            slots = get(key)
+            fragment = None if slots is None else slots[slot]
+            if fragment is None:
+                fragment = encode(key)
+            else:
+                move_to_end(key)
+                hits += 1
+            parts.append(fragment)
+        Fragments.hits += hits
+        return b",".join(parts)
+
+    @staticmethod
+    def render_value(key: str, causal_metadata: dict) -> bytes:
+        """Body of GET /data/<key>: {"value": <its value>, "causal-metadata": causal_metadata}."""
+        return b'{"value":' + Fragments.value(key) + b',"causal-metadata":' + dumps(causal_metadata) + b"}"
+
+    @staticmethod
+    def stats() -> dict:
+        return {"keys": len(Fragments.entries), "hits": Fragments.hits, "misses": Fragments.misses, "encoder": "orjson" if orjson is not None else "json"}
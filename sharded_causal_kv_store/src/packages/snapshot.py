@@ -0,0 +1,206 @@
+"""
+Snapshot bootstrap: a node joining a shard pulls one image of the shard from a replica, instead
+of being pushed the shard's keys by every replica (packages/transfer.py) or filled by gossip.
+
+Serving side (`GET /snapshot`, `Snapshot.stream`):
+- The image holds the keys of our shard as they were when the request came in. It is streamed
+  leaf by leaf of the Merkle index (packages/merkle.py), in order. Before a key changes in a leaf
+  not streamed yet, its state is kept (`Snapshot.keep`, through util.key_changing) and streamed
+  instead. Keys created since are left out.
+- The body is gzip-compressed NDJSON, sent as it is produced (chunked):
+
+      {"snapshot": "<shard>", "view": "<view id>", "node": <node id>}
+      {"key": "<key>", "value": "<value>", "causal-metadata": {<dep key>: {<node id>: <int>}, ...}}
+      ...
+      {"end": true, "keys": <number of keys>}
+
+  Only one chunk of SNAPSHOT_CHUNK_SIZE keys is built at a time, so a snapshot is paced by how
+  fast we read the data and the network carries it.
+
+Installing side (`Snapshot.bootstrap`, started by Migration when we join a shard):
+- The snapshot is pulled from the best replica of the shard (the next one if that fails), and
+  its entries merged as they arrive. A stream cut short (no end line) counts as a failure.
+- Writes made since the image was taken are caught up on with one anti-entropy round with the
+  same replica (packages/gossip.py), which only ships the keys that differ. Writes replicated to
+  us meanwhile are merged as usual (merging is idempotent).
+- Until then, keys we don't have yet are pulled from the shard's replicas on access
+  (`Migration.pull`), and GET /data waits, as for any incoming transfer.
+"""
+import asyncio
+import json
+import os
+import time
+import zlib
+from shared_data import SharedData
+from helper import AsyncHelper, ReqHelper
+from packages.health import Health
+from packages.gossip import Gossip
+from packages.stability import Stability
+import util
+from log import get_logger
+
+# Pull a snapshot when joining a shard. Must be the same on every node: with it, the replicas of
+# a shard don't push their keys to the nodes joining it.
+SNAPSHOT_BOOTSTRAP = os.environ.get("SNAPSHOT_BOOTSTRAP", "true").lower() in ("1", "true", "yes")
+
+# Keys per compressed chunk of the stream, and the compression level (1 fastest ... 9 smallest).
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get("SNAPSHOT_CHUNK_SIZE", 1000))
+SNAPSHOT_COMPRESSION = int(os.environ.get("SNAPSHOT_COMPRESSION", 1))
+
+# Secs without data before a pull fails, rounds over the replicas, and the backoff (in secs) between them.
+SNAPSHOT_TIMEOUT = 10
+SNAPSHOT_ATTEMPTS = 3
+SNAPSHOT_BACKOFF = 0.2
+
+logger = get_logger(__name__)
+
+def entry(key: str):
+    """(value, json dependency map) of `key`, or None if we don't hold it."""
+    if key in SharedData.kvstore and key in SharedData.causal_data:
+        return SharedData.kvstore[key], util.causal_data_to_dict(SharedData.causal_data[key])
+    return None
+
+class Image:
+    """A snapshot being streamed: the leaves of the Merkle index below `cursor` are sent."""
+
+    def __init__(self):
+        self.cursor = 0
+        self.view = Stability.view_id
+        # {<leaf>: {<key>: <its entry when the snapshot started>}} for keys changed since
+        self.kept = {}
+
+    def keep(self, key: str):
+        leaf = SharedData.merkle.leaf_of(key)
+        if leaf < self.cursor:
+            return
+        kept = self.kept.setdefault(leaf, {})
+        if key not in kept:
+            kept[key] = entry(key)
+
+class Snapshot:
+    # Serving side: the images being streamed
+    images = set()
+
+    # Installing side: state of the last bootstrap ("idle", "pulling", "catching-up", "done" or
+    # "failed"), the replica it pulled from, the keys installed and how long it took
+    state = "idle"
+    source = None
+    installed = 0
+    elapsed = None
+
+    @staticmethod
+    def keep(key: str):
+        """Keeps the state of `key` for the snapshots being streamed, before it changes (called by util.key_changing)."""
+        for image in Snapshot.images:
+            image.keep(key)
+
+    @staticmethod
+    async def stream():
+        """Body of GET /snapshot: an image of our shard, gzip-compressed NDJSON (see the top of this file)."""
+        image = Image()
+        # wbits 31: gzip framing, so the client decodes it as Content-Encoding: gzip
+        compressor = zlib.compressobj(SNAPSHOT_COMPRESSION, zlib.DEFLATED, 31)
+        Snapshot.images.add(image)
+        try:
+            lines = [json.dumps({"snapshot": SharedData.current_shard, "view": image.view, "node": SharedData.NODE_IDENTIFIER})]
+            count = 0
+            for leaf in range(1 << SharedData.merkle.leaf_bits):
+                kept = image.kept.pop(leaf, {})
+                bucket = SharedData.merkle.buckets.get(leaf)
+                keys = list(kept) + [key for key in bucket if key not in kept] if bucket else list(kept)
+                for key in keys:
+                    state = kept[key] if key in kept else entry(key)
+                    if state is None or not util.key_in_current_shard(key):
+                        continue
+                    lines.append(json.dumps({"key": key, "value": state[0], "causal-metadata": state[1]}))
+                    count += 1
+                image.cursor = leaf + 1
+                if len(lines) < SNAPSHOT_CHUNK_SIZE:
+                    continue
+                data = compressor.compress(("\n".join(lines) + "\n").encode("utf-8"))
+                lines = []
+                if data:
+                    yield data
+                # sending doesn't wait unless the connection is backed up, so let other requests in
+                await asyncio.sleep(0)
+                if Stability.view_id != image.view:
+                    # our shard may be another one now: end without the end line, the client pulls again
+                    logger.info("View changed, ending the snapshot after %d keys", count)
+                    return
+            lines.append(json.dumps({"end": True, "keys": count}))
+            yield compressor.compress(("\n".join(lines) + "\n").encode("utf-8")) + compressor.flush()
+            logger.info("Streamed a snapshot of %d keys", count)
+        finally:
+            Snapshot.images.discard(image)
+
+    @staticmethod
+    async def install(address: str) -> int:
+        """Pulls the snapshot of the node at `address`, merging its entries as they arrive. Returns the number of keys.
+
+        Raises if it couldn't be pulled whole.
+        """
+        installed = 0
+        header = end = None
+        async with AsyncHelper.stream("GET", f"http://{address}/snapshot", headers=ReqHelper.create_req_headers(), timeout=SNAPSHOT_TIMEOUT) as res:
+            if res.status_code != 200:
+                raise ConnectionError(f"Snapshot request answered {res.status_code}")
+            buffer = b""
+            kvstore, metadata = {}, {}
+            # (httpx undoes the gzip encoding)
+            async for data in res.aiter_bytes():
+                lines = (buffer + data).split(b"\n")
+                buffer = lines.pop()
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    item = json.loads(line)
+                    if header is None:
+                        header = item
+                    elif item.get("end"):
+                        end = item
+                    else:
+                        kvstore[item["key"]] = item["value"]
+                        metadata[item["key"]] = item["causal-metadata"]
+                if len(kvstore) >= SNAPSHOT_CHUNK_SIZE:
+                    util.merge_data(kvstore, metadata)
+                    installed += len(kvstore)
+                    kvstore, metadata = {}, {}
+            if kvstore:
+                util.merge_data(kvstore, metadata)
+                installed += len(kvstore)
+        if end is None:
+            raise ConnectionError(f"Snapshot cut short after {installed} keys")
+        return installed
+
+    @staticmethod
+    async def bootstrap(nodes: list[dict]) -> bool:
+        """Installs a snapshot of our shard from one of `nodes`, then catches up with that node. Returns whether it did."""
+        start = time.monotonic()
+        Snapshot.state = "pulling"
+        Snapshot.installed = 0
+        Snapshot.elapsed = None
+        for attempt in range(SNAPSHOT_ATTEMPTS):
+            if attempt:
+                await asyncio.sleep(SNAPSHOT_BACKOFF * (2 ** (attempt - 1)))
+            for node in Health.rank(nodes):
+                address = node["address"]
+                Snapshot.source = address
+                Snapshot.state = "pulling"
+                try:
+                    Snapshot.installed = await Snapshot.install(address)
+                    Snapshot.state = "catching-up"
+                    await Gossip.exchange(address, ReqHelper.create_req_headers())
+                except Exception as e:
+                    logger.warning("Snapshot from %s failed: %r", address, e)
+                    continue
+                Snapshot.state = "done"
+                Snapshot.elapsed = round(time.monotonic() - start, 3)
+                logger.info("Installed a snapshot of %d keys from %s in %.3fs", Snapshot.installed, address, Snapshot.elapsed)
+                return True
+        Snapshot.state = "failed"
+        logger.warning("No replica of shard %s served a snapshot, leaving it to gossip", SharedData.current_shard)
+        return False
+
+    @staticmethod
+    def status() -> dict:
+        return {"state": Snapshot.state, "source": Snapshot.source, "keys": Snapshot.installed, "secs": Snapshot.elapsed}
@@ -0,0 +1,207 @@
+"""
+Causal stability: which writes every replica of a shard has delivered.
+
+A dependency on such a write is satisfied on every replica, so no read will ever wait on it
+and it can be dropped from causal metadata (`util.compact_dependencies`). That keeps the
+dependency maps in `SharedData.causal_data` and the clients' causal-metadata down to the
+writes still in flight, instead of every key ever touched.
+
+- Every write gets a sequence number from its node (`Stability.next_seq`), increasing across
+  all keys, which is the node's slot in the key's new clock. So a node's slot in any clock
+  names one of its writes.
+- A node knows up to which of its own writes everything has been delivered to a peer of its
+  shard: the writes since the last view change are in the peer's replication queue until the
+  peer acks them (packages/broadcast.py), the ones before were handed over by the view change.
+  The minimum over its peers is the node's stable seq.
+  An anti-entropy round that leaves the peer with all our versions (packages/gossip.py) also
+  counts as delivery of every write we made before it started.
+- Nodes report the frontier they know for their shard ({<node id>: <stable seq>}) to each
+  other on replication batches and gossip rounds, and to other shards on proxied requests
+  (`STABLE_HEADER`). A clock is stable once it is <= the frontier of its key's shard.
+- Dependency maps are compacted as they are written, and swept periodically
+  (`Stability.collecting`, run in app.py's lifespan) for entries that became stable since.
+
+Reports are tagged with a fingerprint of the view, and everything is reset on a view change.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from contextlib import asynccontextmanager
+from shared_data import SharedData
+from packages.vector_clock import VectorClock
+from log import get_logger
+
+# Header carrying a stability report on proxied requests and their responses.
+STABLE_HEADER = "Stable-Clock"
+
+# Secs between sweeps of SharedData.causal_data for dependencies that became stable.
+STABILITY_GC_INTERVAL = float(os.environ.get("STABILITY_GC_INTERVAL", 5))
+
+# Keys compacted between yields to the event loop during a sweep.
+GC_CHUNK = 1000
+
+logger = get_logger(__name__)
+
+class Stability:
+    # Last sequence number given to one of this node's writes
+    seq = 0
+
+    # Fingerprint of the view the frontiers belong to, and our seq when it was installed
+    view_id = None
+    view_base = 0
+
+    # {<peer address>: <seq>} our writes up to seq are known to have been handed over to the peer
+    # in full (by a view change or an anti-entropy round), rather than through its replication queue
+    synced = {}
+
+    # {<shard>: {<node id: str>: <seq>}} frontiers reported to us (our own slot is computed locally)
+    frontiers = {}
+
+    @staticmethod
+    def next_seq(current: int) -> int:
+        """Sequence number for a new write by this node, whose slot in the key's clock is `current`."""
+        Stability.seq = max(Stability.seq + 1, current + 1)
+        return Stability.seq
+
+    @staticmethod
+    def reset(view: dict):
+        """Forgets all frontiers (called on a view change, once the new view and placement are installed)."""
+        canonical = {shard: sorted(nodes, key=lambda node: int(node["id"])) for shard, nodes in view.items()}
+        # a new placement of keys (weights, hashing strategy) over the same nodes is a new view too
+        canonical = {"view": canonical, "placement": SharedData.hash_circle.config()}
+        Stability.view_id = hashlib.blake2b(json.dumps(canonical, sort_keys=True).encode("utf-8"), digest_size=8).hexdigest()
+        Stability.view_base = Stability.seq
+        Stability.synced = {}
+        Stability.frontiers = {}
+
+    @staticmethod
+    def mark_synced(address: str, seq: int = None):
+        """All our writes up to `seq` (default: the ones before the view change) were handed over to `address`."""
+        # broadcast imports util, which imports this module, so import it lazily here
+        from packages.broadcast import Replicator
+
+        seq = Stability.view_base if seq is None else seq
+        Stability.synced[address] = max(Stability.synced.get(address, 0), seq)
+        Replicator.discard_through(address, seq)
+
+    @staticmethod
+    def own_stable() -> int:
+        """Our writes up to this seq have been delivered to every other replica of our shard."""
+        # broadcast imports util, which imports this module, so import it lazily here
+        from packages.broadcast import Replicator
+
+        stable = Stability.seq
+        for node in SharedData.gossip_nodes:
+            if int(node["id"]) == SharedData.NODE_IDENTIFIER:
+                continue
+            address = node["address"]
+            floor = Replicator.delivered_floor(address)
+            synced = Stability.synced.get(address, 0)
+            if synced < Stability.view_base:
+                floor = min(floor, synced)
+            stable = min(stable, floor)
+        return stable
+
+    @staticmethod
+    def frontier(shard: str) -> VectorClock | None:
+        """The stable frontier of `shard` as far as we know (None if we know nothing about it)."""
+        known = Stability.frontiers.get(shard)
+        if shard != SharedData.current_shard or not SharedData.current_shard:
+            return None if known is None else VectorClock.from_dict(known)
+        frontier = dict(known or {})
+        frontier[str(SharedData.NODE_IDENTIFIER)] = Stability.own_stable()
+        return VectorClock.from_dict(frontier)
+
+    @staticmethod
+    def report() -> dict | None:
+        """Our shard's frontier, to piggyback on messages to other nodes."""
+        if not SharedData.current_shard or Stability.view_id is None:
+            return None
+        return {
+            "view": Stability.view_id,
+            "shard": SharedData.current_shard,
+            "clock": Stability.frontier(SharedData.current_shard).to_dict(),
+        }
+
+    @staticmethod
+    def learn(report: dict | None):
+        """Merges a frontier reported by another node (ignored if it is from another view)."""
+        if not report or report.get("view") != Stability.view_id or not report.get("shard"):
+            return
+        shard = report["shard"]
+        known = Stability.frontiers.setdefault(shard, {})
+        own_id = str(SharedData.NODE_IDENTIFIER)
+        for node_id, seq in report.get("clock", {}).items():
+            if shard == SharedData.current_shard and node_id == own_id:
+                continue
+            if seq > known.get(node_id, 0):
+                known[node_id] = seq
+
+    @staticmethod
+    def headers() -> dict:
+        """`STABLE_HEADER` with our report, for proxied requests and /data responses."""
+        report = Stability.report()
+        return {} if report is None else {STABLE_HEADER: json.dumps(report, separators=(",", ":"))}
+
+    @staticmethod
+    def learn_header(headers):
+        """Merges the report in `headers` (of a request or httpx response), if any."""
+        value = headers.get(STABLE_HEADER)
+        if value:
+            try:
+                Stability.learn(json.loads(value))
+            except ValueError:
+                pass
+
+    @staticmethod
+    def collect(frontiers: dict = None, keys=None) -> int:
+        """Drops the stable dependencies from the dependency maps of `keys` (default: all keys).
+
+        Returns the number of dependencies dropped.
+        """
+        # util imports this module, so import it lazily here
+        import util
+
+        frontiers = {} if frontiers is None else frontiers
+        dropped = 0
+        for key in list(SharedData.causal_data) if keys is None else keys:
+            dependencies = SharedData.causal_data.get(key)
+            if dependencies is None or len(dependencies) <= 1:
+                continue
+            compacted = util.compact_dependencies(dependencies, keep=key, frontiers=frontiers)
+            if len(compacted) < len(dependencies):
+                dropped += len(dependencies) - len(compacted)
+                # a write like any other: snapshots keep the old map, the engine logs the new one
+                util.key_changing(key)
+                SharedData.causal_data[key] = compacted
+                util.key_changed(key)
+        return dropped
+
+    @staticmethod
+    @asynccontextmanager
+    async def collecting():
+        """Runs the metadata sweep in the background for the lifetime of the app."""
+        task = asyncio.create_task(Stability._gc_loop())
+        try:
+            yield
+        finally:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    @staticmethod
+    async def _gc_loop():
+        while True:
+            await asyncio.sleep(STABILITY_GC_INTERVAL)
+            keys = list(SharedData.causal_data)
+            # the frontiers only grow, so one lookup per shard serves the whole sweep
+            frontiers = {}
+            dropped = 0
+            for start in range(0, len(keys), GC_CHUNK):
+                dropped += Stability.collect(frontiers, keys[start:start + GC_CHUNK])
+                await asyncio.sleep(0)
+            if dropped:
+                logger.debug("Dropped %d stable dependencies from %d keys", dropped, len(keys))
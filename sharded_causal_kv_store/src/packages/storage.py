@@ -0,0 +1,656 @@
+"""
+Durable storage of the node's data (SharedData.kvstore and SharedData.causal_data), so a
+restarted node recovers it from its disk instead of being refilled over the network.
+
+STORAGE_ENGINE picks the engine (see ENGINES):
+- `memory`: nothing is kept across restarts (a restarted node is refilled by gossip and view changes).
+- `wal`: every change of a key (util.key_changed) is appended to a write-ahead log in DATA_DIR,
+  the value together with the key's dependency map.
+- `bitcask`: for data larger than memory. The log is the data: SharedData.kvstore and
+  SharedData.causal_data become mappings over it (`Column`), which keep only where each key's
+  latest record is, and read values through mmap. See BitcaskEngine.
+
+Group commit: changes are appended to a buffer, and one flush writes everything buffered and
+fsyncs it (in a thread) while the next changes build up. Writes, replicated updates and
+transfer chunks are acknowledged only once durable (`Storage.durable()`), so a single fsync
+covers all the writes that arrived while the previous one ran.
+
+Snapshots: once the current log segment holds STORAGE_SNAPSHOT_BYTES (or every
+STORAGE_SNAPSHOT_INTERVAL secs if anything changed), the log moves on to a new segment and an
+image of the data is written beside it. Older segments and snapshots are then deleted. On
+startup the latest snapshot is loaded and the segments after it replayed in order; a torn
+record at the end of the log (a crash mid-write) ends the replay.
+
+The last view installed is saved along with the data, so a restarted node serves right away.
+"""
+import asyncio
+import json
+import mmap
+import os
+import re
+import struct
+import time
+import zlib
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager
+from shared_data import SharedData
+from packages.stability import Stability
+from log import get_logger
+import util
+
+# Storage engine (see ENGINES) and the directory it keeps its files in (one per node by
+# default, so nodes sharing a host don't mix their files).
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "memory")
+DATA_DIR = os.environ.get("DATA_DIR", os.path.join("data", os.environ.get("NODE_IDENTIFIER", "0")))
+
+# fsync every group commit (off: leave flushing the log to the OS, which loses the last writes on a power failure).
+WAL_FSYNC = os.environ.get("WAL_FSYNC", "true").lower() in ("1", "true", "yes")
+
+# Bytes of log, and secs (if anything changed), after which a snapshot is taken.
+STORAGE_SNAPSHOT_BYTES = int(os.environ.get("STORAGE_SNAPSHOT_BYTES", 64 * 1024 * 1024))
+STORAGE_SNAPSHOT_INTERVAL = float(os.environ.get("STORAGE_SNAPSHOT_INTERVAL", 300))
+
+# Bitcask: bytes after which the log moves on to a new segment, and the share of the closed
+# segments' bytes superseded by later records above which they are compacted.
+STORAGE_SEGMENT_BYTES = int(os.environ.get("STORAGE_SEGMENT_BYTES", 64 * 1024 * 1024))
+STORAGE_COMPACT_GARBAGE = float(os.environ.get("STORAGE_COMPACT_GARBAGE", 0.5))
+
+# Log record header: length and CRC32 of the payload that follows.
+RECORD = struct.Struct("<II")
+
+# Bitcask record payload: flags (VALUES or DEPENDENCIES, | TOMBSTONE) and key length, then the
+# key and the data (utf-8 value, or json dependency map).
+ENTRY = struct.Struct("<BI")
+VALUES = 0
+DEPENDENCIES = 1
+TOMBSTONE = 2
+
+logger = get_logger(__name__)
+
+class StorageEngine:
+    """What the node needs from a storage engine. This one keeps nothing (the `memory` engine)."""
+    name = "memory"
+    # Whether `open()` returns the engine's own mappings, to stand in for SharedData's dicts
+    holds_data = False
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.changes = 0
+
+    def open(self) -> tuple[dict, dict]:
+        """Recovers (kvstore, {<key>: <dependency map (json)>})."""
+        return {}, {}
+
+    def append(self, key: str, value: str | None, dependencies: dict | None):
+        """Logs the new state of `key` (`value` None: deleted). Durable once `commit()` returns."""
+
+    async def commit(self):
+        """Returns once everything appended so far is durable."""
+
+    def needs_snapshot(self) -> bool:
+        return False
+
+    async def snapshot(self, image):
+        """Writes the image of the data returned by `image()`, and drops the log it supersedes."""
+
+    def save_view(self, config: dict):
+        """Keeps the installed view (`config`: {"view", "weights", "strategy", "capacity", "epoch"})."""
+
+    def saved_view(self) -> dict | None:
+        return None
+
+    async def close(self):
+        pass
+
+    def stats(self) -> dict:
+        return {"engine": self.name}
+
+class WALEngine(StorageEngine):
+    """Append-only log segments (wal-<n>.log) and snapshots (snapshot-<n>.json, the data before segment n)."""
+    name = "wal"
+
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.segment = 0
+        self.segment_bytes = 0
+        self.file = None
+        self.buffer = bytearray()
+        # records appended, and records known to be on disk
+        self.appended = 0
+        self.synced = 0
+        self.flushing = None
+        # set if writing the log failed: nothing appended since can be made durable
+        self.error = None
+        # one writer to the files at a time (a flush, or the switch to a new segment)
+        self.io = asyncio.Lock()
+
+    def _path(self, kind: str, number: int) -> str:
+        return os.path.join(self.directory, f"wal-{number:08d}.log" if kind == "wal" else f"snapshot-{number:08d}.json")
+
+    def _numbers(self, kind: str) -> list[int]:
+        pattern = re.compile(r"wal-(\d+)\.log$" if kind == "wal" else r"snapshot-(\d+)\.json$")
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+
+    def open(self) -> tuple[dict, dict]:
+        os.makedirs(self.directory, exist_ok=True)
+        kvstore, dependencies = {}, {}
+        start = 0
+        snapshots = self._numbers("snapshot")
+        if snapshots:
+            start = snapshots[-1]
+            with open(self._path("snapshot", start), "rb") as file:
+                image = json.load(file)
+            kvstore, dependencies = image["kvstore"], image["causal-metadata"]
+        replayed = 0
+        segments = [number for number in self._numbers("wal") if number >= start]
+        for number in segments:
+            replayed += self._replay(self._path("wal", number), kvstore, dependencies)
+        logger.info("Recovered %d keys from %s (snapshot %s, %d log records)", len(kvstore), self.directory, start if snapshots else None, replayed)
+
+        # a new segment for this run, after anything a torn record may have cut short
+        self.segment = max(segments[-1] + 1 if segments else 0, start)
+        self.file = open(self._path("wal", self.segment), "ab")
+        return kvstore, dependencies
+
+    @staticmethod
+    def _replay(path: str, kvstore: dict, dependencies: dict) -> int:
+        with open(path, "rb") as file:
+            data = file.read()
+        offset = count = 0
+        while offset + RECORD.size <= len(data):
+            length, crc = RECORD.unpack_from(data, offset)
+            payload = data[offset + RECORD.size:offset + RECORD.size + length]
+            if not length or len(payload) < length or zlib.crc32(payload) != crc:
+                logger.warning("Torn record at %s:%d, ignoring the rest of the segment", path, offset)
+                break
+            record = json.loads(payload)
+            if len(record) == 1:
+                kvstore.pop(record[0], None)
+                dependencies.pop(record[0], None)
+            else:
+                kvstore[record[0]], dependencies[record[0]] = record[1], record[2]
+            offset += RECORD.size + length
+            count += 1
+        return count
+
+    def append(self, key: str, value: str | None, dependencies: dict | None):
+        payload = json.dumps([key] if value is None else [key, value, dependencies], separators=(",", ":")).encode("utf-8")
+        self.buffer += RECORD.pack(len(payload), zlib.crc32(payload))
+        self.buffer += payload
+        self.appended += 1
+        self.changes += 1
+        # the flush picks up everything appended until it runs
+        if self.flushing is None:
+            self.flushing = asyncio.create_task(self._flush())
+
+    async def commit(self):
+        target = self.appended
+        while self.synced < target and self.error is None:
+            # (a snapshot may have taken the buffer, and be writing it)
+            if self.flushing is None:
+                self.flushing = asyncio.create_task(self._flush())
+            await asyncio.shield(self.flushing)
+        if self.error is not None:
+            raise RuntimeError(f"Writing the log failed: {self.error!r}")
+
+    async def _flush(self):
+        try:
+            while True:
+                async with self.io:
+                    await self._write_buffer()
+                if not self.buffer:
+                    break
+        except Exception as e:
+            logger.error("Writing the log failed: %r", e)
+            self.error = e
+        finally:
+            self.flushing = None
+
+    async def _write_buffer(self):
+        """Writes the buffer to the current segment (holding `io`)."""
+        data, self.buffer = self.buffer, bytearray()
+        target = self.appended
+        if data:
+            await asyncio.to_thread(self._write, self.file, data)
+            self.segment_bytes += len(data)
+        self.synced = max(self.synced, target)
+
+    @staticmethod
+    def _write(file, data: bytes):
+        file.write(data)
+        file.flush()
+        if WAL_FSYNC:
+            os.fsync(file.fileno())
+
+    def needs_snapshot(self) -> bool:
+        return self.segment_bytes >= STORAGE_SNAPSHOT_BYTES
+
+    async def snapshot(self, image):
+        async with self.io:
+            await self._write_buffer()
+            # later changes go to the new segment; the image taken right after the switch has
+            # everything before it (replaying changes it already has is harmless)
+            old = self.file
+            self.segment += 1
+            self.segment_bytes = 0
+            self.file = open(self._path("wal", self.segment), "ab")
+            self.changes = 0
+            kvstore, dependencies = image()
+        old.close()
+        await asyncio.to_thread(self._write_snapshot, self.segment, kvstore, dependencies)
+        logger.info("Snapshot of %d keys before log segment %d", len(kvstore), self.segment)
+
+    def _write_snapshot(self, number: int, kvstore: dict, dependencies: dict):
+        path = self._path("snapshot", number)
+        with open(path + ".tmp", "w") as file:
+            json.dump({"kvstore": kvstore, "causal-metadata": dependencies}, file, separators=(",", ":"))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        self._sync_directory()
+        for old in self._numbers("wal"):
+            if old < number:
+                os.remove(self._path("wal", old))
+        for old in self._numbers("snapshot"):
+            if old < number:
+                os.remove(self._path("snapshot", old))
+
+    def _sync_directory(self):
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def save_view(self, config: dict):
+        path = os.path.join(self.directory, "view.json")
+        with open(path + ".tmp", "w") as file:
+            json.dump(config, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        self._sync_directory()
+
+    def saved_view(self) -> dict | None:
+        try:
+            with open(os.path.join(self.directory, "view.json")) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    async def close(self):
+        async with self.io:
+            await self._write_buffer()
+            self.file.close()
+
+    def stats(self) -> dict:
+        return {"engine": self.name, "segment": self.segment, "segment-bytes": self.segment_bytes, "buffered": len(self.buffer), "appended": self.appended, "synced": self.synced}
+
+class Segment:
+    """A bitcask segment file, read through a read-only mmap (remapped as the file grows)."""
+
+    def __init__(self, path: str, number: int, size: int = 0):
+        self.path = path
+        self.number = number
+        self.size = size
+        # bytes of records superseded by later ones (and tombstones), which a compaction drops
+        self.dead = 0
+        self.map = None
+
+    def read(self, offset: int, length: int) -> memoryview:
+        """The bytes at `offset`, without copying them out of the map."""
+        if self.map is None or offset + length > len(self.map):
+            self.remap()
+        return memoryview(self.map)[offset:offset + length]
+
+    def remap(self):
+        # views of the old map are only ever used right away, so none is left to block close()
+        self.close()
+        with open(self.path, "rb") as file:
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+def record_size(key: str, length: int) -> int:
+    """Size of the bitcask record holding `length` bytes of data for `key`."""
+    return RECORD.size + ENTRY.size + len(key.encode("utf-8")) + length
+
+class Column(MutableMapping):
+    """SharedData.kvstore or SharedData.causal_data under the bitcask engine.
+
+    Only the index is in memory: {<key>: (<segment>, <offset>, <length>)} of the data in its
+    latest record, or [<log position>, <object>] until the record is written. Setting or
+    deleting a key appends a record.
+    """
+
+    def __init__(self, engine: "BitcaskEngine", kind: int, encode, decode):
+        self.engine = engine
+        self.kind = kind
+        self.encode = encode
+        self.decode = decode
+        self.index = {}
+
+    def __getitem__(self, key):
+        location = self.index[key]
+        if type(location) is list:
+            return location[1]
+        segment, offset, length = location
+        return self.decode(segment.read(offset, length))
+
+    def __setitem__(self, key, value):
+        self.place(key, [self.engine.log(self, key, self.encode(value)), value])
+
+    def __delitem__(self, key):
+        if key not in self.index:
+            raise KeyError(key)
+        self.engine.log(self, key, None)
+        self.place(key, None)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def place(self, key: str, location):
+        """Points `key` at `location` (None: drops it), counting the record it replaces as dead."""
+        old = self.index.pop(key, None)
+        if type(old) is tuple:
+            old[0].dead += record_size(key, old[2])
+        if location is not None:
+            self.index[key] = location
+
+class BitcaskEngine(WALEngine):
+    """Append-only segments (data-<n>.log) holding every version of every key, of which only the
+    index of the latest ones is kept in memory (see Column). Values and dependency maps are
+    separate records, so each mapping logs its own changes.
+
+    Group commit is the write-ahead log's. The active segment moves on to a new one past
+    STORAGE_SEGMENT_BYTES. Once STORAGE_COMPACT_GARBAGE of the closed segments' bytes are dead,
+    their live records are copied (in a thread) to compact-<n>.log, which supersedes every
+    segment up to n, and the old files are deleted. On startup the index is rebuilt by scanning
+    the segments' headers; no value is loaded.
+    """
+    name = "bitcask"
+    holds_data = True
+
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.values = Column(self, VALUES, lambda value: value.encode("utf-8"), lambda data: str(data, "utf-8"))
+        self.dependencies = Column(
+            self, DEPENDENCIES,
+            lambda dependencies: json.dumps(util.causal_data_to_dict(dependencies), separators=(",", ":")).encode("utf-8"),
+            lambda data: util.dict_to_causal_data(json.loads(str(data, "utf-8"))),
+        )
+        # oldest first, records are appended to the last one
+        self.segments = []
+        # records in the buffer: (column, key, log position, offset of the data in the buffer, its length)
+        self.unwritten = []
+        self.compactions = 0
+
+    def _path(self, kind: str, number: int) -> str:
+        return os.path.join(self.directory, f"{kind}-{number:08d}.log")
+
+    def _numbers(self, kind: str) -> list[int]:
+        pattern = re.compile(kind + r"-(\d+)\.log$")
+        return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(self.directory)) if match)
+
+    def open(self) -> tuple[Column, Column]:
+        os.makedirs(self.directory, exist_ok=True)
+        compacted = self._numbers("compact")
+        start = compacted[-1] if compacted else -1
+        files = [("compact", start)] if compacted else []
+        files += [("data", number) for number in self._numbers("data") if number > start]
+        records = 0
+        for kind, number in files:
+            path = self._path(kind, number)
+            segment = Segment(path, number, os.path.getsize(path))
+            self.segments.append(segment)
+            records += self._scan(segment)
+        # a compaction may have stopped before deleting the files it superseded
+        self._remove_superseded(start)
+
+        # half of a write (its value or its dependency map) lost in a torn record
+        for column, other in ((self.values, self.dependencies), (self.dependencies, self.values)):
+            for key in [key for key in column.index if key not in other.index]:
+                column.place(key, None)
+        logger.info("Indexed %d keys in %d segments of %s (%d records)", len(self.values), len(self.segments), self.directory, records)
+
+        # a new segment for this run, after anything a torn record may have cut short
+        number = max(start, files[-1][1] if files else -1) + 1
+        self.segments.append(Segment(self._path("data", number), number))
+        self.file = open(self.segments[-1].path, "ab")
+        return self.values, self.dependencies
+
+    def _scan(self, segment: Segment) -> int:
+        """Indexes the records of `segment` (oldest segment first)."""
+        if not segment.size:
+            return 0
+        data = segment.read(0, segment.size)
+        offset = count = 0
+        try:
+            while offset + RECORD.size <= len(data):
+                length, crc = RECORD.unpack_from(data, offset)
+                start = offset + RECORD.size
+                if not length or start + length > len(data) or zlib.crc32(data[start:start + length]) != crc:
+                    logger.warning("Torn record at %s:%d, ignoring the rest of the segment", segment.path, offset)
+                    segment.dead += len(data) - offset
+                    break
+                flags, key_length = ENTRY.unpack_from(data, start)
+                key = str(data[start + ENTRY.size:start + ENTRY.size + key_length], "utf-8")
+                column = self.dependencies if flags & DEPENDENCIES else self.values
+                if flags & TOMBSTONE:
+                    column.place(key, None)
+                    segment.dead += RECORD.size + length
+                else:
+                    data_offset = start + ENTRY.size + key_length
+                    column.place(key, (segment, data_offset, start + length - data_offset))
+                offset = start + length
+                count += 1
+        finally:
+            data.release()
+        return count
+
+    def log(self, column: Column, key: str, data: bytes | None) -> int:
+        """Appends a record of `key` (`data` None: a tombstone). Returns its log position."""
+        key_bytes = key.encode("utf-8")
+        payload = ENTRY.pack(column.kind | (TOMBSTONE if data is None else 0), len(key_bytes)) + key_bytes + (data or b"")
+        self.buffer += RECORD.pack(len(payload), zlib.crc32(payload))
+        self.unwritten.append((column, key, self.appended + 1, len(self.buffer) + ENTRY.size + len(key_bytes), len(data or b"")))
+        self.buffer += payload
+        self.appended += 1
+        if self.flushing is None:
+            self.flushing = asyncio.create_task(self._flush())
+        return self.appended
+
+    async def _write_buffer(self):
+        """Writes the buffer to the active segment (holding `io`), and points the index at the records written."""
+        data, self.buffer = self.buffer, bytearray()
+        written, self.unwritten = self.unwritten, []
+        target = self.appended
+        if data:
+            segment = self.segments[-1]
+            await asyncio.to_thread(self._write, self.file, data)
+            base = segment.size
+            segment.size += len(data)
+            for column, key, position, offset, length in written:
+                location = column.index.get(key)
+                if type(location) is list and location[0] == position:
+                    column.index[key] = (segment, base + offset, length)
+                else:
+                    # a tombstone, or a version already replaced
+                    segment.dead += record_size(key, length)
+            if segment.size >= STORAGE_SEGMENT_BYTES:
+                self.file.close()
+                number = segment.number + 1
+                self.segments.append(Segment(self._path("data", number), number))
+                self.file = open(self.segments[-1].path, "ab")
+        self.synced = max(self.synced, target)
+
+    def needs_snapshot(self) -> bool:
+        closed = self.segments[:-1]
+        size = sum(segment.size for segment in closed)
+        return size > 0 and sum(segment.dead for segment in closed) >= STORAGE_COMPACT_GARBAGE * size
+
+    async def snapshot(self, image):
+        """Compacts the closed segments (the segments are the data, so `image` isn't needed)."""
+        closed = self.segments[:-1]
+        if not closed:
+            return
+        for segment in closed:
+            if segment.size and (segment.map is None or len(segment.map) < segment.size):
+                segment.remap()
+        members = set(closed)
+        live = [(column, key, location) for column in (self.values, self.dependencies)
+                for key, location in column.index.items() if type(location) is tuple and location[0] in members]
+        number = closed[-1].number
+        offsets, size = await asyncio.to_thread(self._write_compacted, self._path("compact", number), live)
+
+        # keys written meanwhile point at the active segment already
+        compacted = Segment(self._path("compact", number), number, size)
+        for (column, key, location), offset in zip(live, offsets):
+            if column.index.get(key) == location:
+                column.index[key] = (compacted, offset, location[2])
+            else:
+                compacted.dead += record_size(key, location[2])
+        self.segments[:len(closed)] = [compacted]
+        for segment in closed:
+            segment.close()
+        await asyncio.to_thread(self._remove_superseded, number)
+        self.compactions += 1
+        logger.info("Compacted %d segments into %d bytes (%d records)", len(closed), size, len(live))
+
+    def _write_compacted(self, path: str, live: list) -> tuple[list[int], int]:
+        """Copies the records of `live` to a new segment at `path`. Returns the new offsets of their data, and its size."""
+        offsets = []
+        position = 0
+        with open(path + ".tmp", "wb") as file:
+            for column, key, (segment, offset, length) in live:
+                start = offset - len(key.encode("utf-8")) - ENTRY.size - RECORD.size
+                with memoryview(segment.map) as view:
+                    file.write(view[start:offset + length])
+                offsets.append(position + offset - start)
+                position += offset + length - start
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path + ".tmp", path)
+        self._sync_directory()
+        return offsets, position
+
+    def _remove_superseded(self, number: int):
+        """Deletes the segments a compacted segment `number` supersedes."""
+        for old in self._numbers("data"):
+            if old <= number:
+                os.remove(self._path("data", old))
+        for old in self._numbers("compact"):
+            if old < number:
+                os.remove(self._path("compact", old))
+
+    async def close(self):
+        await super().close()
+        for segment in self.segments:
+            segment.close()
+
+    def stats(self) -> dict:
+        return {
+            "engine": self.name,
+            "keys": len(self.values),
+            "segments": len(self.segments),
+            "bytes": sum(segment.size for segment in self.segments),
+            "dead-bytes": sum(segment.dead for segment in self.segments),
+            "compactions": self.compactions,
+            "buffered": len(self.buffer),
+            "appended": self.appended,
+            "synced": self.synced,
+        }
+
+ENGINES = {
+    "memory": StorageEngine,
+    "wal": WALEngine,
+    "bitcask": BitcaskEngine,
+}
+
+class Storage:
+    engine: StorageEngine = StorageEngine(DATA_DIR)
+
+    @staticmethod
+    def recover():
+        """Opens the engine and loads what it recovered into SharedData (indexed in the Merkle tree
+        once the view is restored, see routers/view.py)."""
+        if STORAGE_ENGINE not in ENGINES:
+            raise ValueError(f"Unknown STORAGE_ENGINE {STORAGE_ENGINE!r}, expected one of {sorted(ENGINES)}")
+        Storage.engine = ENGINES[STORAGE_ENGINE](DATA_DIR)
+        kvstore, dependencies = Storage.engine.open()
+        if Storage.engine.holds_data:
+            SharedData.kvstore, SharedData.causal_data = kvstore, dependencies
+        for key in kvstore:
+            if not Storage.engine.holds_data:
+                SharedData.kvstore[key] = kvstore[key]
+                SharedData.causal_data[key] = util.dict_to_causal_data(dependencies[key])
+            # our next writes must be numbered after the ones we made before the restart
+            own = SharedData.causal_data[key][key].to_dict().get(str(SharedData.NODE_IDENTIFIER), 0)
+            Stability.seq = max(Stability.seq, own)
+
+    @staticmethod
+    def record(key: str):
+        """Logs the current state of `key` (called by util.key_changed)."""
+        if Storage.engine.holds_data:
+            # the engine's mappings logged the change as it was made
+            return
+        if key in SharedData.kvstore and key in SharedData.causal_data:
+            Storage.engine.append(key, SharedData.kvstore[key], util.causal_data_to_dict(SharedData.causal_data[key]))
+        else:
+            Storage.engine.append(key, None, None)
+
+    @staticmethod
+    async def durable():
+        """Returns once every change recorded so far is durable."""
+        await Storage.engine.commit()
+
+    @staticmethod
+    def save_view(view: dict, epoch: int):
+        config = SharedData.hash_circle.config()
+        Storage.engine.save_view({"view": view, "weights": config["weights"], "strategy": config["strategy"], "capacity": config["capacity"], "epoch": epoch})
+
+    @staticmethod
+    def saved_view() -> dict | None:
+        return Storage.engine.saved_view()
+
+    @staticmethod
+    def _image() -> tuple[dict, dict]:
+        return dict(SharedData.kvstore), {key: util.causal_data_to_dict(SharedData.causal_data[key]) for key in SharedData.kvstore if key in SharedData.causal_data}
+
+    @staticmethod
+    @asynccontextmanager
+    async def persisting():
+        """Recovers the data, then takes snapshots in the background for the lifetime of the app."""
+        Storage.recover()
+        task = asyncio.create_task(Storage._snapshot_loop())
+        try:
+            yield
+        finally:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+            await Storage.engine.close()
+
+    @staticmethod
+    async def _snapshot_loop():
+        last = time.monotonic()
+        while True:
+            await asyncio.sleep(1)
+            engine = Storage.engine
+            if engine.needs_snapshot() or (engine.changes and time.monotonic() - last >= STORAGE_SNAPSHOT_INTERVAL):
+                try:
+                    await engine.snapshot(Storage._image)
+                except Exception as e:
+                    logger.error("Snapshot failed: %r", e)
+                last = time.monotonic()
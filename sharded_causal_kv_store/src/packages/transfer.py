@@ -0,0 +1,147 @@
+"""
+Chunked, resumable transfer of keys to another node (used by view changes, see routers/view.py).
+
+A transfer is a list of keys sent in chunks of TRANSFER_CHUNK_SIZE keys to the receiver's
+`PUT /copy/stream`, one chunk in flight at a time (the ack of a chunk is what lets the
+next one go). Each chunk is NDJSON: a header line, then one line per key:
+
+    {"transfer": "<id>", "chunk": <n>, "type": "view_change"}
+    {"key": "<key>", "value": "<value>", "causal-metadata": {<dep key>: {<node id>: <int>}, ...}}
+    ...
+
+- The sender only ever builds one chunk (from the live kvs), so a transfer never needs memory
+  proportional to the shard, and no single request has to fit the whole shard in a timeout.
+- The receiver merges entries as they arrive, and records the last chunk it fully merged
+  (the resume cursor, `GET /copy/stream/<id>`).
+- A chunk that fails is retried with backoff, from the receiver's cursor. Merging is
+  idempotent (pairwise max of clocks), so sending a chunk twice is harmless.
+"""
+import asyncio
+import json
+import os
+from shared_data import SharedData
+from helper import AsyncHelper, ReqHelper
+from packages.wire import Wire
+import util
+from log import get_logger
+
+# Keys per chunk, and secs before a chunk request times out.
+TRANSFER_CHUNK_SIZE = int(os.environ.get("TRANSFER_CHUNK_SIZE", 500))
+TRANSFER_TIMEOUT = float(os.environ.get("TRANSFER_TIMEOUT", 5))
+
+# Attempts per chunk before the transfer is given up, and the backoff (in secs) between them.
+TRANSFER_ATTEMPTS = int(os.environ.get("TRANSFER_ATTEMPTS", 5))
+TRANSFER_BACKOFF = 0.2
+
+logger = get_logger(__name__)
+
+class Transfer:
+    # Receiving side: {<transfer id>: <last chunk fully merged>}
+    received = {}
+
+    @staticmethod
+    def encode_chunk(transfer_id: str, chunk: int, keys: list[str], kind: str) -> bytes:
+        """NDJSON body of one chunk, read from the kvs as it is now (keys we no longer hold are skipped)."""
+        lines = [json.dumps({"transfer": transfer_id, "chunk": chunk, "type": kind})]
+        for key in keys:
+            if key in SharedData.kvstore and key in SharedData.causal_data:
+                lines.append(json.dumps({
+                    "key": key,
+                    "value": SharedData.kvstore[key],
+                    "causal-metadata": util.causal_data_to_dict(SharedData.causal_data[key]),
+                }))
+        lines.append("")
+        return "\n".join(lines).encode("utf-8")
+
+    @staticmethod
+    async def cursor(address: str, transfer_id: str) -> int:
+        """Last chunk of the transfer the receiver has merged (-1 if none, or if it can't tell)."""
+        try:
+            res = await AsyncHelper.async_get(f"http://{address}/copy/stream/{transfer_id}", timeout=TRANSFER_TIMEOUT, retries=0)
+            if res.status_code == 200:
+                return Wire.body(res).get("chunk", -1)
+        except Exception:
+            pass
+        return -1
+
+    @staticmethod
+    async def send(address: str, transfer_id: str, keys: list[str], kind: str = "view_change", progress=None) -> bool:
+        """Sends `keys` to the node at `address` in chunks. Returns True once every chunk was acked.
+
+        `progress`, if given, is called with the number of keys of every chunk acked.
+        """
+        chunks = [keys[start:start + TRANSFER_CHUNK_SIZE] for start in range(0, len(keys), TRANSFER_CHUNK_SIZE)]
+        headers = dict(ReqHelper.create_req_headers(), **{"Content-Type": "application/x-ndjson"})
+        chunk = 0
+        attempts = 0
+        while chunk < len(chunks):
+            content = Transfer.encode_chunk(transfer_id, chunk, chunks[chunk], kind)
+            try:
+                res = await AsyncHelper.request("PUT", f"http://{address}/copy/stream", headers=headers, timeout=TRANSFER_TIMEOUT, retries=0, content=content)
+                if res.status_code == 200:
+                    if progress is not None:
+                        progress(len(chunks[chunk]))
+                    chunk += 1
+                    attempts = 0
+                    continue
+                logger.warning("Transfer %s to %s: chunk %d rejected with %s", transfer_id, address, chunk, res.status_code)
+            except Exception as e:
+                logger.warning("Transfer %s to %s: chunk %d failed: %r", transfer_id, address, chunk, e)
+            attempts += 1
+            if attempts >= TRANSFER_ATTEMPTS:
+                logger.warning("Giving up transfer %s to %s at chunk %d of %d", transfer_id, address, chunk, len(chunks))
+                return False
+            await asyncio.sleep(TRANSFER_BACKOFF * (2 ** (attempts - 1)))
+            # resume after the last chunk the receiver has merged
+            chunk = max(chunk, await Transfer.cursor(address, transfer_id) + 1)
+        logger.debug("Transfer %s to %s: sent %d keys in %d chunks", transfer_id, address, len(keys), len(chunks))
+        return True
+
+    @staticmethod
+    def merge_lines(lines: list[bytes], view_change: bool) -> int:
+        """Merges NDJSON entry lines into our kvs. Returns the number of entries merged."""
+        kvstore = {}
+        metadata = {}
+        for line in lines:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            kvstore[entry["key"]] = entry["value"]
+            metadata[entry["key"]] = entry["causal-metadata"]
+        if kvstore:
+            util.merge_data(kvstore, metadata, view_change=view_change)
+        return len(kvstore)
+
+    @staticmethod
+    async def receive(stream) -> dict:
+        """Merges an incoming chunk from `stream` (an async iterator of bytes) as it arrives.
+
+        Returns the chunk's header. Raises ValueError if the body is malformed.
+        """
+        buffer = b""
+        header = None
+        merged = 0
+        async for data in stream:
+            buffer += data
+            lines = buffer.split(b"\n")
+            buffer = lines.pop()
+            if header is None and lines:
+                header = json.loads(lines.pop(0))
+            merged += Transfer.merge_lines(lines, header.get("type") == "view_change") if header else 0
+        if header is None:
+            if not buffer.strip():
+                raise ValueError("Empty transfer chunk")
+            header = json.loads(buffer)
+            buffer = b""
+        merged += Transfer.merge_lines([buffer], header.get("type") == "view_change")
+
+        transfer_id, chunk = header.get("transfer"), header.get("chunk")
+        if transfer_id is not None and chunk is not None:
+            # forget transfers of earlier view changes
+            if transfer_id not in Transfer.received:
+                view_id = transfer_id.split(":", 1)[0]
+                for old_id in [old_id for old_id in Transfer.received if not old_id.startswith(view_id + ":")]:
+                    del Transfer.received[old_id]
+            Transfer.received[transfer_id] = max(Transfer.received.get(transfer_id, -1), chunk)
+        header["merged"] = merged
+        return header
@@ -0,0 +1,61 @@
+"""
+Per-key registry of waiters, used by reads that are causally blocked on a key.
+
+Every path that changes a key calls `KeyWaiters.notify(key)` (through util.key_changed),
+which wakes the requests waiting on that key so they can re-check their condition
+right away instead of polling.
+"""
+import asyncio
+
+# Waiters also re-check their condition this often (in secs), in case the condition
+# changed without the key being written (e.g. a view change moved the key to another shard).
+RECHECK_INTERVAL = 1.5
+
+class KeyWaiters:
+    # {<kvs key>: asyncio.Event} - the event is set (and dropped) the next time the key changes.
+    events = {}
+
+    # {<kvs key>: <number of requests waiting on it>} - the key's event is dropped when the last
+    # one leaves, so keys whose waiters timed out (and aren't written again) don't pile up.
+    waiting = {}
+
+    @staticmethod
+    def notify(key: str):
+        """Wakes everything waiting on `key`."""
+        event = KeyWaiters.events.pop(key, None)
+        if event is not None:
+            event.set()
+
+    @staticmethod
+    async def wait_for(key: str, predicate, timeout: float = None) -> bool:
+        """Waits until `predicate()` is true, re-checking it every time `key` changes.
+
+        Returns True once the predicate holds, or False if `timeout` (in secs) passed first.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        KeyWaiters.waiting[key] = KeyWaiters.waiting.get(key, 0) + 1
+        try:
+            while not predicate():
+                wait = RECHECK_INTERVAL
+                if deadline is not None:
+                    remaining = deadline - loop.time()
+                    if remaining <= 0:
+                        return False
+                    wait = min(wait, remaining)
+
+                event = KeyWaiters.events.get(key)
+                if event is None:
+                    event = KeyWaiters.events[key] = asyncio.Event()
+                try:
+                    await asyncio.wait_for(event.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+            return True
+        finally:
+            # also on cancellation (the client went away)
+            left = KeyWaiters.waiting.pop(key) - 1
+            if left:
+                KeyWaiters.waiting[key] = left
+            else:
+                KeyWaiters.events.pop(key, None)
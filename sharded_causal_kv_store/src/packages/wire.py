@@ -0,0 +1,409 @@
+"""
+Binary encoding of inter-node messages, negotiated per peer, with JSON as the fallback.
+
+Format (`MEDIA_TYPE`): a flags byte, then the payload, compressed if the flags say so (bodies of
+WIRE_COMPRESS_MIN bytes or more, with WIRE_COMPRESSION):
+
+    payload := <node table> <value>
+    node table := <u16 count> <count x i64 node id>
+    value := N | T | F                                  None, true, false
+           | i <i64> | I <str>                          int (I: too big for 64 bits, in decimal)
+           | d <f64> | s <str>                          float, string (<str> := <u32 length> <utf-8>)
+           | l <u32 count> <value>...                   list
+           | m <u32 count> (<str> <value>)...           map
+           | c <u16 n> <array>                          clock of the first n nodes of the table
+           | C <u16 n> <n x u16 table index> <array>    clock of other nodes
+    array := <typecode> <n x item>                      array.array of the smallest fitting type
+
+A clock is any map of node ids ("<int>", as VectorClock.to_dict writes them) to ints. Its node ids
+go in the node table once per message, and the clock is only its values, in table order. The table
+takes the nodes in the order they are first met, and every clock on a node lists its nodes in the
+same (slot) order (packages/vector_clock.py), so nearly all clocks are written the first way.
+
+Negotiation: requests (see `AsyncHelper.request`) accept `MEDIA_TYPE`, and internal endpoints
+answer with it if so (`Wire.response`). A peer that did is sent binary bodies from then on;
+everyone else JSON. Either way, bodies are read by their Content-Type (`Wire.read`, `Wire.body`).
+"""
+import json
+import os
+import struct
+import sys
+import zlib
+from array import array
+from fastapi.responses import Response
+from log import get_logger
+from packages.render import FastJSONResponse
+
+# "binary" to send (and offer) the binary encoding to peers that support it, "json" to stick to JSON.
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "binary").lower()
+
+# Compression of binary bodies of at least WIRE_COMPRESS_MIN bytes: "zlib", "zstd" (needs the
+# `zstandard` package) or "none".
+WIRE_COMPRESSION = os.environ.get("WIRE_COMPRESSION", "zlib").lower()
+WIRE_COMPRESS_MIN = int(os.environ.get("WIRE_COMPRESS_MIN", 4096))
+
+# Compression level (zlib 1 fastest ... 9 smallest; zstd 1 ... 22).
+WIRE_COMPRESS_LEVEL = 1
+
+MEDIA_TYPE = "application/x-kvs-wire"
+ACCEPT = f"{MEDIA_TYPE}, application/json"
+
+# Flags byte: compression of the payload
+RAW, ZLIB, ZSTD = 0, 1, 2
+
+I64 = struct.Struct("<q")
+F64 = struct.Struct("<d")
+U32 = struct.Struct("<I")
+U16 = struct.Struct("<H")
+
+# Array item types, smallest first: (typecode, largest value)
+UNSIGNED = [("B", 0xFF), ("H", 0xFFFF), ("I", 0xFFFFFFFF)]
+MAX_I64 = (1 << 63) - 1
+MIN_I64 = -(1 << 63)
+INT_ONLY = {int}
+ARRAY_TYPES = ("B", "H", "I", "q")
+BIG_ENDIAN = sys.byteorder == "big"
+
+logger = get_logger(__name__)
+
+def _zstd():
+    """The zstandard module, or None if it isn't installed."""
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+def _node_id(key) -> int | None:
+    """The node id `key` stands for, if it is one as VectorClock.to_dict writes them ("<int>")."""
+    if type(key) is not str or not key.isascii() or not key.isdigit() or (key[0] == "0" and key != "0"):
+        return None
+    return int(key)
+
+class Encoder:
+    def __init__(self):
+        self.out = bytearray()
+        self.table = []
+        self.slot_of = {}
+        # {<keys of a clock>: its header}, see `clock_header`
+        self.headers = {}
+
+    def encode(self, obj) -> bytes:
+        self.value(obj)
+        table = array("q", self.table)
+        if BIG_ENDIAN:
+            table.byteswap()
+        return U16.pack(len(self.table)) + table.tobytes() + self.out
+
+    def string(self, s: str):
+        data = s.encode("utf-8")
+        self.out += U32.pack(len(data))
+        self.out += data
+
+    def clock(self, obj: dict) -> bool:
+        """Writes `obj` as a clock if it is one."""
+        values = list(obj.values())
+        if {*map(type, values)} != INT_ONLY:
+            return False
+        high = max(values)
+        typecode = "q"
+        for code, largest in UNSIGNED:
+            if high <= largest:
+                typecode = code
+                break
+        try:
+            items = array(typecode, values)
+        except OverflowError:
+            # negative, or too big for 64 bits
+            try:
+                typecode, items = "q", array("q", values)
+            except OverflowError:
+                return False
+        keys = tuple(obj)
+        header = self.headers.get(keys)
+        if header is None:
+            header = self.headers[keys] = self.clock_header(keys)
+        if not header:
+            return False
+        if BIG_ENDIAN:
+            items.byteswap()
+        out = self.out
+        out += header
+        out += typecode.encode()
+        out += items.tobytes()
+        return True
+
+    def clock_header(self, keys: tuple) -> bytes:
+        """The bytes before the values of a clock of the nodes `keys`, or b"" if they aren't node ids."""
+        nodes = [_node_id(key) for key in keys]
+        if None in nodes or len(nodes) > 0xFFFF or max(nodes) > MAX_I64:
+            return b""
+        slots = []
+        for node in nodes:
+            slot = self.slot_of.get(node)
+            if slot is None:
+                if len(self.table) == 0xFFFF:
+                    return b""
+                slot = self.slot_of[node] = len(self.table)
+                self.table.append(node)
+            slots.append(slot)
+        if slots == list(range(len(slots))):
+            return b"c" + U16.pack(len(slots))
+        return b"C" + U16.pack(len(slots)) + b"".join(map(U16.pack, slots))
+
+    def value(self, obj):
+        out = self.out
+        kind = type(obj)
+        if kind is str:
+            out += b"s"
+            self.string(obj)
+        elif kind is dict:
+            if obj and self.clock(obj):
+                return
+            out += b"m"
+            out += U32.pack(len(obj))
+            for key, value in obj.items():
+                if type(key) is not str:
+                    # as JSON would
+                    key = json.dumps(key) if key is None or isinstance(key, bool) else str(key)
+                self.string(key)
+                self.value(value)
+        elif obj is None:
+            out += b"N"
+        elif obj is True:
+            out += b"T"
+        elif obj is False:
+            out += b"F"
+        elif kind is int:
+            if MIN_I64 <= obj <= MAX_I64:
+                out += b"i"
+                out += I64.pack(obj)
+            else:
+                out += b"I"
+                self.string(str(obj))
+        elif kind is float:
+            out += b"d"
+            out += F64.pack(obj)
+        elif kind is list or kind is tuple:
+            out += b"l"
+            out += U32.pack(len(obj))
+            for item in obj:
+                self.value(item)
+        elif isinstance(obj, (str, int, float, dict, list, tuple)):
+            # subclasses (e.g. enums, OrderedDict): as their base type
+            base = next(base for base in (bool, str, int, float, dict, list, tuple) if isinstance(obj, base))
+            self.value(base(obj))
+        else:
+            raise TypeError(f"Object of type {kind.__name__} can't be encoded")
+
+class Decoder:
+    def __init__(self, data):
+        self.data = bytes(data)
+        self.size = len(self.data)
+        self.at = 0
+        count = self.u16()
+        self.table = [str(node) for node in self.array("q", count)]
+
+    def u16(self) -> int:
+        (n,) = U16.unpack_from(self.data, self.at)
+        self.at += 2
+        return n
+
+    def u32(self) -> int:
+        (n,) = U32.unpack_from(self.data, self.at)
+        self.at += 4
+        return n
+
+    def string(self) -> str:
+        at = self.at + 4
+        end = at + U32.unpack_from(self.data, self.at)[0]
+        if end > self.size:
+            raise ValueError("Truncated binary message")
+        self.at = end
+        return self.data[at:end].decode("utf-8")
+
+    def array(self, typecode: str, n: int) -> list:
+        items = array(typecode)
+        end = self.at + n * items.itemsize
+        if end > self.size:
+            raise ValueError("Truncated binary message")
+        items.frombytes(self.data[self.at:end])
+        if BIG_ENDIAN:
+            items.byteswap()
+        self.at = end
+        return items.tolist()
+
+    def typed_array(self, n: int) -> list:
+        typecode = chr(self.data[self.at])
+        self.at += 1
+        if typecode not in ARRAY_TYPES:
+            raise ValueError(f"Invalid array type {typecode!r}")
+        return self.array(typecode, n)
+
+    def value(self):
+        tag = self.data[self.at]
+        self.at += 1
+        if tag == 0x73: # s
+            return self.string()
+        if tag == 0x63: # c
+            n = self.u16()
+            return dict(zip(self.table[:n], self.typed_array(n)))
+        if tag == 0x6D: # m
+            string, value = self.string, self.value
+            return {string(): value() for _ in range(self.u32())}
+        if tag == 0x69: # i
+            (n,) = I64.unpack_from(self.data, self.at)
+            self.at += 8
+            return n
+        if tag == 0x6C: # l
+            value = self.value
+            return [value() for _ in range(self.u32())]
+        if tag == 0x43: # C
+            n = self.u16()
+            slots = self.array("H", n)
+            table = self.table
+            return dict(zip((table[slot] for slot in slots), self.typed_array(n)))
+        if tag == 0x4E: # N
+            return None
+        if tag == 0x54: # T
+            return True
+        if tag == 0x46: # F
+            return False
+        if tag == 0x64: # d
+            (n,) = F64.unpack_from(self.data, self.at)
+            self.at += 8
+            return n
+        if tag == 0x49: # I
+            return int(self.string())
+        raise ValueError(f"Invalid tag {tag:#x} at byte {self.at - 1}")
+
+class Wire:
+    # Compression in use (WIRE_COMPRESSION, or zlib if zstd isn't installed), set by `compression`
+    compressor = None
+
+    # {<peer address>: True} for peers known to take binary bodies (see `learn`)
+    binary_peers: dict[str, bool] = {}
+
+    # Bodies we sent per format, and the bytes of the binary ones before and after compression
+    stats = {"binary": 0, "json": 0, "raw-bytes": 0, "sent-bytes": 0}
+
+    @staticmethod
+    def compression() -> str:
+        """The compression binary bodies get, checking WIRE_COMPRESSION once."""
+        if Wire.compressor is None:
+            compression = WIRE_COMPRESSION
+            if compression == "zstd" and _zstd() is None:
+                logger.warning("WIRE_COMPRESSION is zstd but the zstandard package is not installed, falling back to zlib")
+                compression = "zlib"
+            elif compression not in ("zlib", "zstd", "none"):
+                logger.warning("Unknown WIRE_COMPRESSION %r, falling back to zlib", compression)
+                compression = "zlib"
+            Wire.compressor = compression
+        return Wire.compressor
+
+    @staticmethod
+    def dumps(obj) -> bytes:
+        """Encodes `obj` (anything JSON can encode) in the binary format."""
+        payload = Encoder().encode(obj)
+        size = len(payload)
+        compression = Wire.compression()
+        flags = RAW
+        if len(payload) >= WIRE_COMPRESS_MIN and compression != "none":
+            if compression == "zstd":
+                packed = _zstd().ZstdCompressor(level=WIRE_COMPRESS_LEVEL).compress(payload)
+                flag = ZSTD
+            else:
+                packed = zlib.compress(payload, WIRE_COMPRESS_LEVEL)
+                flag = ZLIB
+            if len(packed) < len(payload):
+                payload, flags = packed, flag
+        data = bytes((flags,)) + payload
+        stats = Wire.stats
+        stats["binary"] += 1
+        stats["raw-bytes"] += size
+        stats["sent-bytes"] += len(data)
+        return data
+
+    @staticmethod
+    def loads(data: bytes):
+        """Decodes a message encoded by `dumps`. Raises ValueError if it isn't one."""
+        if not data:
+            raise ValueError("Empty binary message")
+        flags, payload = data[0], memoryview(data)[1:]
+        try:
+            if flags == ZLIB:
+                payload = zlib.decompress(payload)
+            elif flags == ZSTD:
+                zstandard = _zstd()
+                if zstandard is None:
+                    raise ValueError("Message compressed with zstd, but the zstandard package is not installed")
+                payload = zstandard.ZstdDecompressor().decompress(payload)
+            elif flags != RAW:
+                raise ValueError(f"Unknown flags {flags:#x}")
+            decoder = Decoder(payload)
+            value = decoder.value()
+        except (zlib.error, struct.error, IndexError, UnicodeDecodeError) as e:
+            raise ValueError(f"Malformed binary message: {e!r}") from e
+        if decoder.at != decoder.size:
+            raise ValueError("Trailing bytes after binary message")
+        return value
+
+    @staticmethod
+    def is_binary(headers) -> bool:
+        return headers.get("content-type", "").split(";")[0].strip() == MEDIA_TYPE
+
+    @staticmethod
+    def accepts(headers) -> bool:
+        """Whether the sender of a request with `headers` takes binary answers."""
+        return MEDIA_TYPE in headers.get("accept", "")
+
+    @staticmethod
+    def encode_request(peer: str, body) -> tuple[bytes, dict]:
+        """(content, headers) of a request body for the peer at `peer` (host:port): binary if it takes it, else JSON."""
+        if WIRE_FORMAT == "binary" and Wire.binary_peers.get(peer):
+            return Wire.dumps(body), {"Content-Type": MEDIA_TYPE}
+        Wire.stats["json"] += 1
+        return json.dumps(body, separators=(",", ":")).encode("utf-8"), {"Content-Type": "application/json"}
+
+    @staticmethod
+    def request_headers() -> dict:
+        """Headers every inter-node request carries, offering binary answers."""
+        return {"Accept": ACCEPT} if WIRE_FORMAT == "binary" else {}
+
+    @staticmethod
+    def learn(peer: str, response, sent_binary: bool):
+        """Notes whether `peer` takes binary bodies, from its `response` to a request."""
+        if Wire.is_binary(response.headers):
+            Wire.binary_peers[peer] = True
+        elif sent_binary and response.status_code in (400, 415):
+            # e.g. restarted on a version without it
+            Wire.binary_peers.pop(peer, None)
+
+    @staticmethod
+    def forget_others(addresses):
+        """Forgets what peers not in `addresses` take (called on a view change)."""
+        addresses = set(addresses)
+        for peer in list(Wire.binary_peers):
+            if peer not in addresses:
+                del Wire.binary_peers[peer]
+
+    @staticmethod
+    def body(response):
+        """The decoded body of an httpx response, binary or JSON."""
+        if Wire.is_binary(response.headers):
+            return Wire.loads(response.content)
+        return response.json()
+
+    @staticmethod
+    async def read(request):
+        """The decoded body of a request to one of our endpoints, binary or JSON. Raises ValueError if it has none."""
+        if Wire.is_binary(request.headers):
+            return Wire.loads(await request.body())
+        return await request.json()
+
+    @staticmethod
+    def response(content, request, status_code: int = 200, headers: dict = None) -> Response:
+        """Answers `content` in binary if the `request`'s sender takes it, else as JSON."""
+        if WIRE_FORMAT == "binary" and Wire.accepts(request.headers):
+            return Response(Wire.dumps(content), status_code=status_code, headers=headers, media_type=MEDIA_TYPE)
+        return FastJSONResponse(content, status_code=status_code, headers=headers)
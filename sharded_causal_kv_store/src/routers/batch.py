@@ -0,0 +1,140 @@
+from fastapi import APIRouter, Request
+from shared_data import SharedData
+from packages.vector_clock import VectorClock
+
+import util
+import asyncio
+
+from helper import AsyncHelper
+from packages.proxy import Proxy
+from packages.stability import Stability
+from packages.migration import Migration
+from packages.hotkeys import HotKeys
+from packages.read_cache import ReadCache
+from packages.storage import Storage
+from packages.wire import Wire
+from packages.render import FastJSONResponse
+from routers.get_data import read_local, merge_read, proxy_deadline, wait_timed_out_response
+from routers.put_data import write_local
+from log import get_logger
+
+batch_router = APIRouter()
+logger = get_logger(__name__)
+
+@batch_router.post('/data/batch')
+async def batch(request: Request):
+    """
+    Reads and writes many keys with one causal-metadata document:
+    {"get": [<key>, ...], "put": {<key>: <value>, ...}, "causal-metadata": {...}, "wait-timeout": 5}
+
+    1. Split the keys by owning shard.
+    2. Apply our shard's part locally, and send every other shard its part in one sub-request (in parallel).
+       A shard applies the batch's writes before its reads, so a read of a key written in the same batch sees the write.
+    3. Merge the answers: {"items": {<key>: <value>}, "missing": [<key>, ...], "causal-metadata": {...}}.
+    """
+    # If node is not in view, return 503.
+    if not util.in_current_view():
+        return FastJSONResponse({"error": f"Node {SharedData.NODE_IDENTIFIER} is not in view"}, status_code=503)
+
+    # Get request json and check input.
+    try:
+        data = await Wire.read(request)
+    except ValueError as e: # No json body.
+        logger.debug("No json in batch request: %s", e)
+        data = None
+    gets = data.get("get", []) if isinstance(data, dict) else None
+    puts = data.get("put", {}) if isinstance(data, dict) else None
+    if (not isinstance(gets, list) or not all(isinstance(key, str) and key for key in gets) or
+        not isinstance(puts, dict) or not all(key and isinstance(value, str) for key, value in puts.items())):
+        return FastJSONResponse({"error": 'Missing or invalid JSON body. Expected { "get": ["key", ...], "put": {"key": "string", ...} }'}, status_code=400)
+
+    Stability.learn_header(request.headers)
+    client_metadata = util.dict_to_causal_data(data.get("causal-metadata", dict()))
+    merged = dict(client_metadata)
+    items = {}
+    missing = []
+
+    # 1. split by owning shard (cached entries of other shards' keys answer their reads right away)
+    parts = {}
+    local_shard = SharedData.current_shard
+    for key, shard in zip(puts, SharedData.hash_circle.route(puts)):
+        HotKeys.record(key)
+        parts.setdefault(shard, ({}, []))[0][key] = puts[key]
+        if shard != local_shard:
+            # our cached entry (if any) predates this write
+            ReadCache.invalidate(key)
+    for key, shard in zip(gets, SharedData.hash_circle.route(gets)):
+        HotKeys.record(key)
+        if shard != local_shard and key not in puts and ReadCache.caches(key):
+            cached = ReadCache.lookup(key, client_metadata.get(key))
+            if cached is not None:
+                items[key], dependencies = cached
+                merge_read(key, merged, dependencies)
+                continue
+        parts.setdefault(shard, ({}, []))[1].append(key)
+
+    # 2. our part locally, the others' parts in parallel
+    shards = list(parts)
+    results = await asyncio.gather(*(
+        batch_local(*parts[shard], client_metadata, util.extract_wait_timeout(data)) if shard == local_shard
+        else forward_part(shard, *parts[shard], data)
+        for shard in shards
+    ))
+
+    # 3. merge the parts' answers
+    for shard, result in zip(shards, results):
+        if isinstance(result, FastJSONResponse):
+            return result
+        part_items, part_missing, part_metadata = result
+        items.update(part_items)
+        missing.extend(part_missing)
+        for key, clock in part_metadata.items():
+            merged[key] = merged[key].pairwise_max(clock) if key in merged else clock
+
+    # drop the dependencies every replica already has
+    merged = util.compact_dependencies(merged)
+    return FastJSONResponse({
+        "items": items,
+        "missing": missing,
+        "causal-metadata": util.causal_data_to_dict(merged),
+    }, status_code=200, headers=Stability.headers())
+
+async def batch_local(puts: dict, gets: list, client_metadata: dict[str, VectorClock], timeout: float = None):
+    """Applies the part of a batch for keys of our shard: (items, missing keys, causal-metadata), or a 503 response if `timeout` passed."""
+    # keys we don't have yet may still be on their old holders during a view change
+    await asyncio.gather(*(Migration.pull(key) for key in list(puts) + gets))
+    metadata = dict(client_metadata)
+    for key, value in puts.items():
+        for dep_key, dep_clock in write_local(key, value, client_metadata).items():
+            metadata[dep_key] = metadata[dep_key].pairwise_max(dep_clock) if dep_key in metadata else dep_clock
+    if puts:
+        await Storage.durable()
+
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    items = {}
+    missing = []
+    for key in gets:
+        server_key_metadata = await read_local(key, client_metadata, None if deadline is None else max(0, deadline - loop.time()))
+        if server_key_metadata is None:
+            return wait_timed_out_response(util.causal_data_to_dict(client_metadata))
+        if key in SharedData.kvstore:
+            items[key] = SharedData.kvstore[key]
+        else:
+            missing.append(key)
+        merge_read(key, metadata, server_key_metadata)
+    return items, missing, metadata
+
+async def forward_part(shard: str, puts: dict, gets: list, data: dict):
+    """Sends the part of a batch for keys of `shard` to its fastest replica: (items, missing keys, causal-metadata), or the error response."""
+    body = {"get": gets, "put": puts, "causal-metadata": data.get("causal-metadata", dict())}
+    if "wait-timeout" in data:
+        body["wait-timeout"] = data["wait-timeout"]
+    logger.debug("Forwarding batch of %d keys to %s", len(puts) + len(gets), shard)
+    result = await Proxy.forward("POST", shard, "/data/batch", body, deadline=proxy_deadline(data))
+    if result is None:
+        return FastJSONResponse({"error": f"No replica of {shard} is reachable"}, status_code=503)
+    if result.status_code != 200:
+        return AsyncHelper.format_fast_api_res(result)
+    payload = Wire.body(result)
+    return payload["items"], payload["missing"], util.dict_to_causal_data(payload["causal-metadata"])
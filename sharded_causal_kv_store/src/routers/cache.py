@@ -0,0 +1,17 @@
+from fastapi import APIRouter, Request
+from packages.read_cache import ReadCache
+from packages.wire import Wire
+from packages.render import FastJSONResponse
+
+cache_router = APIRouter()
+
+@cache_router.post("/cache/refresh")
+async def refresh(request: Request):
+    """New entries of keys we cache, pushed by a node of their shard: {"entries": {<key>: {"value", "causal-metadata"} or null}}."""
+    try:
+        data = await Wire.read(request)
+        entries = data["entries"]
+    except (ValueError, KeyError, TypeError):
+        return FastJSONResponse({"error": 'Expected { "entries": {...} }'}, status_code=400)
+    ReadCache.refresh(entries)
+    return Wire.response({"message": "ok"}, request)
@@ -1,14 +1,23 @@
 from fastapi import APIRouter, Request, Response
-from fastapi.responses import JSONResponse
 from shared_data import SharedData
 from packages.vector_clock import VectorClock
+from packages.waiters import KeyWaiters
 
 import util
 import asyncio
 
 from helper import AsyncHelper
+from packages.proxy import Proxy
+from packages.stability import Stability
+from packages.migration import Migration
+from packages.hotkeys import HotKeys
+from packages.read_cache import ReadCache, ENTRY_HEADER
+from packages.wire import Wire
+from packages.render import FastJSONResponse, Fragments
+from log import get_logger
 
 get_data_router = APIRouter()
+logger = get_logger(__name__)
 
 @get_data_router.get('/data')
 async def get_all_data(request: Request, response: Response):
@@ -19,15 +28,22 @@ async def get_all_data(request: Request, response: Response):
     """
     # Node is not in view, return 503.
     if not util.in_current_view():
-        return JSONResponse({"error": f"Node {SharedData.NODE_IDENTIFIER} is not in view"}, status_code=503)
+        return FastJSONResponse({"error": f"Node {SharedData.NODE_IDENTIFIER} is not in view"}, status_code=503)
 
     # Get request json and throw error if nonexistent.
     try: 
-        data = await request.json()
+        data = await Wire.read(request)
     except ValueError as e: # No json body.
         data = {}
 
     causal_metadata = util.dict_to_causal_data(data.get("causal-metadata", dict()))
+    deadline = util.extract_wait_timeout(data)
+    if deadline is not None:
+        deadline += asyncio.get_running_loop().time()
+
+    # keys still migrating to us would be missing from the listing, so wait for them
+    if not await Migration.wait_incoming(None if deadline is None else deadline - asyncio.get_running_loop().time()):
+        return wait_timed_out_response(data.get("causal-metadata", dict()))
 
     for key, vc in causal_metadata.items():
         # If the node/shard isn't responsible for this key, skip
@@ -41,15 +57,21 @@ async def get_all_data(request: Request, response: Response):
         if (local_key_vc and not (local_key_vc < client_key_vc) and (client_key_vc == local_key_vc or local_key_vc.concurrent_break_ties(client_key_vc) == local_key_vc)):
             continue
         else:
-            await wait_until_caught_up(key, vc) # Hang, this key is not updated to client metadata
+            # Hang, this key is not updated to client metadata
+            timeout = None if deadline is None else deadline - asyncio.get_running_loop().time()
+            if not await wait_until_caught_up(key, vc, timeout):
+                return wait_timed_out_response(data.get("causal-metadata", dict()))
+
+    # leave out keys that left our shard and are only kept until their new shard has them (or
+    # that reached us in a transfer of a view change since superseded)
+    items = [key for key in SharedData.kvstore if util.key_in_current_shard(key)]
+    server_metadata = {key: SharedData.causal_data[key] for key in items if key in SharedData.causal_data}
 
     # get updated metadata
-    json_updated_metadata = util.assemble_get_all_metadata_dict(SharedData.causal_data, causal_metadata)
-    
-    return JSONResponse({
-        "items": SharedData.kvstore,
-        "causal-metadata": json_updated_metadata,
-    }, status_code=200)
+    updated_metadata = util.assemble_get_all_metadata(server_metadata, causal_metadata)
+
+    # {"items": {<key>: <value>}, "causal-metadata": {<key>: <its clock>}}, from the keys' encoded fragments
+    return FastJSONResponse(Fragments.render_all(items, updated_metadata), status_code=200)
     
 
 @get_data_router.get('/data/{key}')
@@ -62,44 +84,75 @@ async def get_data(key: str, response: Response, request: Request):
 
     # If node is not in view, return 503.
     if not util.in_current_view():
-        return JSONResponse({"error": f"Node {SharedData.NODE_IDENTIFIER} is not in view"}, status_code=503)
+        return FastJSONResponse({"error": f"Node {SharedData.NODE_IDENTIFIER} is not in view"}, status_code=503)
 
     # Get request json and throw error if nonexistent.
     try: 
-        data = await request.json()
+        data = await Wire.read(request)
     except ValueError as e: # No json body.
-        print(f"error in get_data on {key}: {e}")
+        logger.debug("No json in get_data on %s: %s", key, e)
         data = {}
         # response.status_code = 400
         # return {}
     
+    HotKeys.record(key)
+    Stability.learn_header(request.headers)
     if (not util.key_in_current_shard(key)):
-        forwardShard = SharedData.hash_circle.get_shard_for_key(key)
-        potentialNodes = util.get_nodes_by_shard(SharedData.current_view, forwardShard)
-        print("Get potential nodes:", potentialNodes)
-        
-        tasks = []
-        for node in potentialNodes:
-            address = node["address"]
-            url = f"http://{address}/data/{key}"
+        # a cached copy of the owner's entry answers the read if it is recent enough for the client
+        cache = ReadCache.caches(key)
+        if cache:
+            client_metadata = util.dict_to_causal_data(data.get("causal-metadata", dict()))
+            cached = ReadCache.lookup(key, client_metadata.get(key))
+            if cached is not None:
+                value, dependencies = cached
+                return FastJSONResponse({
+                    "value": value,
+                    "causal-metadata": read_metadata(key, client_metadata, dependencies),
+                }, status_code=200)
 
-            # forward the same GET request body
-            tasks.append(AsyncHelper.async_get(url, body=data, timeout=3))
-        
-        # Run all proxy tasks concurrently, continue until response is received
-        while True:
-            print("Proxying for get, waiting for reply...")
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Check if any proxy returned a successful response
-            for result in results:
-                if not isinstance(result, Exception) and result.status_code < 400:
-                    return AsyncHelper.format_fast_api_res(result)
-            
-            await asyncio.sleep(1)
+        forwardShard = SharedData.hash_circle.get_shard_for_key(key)
+        # forward the same GET request body to the fastest replica of the owning shard
+        result = await Proxy.forward("GET", forwardShard, f"/data/{key}", data, deadline=proxy_deadline(data), headers=ReadCache.request_header() if cache else None)
+        if result is None:
+            return FastJSONResponse({"error": f"No replica of {forwardShard} is reachable"}, status_code=503)
+        if cache:
+            ReadCache.store(key, result)
+        result.headers.pop(ENTRY_HEADER, None)
+        return AsyncHelper.format_fast_api_res(result)
+
+    # a key we don't have yet may still be on its old holders during a view change
+    await Migration.pull(key)
 
     # extract metadata from client and server
     client_metadata: dict[str, VectorClock] = util.dict_to_causal_data(data.get("causal-metadata", dict()))
+    server_key_metadata = await read_local(key, client_metadata, util.extract_wait_timeout(data))
+    if server_key_metadata is None:
+        return wait_timed_out_response(data.get("causal-metadata", dict()))
+
+    updated_metadata = read_metadata(key, client_metadata, server_key_metadata)
+    
+    # return value if it exists
+    if key in SharedData.kvstore:
+        headers = Stability.headers()
+        # a node caching this key for reads asks for our entry along with the value
+        if ENTRY_HEADER in request.headers:
+            headers.update(ReadCache.entry_header(key, request.headers[ENTRY_HEADER]))
+        # the value is encoded once per write of the key
+        return FastJSONResponse(Fragments.render_value(key, updated_metadata), status_code=200, headers=headers)
+    
+    # otherwise 404 error
+    else:
+        return FastJSONResponse({
+            "message": "Key Not Found",
+            "causal-metadata": updated_metadata,
+        }, status_code=404, headers=Stability.headers())
+        
+
+async def read_local(key: str, client_metadata: dict[str, VectorClock], timeout: float = None) -> dict[str, VectorClock] | None:
+    """Waits until our copy of `key` (of our shard) is recent enough for the client, and returns its dependency map.
+
+    Returns None if `timeout` (in secs) passed first.
+    """
     server_key_metadata: dict[str, VectorClock] = SharedData.causal_data.get(key, dict())
     
     # get clocks to determine causal consistency
@@ -112,11 +165,27 @@ async def get_data(key: str, response: Response, request: Request):
     if client_dep_clock > server_dep_clock or (server_dep_clock.isConcurrent(client_dep_clock) and 
         server_dep_clock.concurrent_break_ties(client_dep_clock) == client_dep_clock):
         
-        # Hang until gossip protocol takes effect, broadcast/request for key (polling approach)
-        await wait_until_caught_up(key, client_dep_clock) # Hang
+        # Hang until the key is caught up by a broadcast or gossip (or the client's deadline passes)
+        if not await wait_until_caught_up(key, client_dep_clock, timeout):
+            return None
 
         # Get new dependencies for server key
         server_key_metadata: dict[str, VectorClock] = SharedData.causal_data.get(key, dict())
+    return server_key_metadata
+
+def read_metadata(key: str, client_metadata: dict[str, VectorClock], server_key_metadata: dict[str, VectorClock]) -> dict:
+    """The client's causal-metadata (json) after reading `key`, whose dependency map is `server_key_metadata`."""
+    merge_read(key, client_metadata, server_key_metadata)
+
+    # drop the dependencies every replica already has
+    client_metadata = util.compact_dependencies(client_metadata)
+    
+    #convert metadata to json
+    return util.causal_data_to_dict(client_metadata)
+
+def merge_read(key: str, client_metadata: dict[str, VectorClock], server_key_metadata: dict[str, VectorClock]):
+    """Adds the dependencies of a read of `key` (its dependency map `server_key_metadata`) to `client_metadata`, in place."""
+    server_dep_clock: VectorClock = server_key_metadata.get(key, VectorClock(util.extract_ids(SharedData.current_view)))
 
     # add each dependency for this key to the client's metadata
     for dep_key, dep_clock in server_key_metadata.items():
@@ -127,36 +196,32 @@ async def get_data(key: str, response: Response, request: Request):
             continue
         # new clock is pairwise max of client and server's clock
         client_metadata[dep_key] = old_client_clock.pairwise_max(dep_clock)
-    
-    #convert metadata to json
-    updated_metadata = util.causal_data_to_dict(client_metadata)
-    
-    # return value if it exists
-    if key in SharedData.kvstore:
-        return JSONResponse({
-            "value": SharedData.kvstore[key],
-            "causal-metadata": updated_metadata,
-        }, status_code=200)
-    
-    # otherwise 404 error
-    else:
-        return JSONResponse({
-            "message": "Key Not Found",
-            "causal-metadata": util.causal_data_to_dict(client_metadata),
-        }, status_code=404)
-        
 
-async def wait_until_caught_up(key: str, client_vc: VectorClock):
-    # If the node/shard isn't responsible for this key, no need to wait
-    if not util.key_in_current_shard(key):
-        return
+def proxy_deadline(data: dict) -> float | None:
+    """Event loop time by which a proxied read must be answered, from the client's "wait-timeout"."""
+    timeout = util.extract_wait_timeout(data)
+    return None if timeout is None else asyncio.get_running_loop().time() + timeout
 
-    # Poll every 1.5s
-    while True:
+def wait_timed_out_response(causal_metadata: dict) -> FastJSONResponse:
+    """Response for a read whose causal dependencies didn't arrive before the client's "wait-timeout"."""
+    return FastJSONResponse({
+        "error": "Timed out waiting for causal dependencies",
+        "causal-metadata": causal_metadata,
+    }, status_code=503)
+
+async def wait_until_caught_up(key: str, client_vc: VectorClock, timeout: float = None) -> bool:
+    """Hangs until our copy of `key` is at least as recent as `client_vc`.
+
+    Woken every time the key is written locally (see packages/waiters.py).
+    Returns False if `timeout` (in secs) passed first.
+    """
+    def caught_up():
+        # If the node/shard isn't responsible for this key, no need to wait
+        if not util.key_in_current_shard(key):
+            return True
         local_vc: VectorClock = SharedData.causal_data.get(key, dict()).get(key)
-        print(f"Wait for {key}. Client VC is {client_vc}, local is {local_vc}")
-        if local_vc is not None and (local_vc >= client_vc or (local_vc.isConcurrent(client_vc) and local_vc.concurrent_break_ties(client_vc) == local_vc)):
-            break
-        # Yield control to the event loop and try again
-        await asyncio.sleep(1.5)
+        return local_vc is not None and (local_vc >= client_vc or (local_vc.isConcurrent(client_vc) and local_vc.concurrent_break_ties(client_vc) == local_vc))
+
+    logger.debug("Wait for %s. Client VC is %s", key, client_vc)
+    return await KeyWaiters.wait_for(key, caught_up, timeout)
 
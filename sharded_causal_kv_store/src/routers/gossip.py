@@ -0,0 +1,113 @@
+"""
+Internal endpoints for anti-entropy (gossip) between replicas of a shard.
+"""
+from fastapi import APIRouter, Request, Response
+from shared_data import SharedData
+from helper import AsyncHelper
+from packages.stability import Stability
+from packages.wire import Wire
+from packages.render import FastJSONResponse
+
+import util
+import asyncio
+from log import get_logger
+
+gossip_router = APIRouter()
+logger = get_logger(__name__)
+
+@gossip_router.post('/gossip/digest')
+async def gossip_digest(request: Request, response: Response):
+    """
+    Called by `Gossip._gossip_loop` in src/packages/gossip.py.
+
+    Compares the sender's per-key versions against ours, and replies with only the
+    entries that differ: ours for them to merge, and the list of keys we want theirs for
+    (which the sender then pushes to /copy).
+
+    Expects JSON: {
+      "digest": {<kvs key>: <version from util.key_version>, ...},
+      "ranges": [[<first leaf>, <last leaf>], ...] # optional, the Merkle leaf ranges the digest covers
+    }
+    Returns JSON: {
+      "kvstore": {<kvs key>: <kvs value>, ...},
+      "causal-metadata": {<kvs key>: {<kvs key>: <VectorClock>, ...}, ...},
+      "want": [<kvs key>, ...]
+    }
+    (or the same in the binary format of src/packages/wire.py)
+    """
+    # Get request json and throw error if nonexistent.
+    try: 
+        data = await Wire.read(request)
+    except ValueError as e: # No json body.
+        logger.warning("No json from request: %s", e)
+        response.status_code = 400
+        return {}
+
+    digest = data.get("digest")
+    if digest is None:
+        return FastJSONResponse({"error": "No digest"}, status_code=400)
+
+    send, want = util.diff_digest(digest, data.get("ranges"))
+    payload = util.assemble_copy_payload(send)
+    payload["want"] = want
+    return Wire.response(payload, request)
+
+@gossip_router.post('/merkle/nodes')
+async def merkle_nodes(request: Request, response: Response):
+    """
+    Returns the hashes of some nodes of our Merkle tree (see src/packages/merkle.py).
+
+    Called by `Gossip.find_divergent_ranges` to walk down the tree, one level per request.
+
+    Expects JSON: {
+      "level": <tree level, 0 is the root>,
+      "indices": [<node index in the level>, ...],
+      "stable": <the sender's stability report> # optional, see src/packages/stability.py
+    }
+    Returns JSON: {
+      "hashes": [<node hash>, ...], # same order as "indices"
+      "stable": <our stability report> # if the request had one
+    }
+    """
+    try: 
+        data = await Wire.read(request)
+        level = int(data["level"])
+        indices = data["indices"]
+        hashes = SharedData.merkle.nodes(level, indices)
+    except (ValueError, KeyError, IndexError, TypeError) as e:
+        return FastJSONResponse({"error": f"Invalid Merkle node request: {e}"}, status_code=400)
+    if "stable" not in data:
+        return Wire.response({"hashes": hashes}, request)
+    Stability.learn(data["stable"])
+    return Wire.response({"hashes": hashes, "stable": Stability.report()}, request)
+
+@gossip_router.get('/merkle/root')
+async def merkle_root():
+    """Root hash and number of keys of this node's Merkle tree."""
+    return FastJSONResponse({
+        "node_id": SharedData.NODE_IDENTIFIER,
+        "shard": SharedData.current_shard,
+        "root": format(SharedData.merkle.root(), "016x"),
+        "keys": len(SharedData.merkle),
+    }, status_code=200)
+
+@gossip_router.get('/debug/merkle')
+async def debug_merkle():
+    """Debug endpoint: Merkle root hashes of every replica in this node's shard.
+
+    Replicas that have converged report the same root.
+    """
+    nodes = util.get_nodes_by_shard(SharedData.current_view, SharedData.current_shard) if SharedData.current_shard else []
+
+    async def fetch_root(node):
+        try:
+            res = await AsyncHelper.async_get(f"http://{node['address']}/merkle/root", timeout=2, retries=0)
+            return AsyncHelper.extract_res(res)[0]
+        except Exception as e:
+            return {"node_id": node["id"], "error": str(e)}
+
+    roots = await asyncio.gather(*[fetch_root(node) for node in nodes])
+    return FastJSONResponse({
+        "shard": SharedData.current_shard,
+        "replicas": {str(node["id"]): root for node, root in zip(nodes, roots)},
+    }, status_code=200)
@@ -1,9 +1,24 @@
 from fastapi import APIRouter
-from fastapi.responses import JSONResponse
 from shared_data import SharedData
+from packages.health import Health
+from packages.hotkeys import HotKeys
+from packages.read_cache import ReadCache
+from packages.storage import Storage
+from packages.wire import Wire
+from packages.render import FastJSONResponse, Fragments
 
 ping_router = APIRouter()
 
 @ping_router.get("/ping")
 def ping():
-    return JSONResponse(content={"message": f"Node {SharedData.NODE_IDENTIFIER} is up."}, status_code=200)
+    return FastJSONResponse(content={"message": f"Node {SharedData.NODE_IDENTIFIER} is up."}, status_code=200)
+
+@ping_router.get("/health")
+def health():
+    """This node's view of its peers: {<address>: {"latency", "error-rate", "last-seen", "failures", "down"}}."""
+    return FastJSONResponse(content=Health.table(), status_code=200)
+
+@ping_router.get("/stats")
+def stats():
+    """Access statistics: the most requested keys (estimated requests per window), the read cache's counters and the storage engine's state."""
+    return FastJSONResponse(content={"hot-keys": HotKeys.top(), "read-cache": ReadCache.stats(), "storage": Storage.engine.stats(), "wire": Wire.stats, "fragments": Fragments.stats()}, status_code=200)
@@ -1,15 +1,23 @@
 from fastapi import APIRouter, Request, Response, BackgroundTasks
-from fastapi.responses import JSONResponse
 from shared_data import SharedData
 from packages.vector_clock import VectorClock
 from packages.broadcast import broadcast_info
 
 from helper import AsyncHelper
+from packages.proxy import Proxy
+from packages.stability import Stability
+from packages.migration import Migration
+from packages.hotkeys import HotKeys
+from packages.read_cache import ReadCache
+from packages.storage import Storage
+from packages.wire import Wire
+from packages.render import FastJSONResponse
+from log import get_logger
 
 import util
-import asyncio
 
 put_data_router = APIRouter()
+logger = get_logger(__name__)
 
 @put_data_router.put('/data/{key}')
 async def put_data(key: str, response: Response, request: Request, background_tasks: BackgroundTasks):
@@ -26,49 +34,51 @@ async def put_data(key: str, response: Response, request: Request, background_ta
 
     # Get request json and throw error if nonexistent.
     try: 
-        data = await request.json()
+        data = await Wire.read(request)
     except ValueError as e: # No json body.
-        print(e)
+        logger.warning("No json from request: %s", e)
         response.status_code = 400
         return {}
 
     # Check input.
     if "value" not in data or not isinstance(data["value"], str):
-        return JSONResponse(content={"error": 'Missing or invalid JSON body. Expected { "value": "string" }'}, status_code=400)
+        return FastJSONResponse(content={"error": 'Missing or invalid JSON body. Expected { "value": "string" }'}, status_code=400)
     
     # Check if node is in current view, else 503.
     if not util.in_current_view():
-        return JSONResponse({"error": "Node not in view"}, status_code=503)
+        return FastJSONResponse({"error": "Node not in view"}, status_code=503)
     
+    HotKeys.record(key)
+    Stability.learn_header(request.headers)
     if (not util.key_in_current_shard(key)):
+        # our cached entry (if any) predates this write
+        ReadCache.invalidate(key)
         forwardShard = SharedData.hash_circle.get_shard_for_key(key)
-        print("Forward Shard:", forwardShard)
-        potentialNodes = util.get_nodes_by_shard(SharedData.current_view, forwardShard)
-        print("Potential Nodes: ", potentialNodes)
-        
-        tasks = []
-        for node in potentialNodes:
-            address = node["address"]
-            url = f"http://{address}/data/{key}"
-
-            # forward the same PUT request body
-            tasks.append(AsyncHelper.async_put(url, data, timeout=3))
-        
-        # Run all proxy tasks concurrently, continue until response is received
-        while True:
-            print("Proxying concurrently, in the while loop...")
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Check if any proxy returned a successful response
-            for result in results:
-                if not isinstance(result, Exception) and result.status_code < 400:
-                    return AsyncHelper.format_fast_api_res(result)
-            
-            await asyncio.sleep(1)
+        logger.debug("Forwarding PUT of %s to %s", key, forwardShard)
+        # forward the same PUT request body to the fastest replica of the owning shard
+        result = await Proxy.forward("PUT", forwardShard, f"/data/{key}", data)
+        return AsyncHelper.format_fast_api_res(result)
+
+    # a key we don't have yet may still be on its old holders during a view change
+    await Migration.pull(key)
 
     # 1. Extract client's causal-metadata
     client_metadata = util.dict_to_causal_data(data.get("causal-metadata", dict()))
-    value = data['value']
+    updatedMetadata = util.causal_data_to_dict(write_local(key, data['value'], client_metadata))
+    await Storage.durable()
+
+    # send back the updatedMetadata server metadata 
+    return FastJSONResponse({
+        "message": "Key updated successfully." if key in SharedData.kvstore else "Key created successfully.",
+        "causal-metadata": updatedMetadata
+    }, status_code=200, headers=Stability.headers())
+
+def write_local(key: str, value: str, client_metadata: dict[str, VectorClock]) -> dict[str, VectorClock]:
+    """Writes `key` (of our shard) after the client's dependencies `client_metadata` and replicates the write.
+
+    Returns the write's dependency map, which is the client's new causal-metadata.
+    """
+    util.key_changing(key)
 
     # 2. add client dependencies to server_metadata for this key
     server_key_metadata = SharedData.causal_data.get(key, {key: VectorClock(util.extract_ids(SharedData.current_view))})
@@ -77,22 +87,17 @@ async def put_data(key: str, response: Response, request: Request, background_ta
         # new clock is pairwise max of client and server's clock
         server_key_metadata[dep_key] = old_server_clock.pairwise_max(dep_clock)
 
-    # 3. Increment 1 for node's position in vector clock data for the key
-    server_key_metadata[key][SharedData.NODE_IDENTIFIER] += 1 
+    # 3. Advance node's position in vector clock data for the key to the write's sequence number
+    server_key_metadata[key][SharedData.NODE_IDENTIFIER] = Stability.next_seq(server_key_metadata[key][SharedData.NODE_IDENTIFIER])
 
-    # assign updated metadata to server if not there already
+    # drop the dependencies every replica already has, and assign updated metadata to server
+    server_key_metadata = util.compact_dependencies(server_key_metadata, keep=key)
     SharedData.causal_data[key] = server_key_metadata
 
     # 4. put the value into the kvs
     SharedData.kvstore[key] = value # 2. Store PUT request value in kvstore
+    util.key_changed(key)
 
-    updatedMetadata = util.causal_data_to_dict(server_key_metadata)
-    
     # 5. Replicate (Broadcast) to other nodes, retry every some seconds (or await for gossip protocol)
-    background_tasks.add_task(broadcast_info, background_tasks, "PUT", updatedMetadata, key, value)
-
-    # send back the updatedMetadata server metadata 
-    return JSONResponse({
-        "message": "Key updated successfully." if key in SharedData.kvstore else "Key created successfully.",
-        "causal-metadata": updatedMetadata
-    }, status_code=200)
+    broadcast_info("PUT", util.causal_data_to_dict(server_key_metadata), key, value)
+    return server_key_metadata
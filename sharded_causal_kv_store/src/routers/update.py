@@ -1,18 +1,22 @@
 """
 Helpers for broadcasting updates to other nodes. Used for PUT.
 """
-from fastapi import APIRouter, Request, Response, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Request, Response, BackgroundTasks
 from shared_data import SharedData
-from helper import ReqHelper, AsyncHelper
+from helper import ReqHelper
 
 from packages.vector_clock import VectorClock
 import packages.broadcast as broadcast
+from packages.stability import Stability
+from packages.storage import Storage
+from packages.wire import Wire
+from packages.render import FastJSONResponse
 
-import requests
 import util
+from log import get_logger
 
 update_data_router = APIRouter()
+logger = get_logger(__name__)
 
 test_num = 0
 @update_data_router.get('/test_broadcast')
@@ -37,78 +41,124 @@ async def test_broadcast(request: Request, response: Response, background_tasks:
     if "test_broadcast" not in causal_metadata:
         causal_metadata["test_broadcast"] = VectorClock(util.extract_ids(SharedData.current_view))
     
-    #Increment Vector Clock.
-    causal_metadata["test_broadcast"][str(SharedData.NODE_IDENTIFIER)] += 1
+    #Advance Vector Clock.
+    causal_metadata["test_broadcast"][str(SharedData.NODE_IDENTIFIER)] = Stability.next_seq(causal_metadata["test_broadcast"][str(SharedData.NODE_IDENTIFIER)])
     SharedData.causal_data = causal_metadata.copy()
 
     # Broadcast to all other nodes
-    await broadcast.broadcast_info(background_tasks, "PUT", causal_metadata, "test_broadcast", test_num)
+    broadcast.broadcast_info("PUT", causal_metadata, "test_broadcast", test_num)
     SharedData.kvstore["test_broadcast"] = test_num
+    util.key_changed("test_broadcast")
     test_num += 1
     
-    return JSONResponse({"kvs": SharedData.kvstore, "causal-metadata": util.causal_data_to_dict(causal_metadata)})
+    return FastJSONResponse({"kvs": dict(SharedData.kvstore), "causal-metadata": util.causal_data_to_dict(causal_metadata)})
 
-@update_data_router.post('/update')
-async def update(request: Request, response: Response):
-    """
-    Internal endpoint for relaying PUT requests.
-
-    Called by `unicast_info` in src/packages/broadcast.py.
+def apply_update(key: str, val, json_causal_metadata: dict) -> str:
+    """Delivers a replicated PUT of `key` if its clock is ahead of ours (or wins the tiebreaker).
 
-    Expects JSON: {
-      "key": "<key>",
-      "value": "<val>" # only for PUT,
-      "causal-metadata": {<kvs key>: <VectorClock>, ...}
-    }
+    Returns a message describing what happened.
     """
-    # Get request json and throw error if nonexistent.
-    try: 
-        data = await request.json()
-    except ValueError as e: # No json body.
-        print("No json from request.")
-        print(e)
-        response.status_code = 400
-        return {}
-
-    # Extract headers & json body.
-    sender_node_id = ReqHelper.extract_node_id_header(request)
-    key = data["key"]
-    val = data["value"]
-    json_causal_metadata = data["causal-metadata"]
-
     causal_metadata = util.dict_to_causal_data(json_causal_metadata)
     
     # Get local and msg's VC for the specified key (initialize one if nonexistent).
     local_key_vc = SharedData.causal_data.get(key, {}).get(key, VectorClock(util.extract_ids(SharedData.current_view)))
 
-    print("local_key_vc:", local_key_vc, type(local_key_vc))
-    msg_key_vc: VectorClock = causal_metadata.get(key, VectorClock(local_key_vc.clock.keys()))
-    print("msg_key_vc:", msg_key_vc, type(msg_key_vc))
+    msg_key_vc: VectorClock = causal_metadata.get(key, VectorClock([]))
+    logger.debug("Update of %s: local VC %s, msg VC %s", key, local_key_vc, msg_key_vc)
 
     # Case 1: msg VC < local VC, don't deliver (local is more updated)
     if msg_key_vc < local_key_vc:
-        return JSONResponse({
-            "message": f"Update did not occur - local VC {local_key_vc} more ahead than message's VC {msg_key_vc}"
-        })
+        return f"Update did not occur - local VC {local_key_vc} more ahead than message's VC {msg_key_vc}"
 
     # Case 2: msg VC == local VC, the kvs values better be the same
     elif msg_key_vc == local_key_vc:
-        if val != SharedData.kvstore[key]:
+        if val != SharedData.kvstore.get(key):
             raise ValueError("!!!!!!!!!!!!!!!!!!!!!!!For update, vector clocks are the same but values aren't. This is really bad!!!!!!!!!!!!!!!!!!!!!!!!!!!")
+        return f"Update did not occur - local VC {local_key_vc} equals message's VC"
     
     # Case 2: msg || local AND local wins the tiebreaker, don't deliver
     elif msg_key_vc.isConcurrent(local_key_vc) and msg_key_vc.concurrent_break_ties(local_key_vc) == local_key_vc:
-        return JSONResponse({
-            "message": f"Update did not occur - local VC {local_key_vc} || message's VC {msg_key_vc}, but local wins tiebreaker."
-        })
+        return f"Update did not occur - local VC {local_key_vc} || message's VC {msg_key_vc}, but local wins tiebreaker."
 
     # Case 3: msg || local & msg wins, local -> msg, or msg == local, deliver
     else:
         # Merge client metadata with our node's key's metadata, along with KVS data
 
+        util.key_changing(key)
         self_dependencies = SharedData.causal_data.get(key, {})
         util.update_metadata(self_dependencies, causal_metadata, SharedData.kvstore, {key: val}, key)
-        SharedData.causal_data[key] = self_dependencies
-        print("After update, causal metadata is", util.server_metadata_to_dict(SharedData.causal_data))
-        print(SharedData.kvstore[key])
-        return JSONResponse({"message": f"Replicated data with key {key} and value {val}"})
+        SharedData.causal_data[key] = util.compact_dependencies(self_dependencies, keep=key)
+        util.key_changed(key)
+        return f"Replicated data with key {key} and value {val}"
+
+@update_data_router.post('/update')
+async def update(request: Request, response: Response):
+    """
+    Internal endpoint for relaying a single PUT request.
+
+    Expects JSON: {
+      "key": "<key>",
+      "value": "<val>" # only for PUT,
+      "causal-metadata": {<kvs key>: <VectorClock>, ...}
+    }
+    """
+    # Get request json and throw error if nonexistent.
+    try: 
+        data = await Wire.read(request)
+    except ValueError as e: # No json body.
+        logger.warning("No json from request: %s", e)
+        response.status_code = 400
+        return {}
+
+    async with SharedData.lock:
+        message = apply_update(data["key"], data["value"], data["causal-metadata"])
+    await Storage.durable()
+    return Wire.response({"message": message}, request)
+
+@update_data_router.post('/update/batch')
+async def update_batch(request: Request, response: Response):
+    """
+    Internal endpoint for relaying a batch of PUT requests, applied under a single lock acquisition.
+
+    Called by `Replicator` in src/packages/broadcast.py.
+
+    Expects JSON: {
+      "updates": [{"operation": "PUT", "key": "<key>", "value": "<val>", "causal-metadata": {...}}, ...],
+      "stable": <the sender's stability report> # see src/packages/stability.py
+    }
+    Replies with our own stability report, and the indices in "updates" of those that failed
+    ("failed"): the sender doesn't count them as delivered, and sends them again.
+
+    Bodies can also be in the binary format of src/packages/wire.py (as can the reply).
+    """
+    # Get request json and throw error if nonexistent.
+    try: 
+        data = await Wire.read(request)
+    except ValueError as e: # No json body.
+        logger.warning("No json from request: %s", e)
+        response.status_code = 400
+        return {}
+
+    sender_node_id = ReqHelper.extract_node_id_header(request)
+    updates = data.get("updates", [])
+    applied = 0
+    failed = []
+    async with SharedData.lock:
+        for index, update in enumerate(updates):
+            # a bad update doesn't fail the batch (the rest of it would be held up behind it), it is
+            # reported back instead
+            try:
+                message = apply_update(update["key"], update["value"], update["causal-metadata"])
+            except Exception as e:
+                logger.error("Update of %r from node %s failed: %r", update.get("key") if isinstance(update, dict) else update, sender_node_id, e)
+                failed.append(index)
+                continue
+            applied += message.startswith("Replicated")
+    # the sender counts acked updates, except the failed ones, as delivered (see packages/stability.py)
+    await Storage.durable()
+    Stability.learn(data.get("stable"))
+    return Wire.response({
+        "message": f"Applied {applied} of {len(updates)} updates from node {sender_node_id}",
+        "failed": failed,
+        "stable": Stability.report(),
+    }, request)
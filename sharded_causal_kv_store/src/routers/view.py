@@ -1,18 +1,28 @@
 from fastapi import APIRouter, Request, Response, HTTPException, BackgroundTasks
-from fastapi.responses import JSONResponse
+from fastapi.responses import StreamingResponse
 from shared_data import SharedData
 import util
-from helper import ReqHelper, AsyncHelper
 from packages.vector_clock import VectorClock
-import util
-import asyncio
+from packages.health import Health
+from packages.broadcast import Replicator
+from packages.stability import Stability
+from packages.transfer import Transfer
+from packages.migration import Migration
+from packages.hash import HashCircle
+from packages.read_cache import ReadCache
+from packages.storage import Storage
+from packages.snapshot import Snapshot
+from packages.wire import Wire
+from packages.render import FastJSONResponse, Fragments
 import random
+from log import get_logger
 
 view_router = APIRouter()
+logger = get_logger(__name__)
 
 @view_router.get('/view')
 async def get_view():
-    return JSONResponse(content=SharedData.current_view)
+    return FastJSONResponse(content=SharedData.current_view)
 
 @view_router.put('/view')
 async def update_view(request: Request, background_tasks: BackgroundTasks):
@@ -26,64 +36,118 @@ async def update_view(request: Request, background_tasks: BackgroundTasks):
     if not data or "view" not in data:
         raise HTTPException(status_code=400, detail='Request body must have "view" field.')
 
-    # Update the current view
-    SharedData.current_view = data["view"]
+    # Optional placement of keys: {"weights": {<shard>: <weight>}, "hashing": {"strategy", "capacity"}}
+    weights = data.get("weights") or {}
+    hashing = data.get("hashing") or {}
+    if not isinstance(weights, dict) or not all(isinstance(weight, (int, float)) and not isinstance(weight, bool) and weight > 0 for weight in weights.values()):
+        return FastJSONResponse(content={"error": '"weights" must map shards to positive numbers'}, status_code=400)
+    try:
+        strategy, capacity = HashCircle.check_strategy(hashing.get("strategy"), hashing.get("capacity"))
+    except (ValueError, AttributeError) as e:
+        return FastJSONResponse(content={"error": f'Invalid "hashing": {e}'}, status_code=400)
+
+    # A view change numbered below the last one we installed is stale
+    epoch = data.get("epoch")
+    if epoch is not None:
+        if not isinstance(epoch, int) or epoch < Migration.epoch:
+            return FastJSONResponse(content={"error": f"Stale or invalid epoch, at epoch {Migration.epoch}"}, status_code=409)
+
+    # What we need to tell which keys move, and to whom
+    old_view = SharedData.current_view
+    old_shard = SharedData.current_shard
+    old_circle = SharedData.hash_circle.copy()
+    synced_peers = {address for address, seq in Stability.synced.items() if seq >= Stability.view_base}
+
+    moved = install_view(data["view"], weights, strategy, capacity)
+
+    # causal stability starts over (our writes so far reach the new replicas through the migration)
+    Stability.reset(SharedData.current_view)
+
+    # hand the keys that move over to their new holders in the background (see packages/migration.py)
+    Migration.start(epoch, old_view, old_shard, old_circle, synced_peers, moved)
+    Storage.save_view(SharedData.current_view, Migration.epoch)
+
+    # Check if the current view contains this node
+    if not util.in_current_view():
+        # Not in the new view => only hand our keys over
+        return FastJSONResponse(content={"message": "Not in View", "epoch": Migration.epoch}, status_code=200)
+
+    # Respond with the updated view
+    return FastJSONResponse(content={"message": "View updated", "node_id": SharedData.NODE_IDENTIFIER, "shard": SharedData.current_shard, "epoch": Migration.epoch, "state": Migration.state}, status_code=200)
+
+def install_view(view: dict, weights: dict = None, strategy: str = None, capacity: float = None) -> list[str]:
+    """Routes by `view` from now on: our shard, the hash circle, the peers we replicate to and the clocks' slots.
+    Returns the keys of our shard in the previous view that moved to another shard."""
+    old_shard = SharedData.current_shard
+    SharedData.current_view = view
 
     # update shard and hash info
     SharedData.current_shard = util.find_shard_by_node(SharedData.current_view, SharedData.NODE_IDENTIFIER)
     SharedData.shards = list(SharedData.current_view.keys())
-    SharedData.hash_circle.update_shards(SharedData.shards)
+    SharedData.hash_circle.update_shards(SharedData.shards, weights, strategy, capacity)
     if SharedData.current_shard:
-        SharedData.gossip_nodes = data["view"][SharedData.current_shard]
+        # copy, so the shuffle below doesn't reorder the view itself
+        SharedData.gossip_nodes = list(view[SharedData.current_shard])
     random.shuffle(SharedData.gossip_nodes)
 
-    # update view of clocks in causal data
-    view_clock = VectorClock(util.extract_ids(SharedData.current_view))
-    for dependencies in SharedData.causal_data.values():
-        for clock in dependencies.values():
-            clock.update_view(view_clock)
-
-    # foward shard kvs and metadata to new nodes
-    
-    headers = ReqHelper.create_req_headers()
-    # extract new location of keys
-    key_locations = SharedData.hash_circle.redistribute_keys(list(SharedData.kvstore.keys()))
-    copy_requests = []
-    for shard in SharedData.shards:
-        # compute payload info
-        shard_kvs = {key: SharedData.kvstore[key] for key in key_locations[shard]}
-        shard_metadata = {key: SharedData.causal_data[key] for key in key_locations[shard]}
-
-        payload = {
-            "kvstore": shard_kvs,
-            "causal-metadata": util.server_metadata_to_dict(shard_metadata),
-            "type": "view_change"
-        }
-        for shard_node in SharedData.current_view[shard]:
-            address = shard_node['address']
-            node_id = shard_node['id']
-            # foward data if not yourself
-            if str(node_id) != SharedData.NODE_IDENTIFIER:
-                r = AsyncHelper.async_put(f"http://{address}/copy", payload, headers, timeout=1, retries=2)
-                copy_requests.append(r)
-    # wait for all copy requests to finish
-    for request in copy_requests:
-        await request
-    # Check if the current view contains this node
-    if not util.in_current_view():
-        # Not in the new view => effectively do nothing
-        return JSONResponse(content={"message": "Not in View"}, status_code=200)
-
-    # update own kvs storage and metadata
-    for shard, keys in key_locations.items():
-        if shard != SharedData.current_shard:
-            for key in keys:
-                del SharedData.kvstore[key]
-                del SharedData.causal_data[key]
-    # SharedData.kvstore = {key: SharedData.kvstore[key] for key in key_locations[SharedData.current_shard]}
-    # SharedData.causal_data = {key: SharedData.causal_data[key] for key in key_locations[SharedData.current_shard]}
-    # Respond with the updated view
-    return JSONResponse(content={"message": "View updated", "node_id": SharedData.NODE_IDENTIFIER, "shard": SharedData.current_shard, "key_map": key_locations}, status_code=200)
+    # cached entries of other shards' keys may be of keys we own now (and our keys' fragments of keys we don't)
+    ReadCache.clear()
+    Fragments.clear()
+
+    # give the view's nodes a slot in every vector clock (existing clocks read 0 for new slots)
+    VectorClock.register_nodes(util.extract_ids(SharedData.current_view))
+
+    # stop tracking the health (and wire format) of nodes that left the view, and replicating to nodes that left the shard
+    Health.forget_others(node["address"] for nodes in SharedData.current_view.values() for node in nodes)
+    Wire.forget_others(node["address"] for nodes in SharedData.current_view.values() for node in nodes)
+    Replicator.forget_others(node["address"] for node in SharedData.gossip_nodes)
+
+    # the Merkle tree only indexes our shard's keys
+    return util.index_shard_keys(old_shard)
+
+def restore_view():
+    """Installs the view saved before a restart (see packages/storage.py), so recovered data is served right away."""
+    saved = Storage.saved_view()
+    if saved is None:
+        return
+    install_view(saved["view"], saved["weights"], saved["strategy"], saved["capacity"])
+    Stability.reset(SharedData.current_view)
+    Migration.epoch = saved["epoch"]
+    logger.info("Restored the view of epoch %s, shard %s", Migration.epoch, SharedData.current_shard)
+
+@view_router.get('/view/status')
+async def get_view_status():
+    """Progress of the migration of the last view change on this node (see src/packages/migration.py)."""
+    return FastJSONResponse(content=Migration.status(), status_code=200)
+
+@view_router.get('/view/distribution')
+async def get_view_distribution():
+    """How evenly the current placement spreads keys over the shards, and how many moved in the last view change."""
+    report = SharedData.hash_circle.report(Migration.old_circle)
+    report["keys"] = {SharedData.current_shard: len(SharedData.kvstore) - len(SharedData.handoff)} if SharedData.current_shard else {}
+    return FastJSONResponse(content=report, status_code=200)
+
+@view_router.post('/view/transferred')
+async def post_view_transferred(request: Request):
+    """
+    Internal endpoint: the sender has handed us everything it had for us.
+
+    Expects JSON: {"view": <view fingerprint>, "node": <sender id>}
+    """
+    try:
+        data = await Wire.read(request)
+        Migration.transferred(data["view"], str(data["node"]))
+    except (ValueError, KeyError, TypeError) as e:
+        return FastJSONResponse({"error": f"Invalid transfer notice: {e}"}, status_code=400)
+    return Wire.response({"message": "OK"}, request)
+
+@view_router.get('/view/key/{key}')
+async def get_view_key(key: str, request: Request):
+    """
+    Internal endpoint for pulling a key that is still migrating: our copy of it, in /copy format
+    (empty if we don't hold it). Served whether or not we are in the view, and never forwarded.
+    """
+    return Wire.response(util.assemble_copy_payload([key]), request)
 
 @view_router.put('/copy')
 async def put_copy(request: Request, response: Response):
@@ -97,10 +161,9 @@ async def put_copy(request: Request, response: Response):
     """
     # Get request json and throw error if nonexistent.
     try: 
-        data = await request.json()
+        data = await Wire.read(request)
     except ValueError as e: # No json body.
-        print("No json from request.")
-        print(e)
+        logger.warning("No json from request: %s", e)
         response.status_code = 400
         return {}
 
@@ -108,19 +171,45 @@ async def put_copy(request: Request, response: Response):
     server_metadata: dict = data.get("causal-metadata")
 
     if server_kvstore is not None and server_metadata is not None:
-        server_metadata = util.dict_to_server_metadata(server_metadata)
-        for key, server_dependencies in server_metadata.items():
-            # If the key doesn't belong in our shard, don't merge, and not doing view change
-            if data.get("type") != "view_change" and not util.key_in_current_shard(key):
-                continue
-                
-            # convert dicts in dependencies to vector clocks
-            self_dependencies = SharedData.causal_data.get(key, {})
-            util.update_metadata(self_dependencies, server_dependencies, SharedData.kvstore, server_kvstore, key)
-            SharedData.causal_data[key] = self_dependencies
-        return JSONResponse({"message": f"Replicated data for {SharedData.NODE_IDENTIFIER}"}, status_code=200)
+        util.merge_data(server_kvstore, server_metadata, view_change=data.get("type") == "view_change")
+        await Storage.durable()
+        return Wire.response({"message": f"Replicated data for {SharedData.NODE_IDENTIFIER}"}, request)
     else:
-        return JSONResponse({"error": "No kvstore or causal-metadata"}, status_code=400)
+        return FastJSONResponse({"error": "No kvstore or causal-metadata"}, status_code=400)
+
+@view_router.put('/copy/stream')
+async def put_copy_stream(request: Request):
+    """
+    Internal endpoint receiving one chunk of a transfer (see src/packages/transfer.py).
+
+    Expects NDJSON: a header line {"transfer": "<id>", "chunk": <n>, "type": "view_change"},
+    then one {"key", "value", "causal-metadata"} line per key. Entries are merged as they arrive.
+    """
+    try:
+        header = await Transfer.receive(request.stream())
+        # the sender drops keys we acked
+        await Storage.durable()
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning("Malformed transfer chunk: %r", e)
+        return FastJSONResponse({"error": f"Malformed transfer chunk: {e}"}, status_code=400)
+    return Wire.response({"transfer": header.get("transfer"), "chunk": header.get("chunk"), "merged": header["merged"]}, request)
+
+@view_router.get('/copy/stream/{transfer_id}')
+async def get_copy_stream(transfer_id: str, request: Request):
+    """Resume cursor of a transfer: the last chunk we have fully merged (-1 if none)."""
+    return Wire.response({"transfer": transfer_id, "chunk": Transfer.received.get(transfer_id, -1)}, request)
+
+@view_router.get('/snapshot')
+async def get_snapshot():
+    """
+    Internal endpoint streaming an image of our shard to a node joining it (see src/packages/snapshot.py).
+
+    Returns gzip-compressed NDJSON, sent as it is produced: a header line, one
+    {"key", "value", "causal-metadata"} line per key, and an {"end": true, "keys": <n>} line.
+    """
+    if not util.in_current_view():
+        return FastJSONResponse({"error": f"Node {SharedData.NODE_IDENTIFIER} is not in view"}, status_code=503)
+    return StreamingResponse(Snapshot.stream(), media_type="application/x-ndjson", headers={"Content-Encoding": "gzip"})
 
 @view_router.get('/copy')
 async def get_copy(request: Request, response: Response):
@@ -131,9 +220,9 @@ async def get_copy(request: Request, response: Response):
     """
     # return node_id, kvs, and causal metadata for a node
 
-    return JSONResponse({
+    return FastJSONResponse({
         "node_id": SharedData.NODE_IDENTIFIER, 
-        "kvs": SharedData.kvstore, 
+        "kvs": dict(SharedData.kvstore),
         "causal-metadata": util.server_metadata_to_dict(SharedData.causal_data)
     }, status_code=200)
     
\ No newline at end of file
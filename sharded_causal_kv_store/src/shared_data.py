@@ -7,6 +7,7 @@ To access from any other file:
 
 from packages.vector_clock import VectorClock
 from packages.hash import HashCircle
+from packages.merkle import MerkleIndex
 
 import os
 from asyncio import Lock
@@ -33,4 +34,12 @@ class SharedData:
     # Hash Circle
     hash_circle = HashCircle()
 
-    causal_data = {}
\ No newline at end of file
+    causal_data = {}
+
+    # Keys that left our shard in a view change, but that not every node of their new shard has
+    # acknowledged yet. Kept (not served) and sent again on the next view change.
+    handoff = set()
+
+    # Hash tree over the keys of our shard in kvstore + causal_data, kept up to date by util.key_changed()
+    # on every write (and util.index_shard_keys() on every view change)
+    merkle = MerkleIndex()
\ No newline at end of file
@@ -1,7 +1,11 @@
 from shared_data import SharedData
 from packages.vector_clock import VectorClock
+from packages.waiters import KeyWaiters
+from packages.stability import Stability
+from packages.render import Fragments
 
 import copy
+import hashlib
 
 def in_current_view():
     """ Helper to check if this node is in current_view. """
@@ -14,7 +18,7 @@ def in_current_view():
 def get_node_address_by_id(node_id):
     """ Helper to get the IP address of a node id. """
     for shard in SharedData.current_view:
-        for node in shard:
+        for node in SharedData.current_view[shard]:
             if node["id"] == node_id:
                 return node["address"]
     return None
@@ -60,8 +64,20 @@ def key_in_current_shard(key: str) -> bool:
     """
     Returns True if the key belongs in the current shard.
     """
+    if not SharedData.current_shard:
+        return False
     return SharedData.current_shard == SharedData.hash_circle.get_shard_for_key(key)
 
+def extract_wait_timeout(data: dict) -> float | None:
+    """Gets the optional client deadline (in secs) for causally blocked reads from a request body."""
+    timeout = data.get("wait-timeout")
+    if timeout is None:
+        return None
+    try:
+        return max(float(timeout), 0)
+    except (TypeError, ValueError):
+        return None
+
 def update_client_metadata(client: dict, server: dict):
     """ Helper to update client causal metadata from client and server causal key -> vector clock recordings. """
     newData = copy.deepcopy(client)
@@ -76,6 +92,26 @@ def update_client_metadata(client: dict, server: dict):
 
     return newData
 
+def compact_dependencies(dependencies: dict[str, VectorClock], keep: str = None, frontiers: dict = None) -> dict[str, VectorClock]:
+    """Drops the dependencies whose clocks are stable (delivered by every replica of the key's shard).
+
+    `keep` is a key whose clock is kept regardless (a key's own clock in its dependency map).
+    `frontiers` ({<shard>: <frontier>}) caches the frontier lookups across calls.
+    See packages/stability.py.
+    """
+    frontiers = {} if frontiers is None else frontiers
+    compacted = {}
+    for key, clock in dependencies.items():
+        if key != keep:
+            shard = SharedData.hash_circle.get_shard_for_key(key)
+            if shard not in frontiers:
+                frontiers[shard] = Stability.frontier(shard)
+            frontier = frontiers[shard]
+            if frontier is not None and clock <= frontier:
+                continue
+        compacted[key] = clock
+    return compacted
+
 def causal_data_to_dict(causal_data: dict[str, VectorClock]):
     """Helper to convert causal_data into json.
     
@@ -98,10 +134,7 @@ def causal_data_to_dict(causal_data: dict[str, VectorClock]):
 
 def dict_to_causal_data(causal_data_dict):
     """opposite of causal_data_to_dict() (Deserialization)"""
-    ret = {}
-    for key in causal_data_dict:
-        ret[key] = VectorClock(list(causal_data_dict[key].keys()), causal_data_dict[key])
-    return ret
+    return {key: VectorClock.from_dict(clock) for key, clock in causal_data_dict.items()}
 
 def update_metadata_view(self_data: dict, target_data: dict):
     """
@@ -132,6 +165,134 @@ def update_metadata(self_data, target_data, self_kvs, target_kvs, target_key):
         # update dependencies to pairwise max of the two clocks
         self_data[key] = self_clock.pairwise_max(target_clock)
 
+def merge_data(server_kvstore: dict, server_metadata: dict, view_change=False):
+    """Merges another node's kvs entries and (json) causal metadata into our own.
+
+    Used by gossip and /copy. Keys that don't belong to our shard are skipped, unless
+    the data is being handed over during a view change.
+    """
+    server_metadata = dict_to_server_metadata(server_metadata)
+    for key, server_dependencies in server_metadata.items():
+        # If the key doesn't belong in our shard, don't merge, and not doing view change
+        if not view_change and not key_in_current_shard(key):
+            continue
+
+        # convert dicts in dependencies to vector clocks
+        key_changing(key)
+        self_dependencies = SharedData.causal_data.get(key, {})
+        update_metadata(self_dependencies, server_dependencies, SharedData.kvstore, server_kvstore, key)
+        SharedData.causal_data[key] = compact_dependencies(self_dependencies, keep=key)
+        key_changed(key)
+
+def entry_hash(key: str) -> int:
+    """64-bit hash of the state of `key` held locally: its value and its own vector clock.
+
+    The clock is keyed by node id (not slot) and ignores zero entries, so two replicas
+    holding the same version of a key compute the same hash.
+    """
+    key_vc = SharedData.causal_data[key].get(key)
+    clock = ",".join(f"{node_id}:{count}" for node_id, count in sorted(key_vc.to_dict().items()) if count) if key_vc else ""
+    digest = hashlib.blake2b(f"{key}\0{clock}\0{SharedData.kvstore[key]}".encode("utf-8"), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+def key_changing(key: str):
+    """Call before writing or deleting `key` in SharedData.kvstore / SharedData.causal_data.
+
+    Lets the snapshots being streamed keep the key's state as of their start.
+    """
+    # imported here, packages/snapshot.py imports this module
+    from packages.snapshot import Snapshot
+    if Snapshot.images:
+        Snapshot.keep(key)
+
+def key_changed(key: str):
+    """Call after writing or deleting `key` in SharedData.kvstore / SharedData.causal_data.
+
+    Keeps the indexes derived from the data (the Merkle tree) up to date, wakes
+    reads waiting for the key to catch up, pushes the key to the nodes caching it and
+    logs it to the storage engine. Drops the key's encoded response fragments.
+    """
+    # imported here, packages/read_cache.py and packages/storage.py import this module
+    from packages.read_cache import ReadCache
+    from packages.storage import Storage
+    # only our shard's keys: replicas compare their trees, and keys held for other shards (handoff) would differ
+    if key in SharedData.kvstore and key in SharedData.causal_data and key_in_current_shard(key):
+        SharedData.merkle.update(key, entry_hash(key))
+    else:
+        SharedData.merkle.remove(key)
+    Fragments.invalidate(key)
+    KeyWaiters.notify(key)
+    ReadCache.notify(key)
+    Storage.record(key)
+
+def index_shard_keys(old_shard: str = None) -> list[str]:
+    """Brings the Merkle tree in line with the view just installed: indexes the keys we hold of our
+    shard and drops the others. Returns the keys it indexed before (those of `old_shard`, our shard
+    in the previous view) whose shard changed."""
+    merkle = SharedData.merkle
+    shard = SharedData.current_shard
+    keys = list(SharedData.kvstore)
+    # route the keys in bulk (vectorized if numpy is installed, see HashCircle.route)
+    shards = SharedData.hash_circle.route(keys) if SharedData.hash_circle.shard_names else [None] * len(keys)
+    moved = []
+    for key, key_shard in zip(keys, shards):
+        indexed = merkle.entry_hash(key) is not None
+        if indexed and key_shard != old_shard:
+            moved.append(key)
+        if shard and key_shard == shard and key in SharedData.causal_data:
+            if not indexed:
+                merkle.update(key, entry_hash(key))
+        elif indexed:
+            merkle.remove(key)
+    return moved
+
+def key_version(key: str) -> str:
+    """Compact summary of the version of `key` held locally (None if we don't have it).
+
+    It's the key's entry hash in the Merkle index, so it costs nothing to look up. Used by
+    gossip to find the keys two replicas disagree on without shipping the data.
+    """
+    entry_hash = SharedData.merkle.entry_hash(key)
+    return None if entry_hash is None else format(entry_hash, "016x")
+
+def shard_digest(ranges=None) -> dict[str, str]:
+    """{<key>: key_version(key)} for every key we hold that belongs to our shard.
+
+    If `ranges` ([first, last) Merkle leaf ranges) is given, only keys in those ranges are included.
+    """
+    keys = SharedData.merkle.entries if ranges is None else SharedData.merkle.keys_in_ranges(ranges)
+    return {key: key_version(key) for key in keys if key_in_current_shard(key)}
+
+def diff_digest(digest: dict[str, str], ranges=None):
+    """Compares another replica's `shard_digest(ranges)` against ours.
+
+    Returns (keys we should send them, keys we want from them).
+    """
+    send = []
+    want = []
+    for key, version in digest.items():
+        if not key_in_current_shard(key):
+            continue
+        local_version = key_version(key)
+        if local_version is None:
+            want.append(key)
+        elif local_version != version:
+            want.append(key)
+            send.append(key)
+    local_keys = SharedData.merkle.entries if ranges is None else SharedData.merkle.keys_in_ranges(ranges)
+    for key in local_keys:
+        if key not in digest and key_in_current_shard(key):
+            send.append(key)
+    return send, want
+
+def assemble_copy_payload(keys) -> dict:
+    """Builds a /copy style payload ({"kvstore", "causal-metadata"}) for the given keys."""
+    keys = [key for key in keys if key in SharedData.kvstore and key in SharedData.causal_data]
+    return {
+        "kvstore": {key: SharedData.kvstore[key] for key in keys},
+        "causal-metadata": server_metadata_to_dict({key: SharedData.causal_data[key] for key in keys}),
+    }
+
 def dict_to_server_metadata(server_metadata):
     """
     convert dict to server metadata (key: {key : clock}) for http requests
@@ -145,7 +306,11 @@ def server_metadata_to_dict(server_metadata):
     return {key: causal_data_to_dict(value) for key, value in server_metadata.items()}
 
 def assemble_get_all_metadata_dict(server_metadata, client_metadata):
-    """Assembles the get all metadata dictionary to return to client.
+    """`assemble_get_all_metadata`, serialized to json."""
+    return causal_data_to_dict(assemble_get_all_metadata(server_metadata, client_metadata))
+
+def assemble_get_all_metadata(server_metadata, client_metadata) -> dict[str, VectorClock]:
+    """Assembles the get all metadata to return to client.
 
     Call this for get all once the hanging is done. Go thorugh each key, and take the pairwise max of 
     server_metadata[key][key] and client_metadata[key].
@@ -170,7 +335,6 @@ def assemble_get_all_metadata_dict(server_metadata, client_metadata):
         # Use the server's VC as the updated metadata
         updated_metadata[key] = local_key_vc
 
-    # Serialize to json and return
-    json_updated_metadata = causal_data_to_dict(updated_metadata)
-    return json_updated_metadata
+    # Leave out the clocks every replica has caught up to
+    return compact_dependencies(updated_metadata)
     
\ No newline at end of file
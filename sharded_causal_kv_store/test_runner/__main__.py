@@ -87,6 +87,12 @@ from .tests.sharding_basic import BASIC_TESTS
 from .tests.shuffle import SHUFFLE_TESTS
 from .tests.stress import STRESS_TESTS
 from .tests.shard_proxy import PROXY_TESTS
+from .tests.batch import BATCH_TESTS
+from .tests.storage import STORAGE_TESTS
+from .tests.wire import WIRE_TESTS
+from .tests.read_cache import READ_CACHE_TESTS
+from .tests.bootstrap import BOOTSTRAP_TESTS
+from .tests.view_epoch import VIEW_EPOCH_TESTS
 from .tests.bench import BENCHMARKS
 
 TEST_SET = []
@@ -100,6 +106,12 @@ TEST_SET.extend(BASIC_TESTS)
 TEST_SET.extend(SHUFFLE_TESTS)
 TEST_SET.extend(STRESS_TESTS)
 TEST_SET.extend(PROXY_TESTS)
+TEST_SET.extend(BATCH_TESTS)
+TEST_SET.extend(STORAGE_TESTS)
+TEST_SET.extend(WIRE_TESTS)
+TEST_SET.extend(READ_CACHE_TESTS)
+TEST_SET.extend(BOOTSTRAP_TESTS)
+TEST_SET.extend(VIEW_EPOCH_TESTS)
 # TEST_SET.extend(BENCHMARKS)
 
 
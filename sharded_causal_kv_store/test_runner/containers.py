@@ -229,9 +229,10 @@ class ClusterConductor:
     def node_external_endpoint(self, index: int) -> str:
         return self.nodes[index].external_endpoint()
 
-    # create a cluster of nodes on the base network
-    def spawn_cluster(self, node_count: int) -> None:
+    # create a cluster of nodes on the base network (with the extra environment variables `env`, e.g. STORAGE_ENGINE)
+    def spawn_cluster(self, node_count: int, env: dict[str, str] = None) -> None:
         self.log(f"spawning cluster of {node_count} nodes")
+        env_args = [arg for name, value in (env or {}).items() for arg in ("--env", f"{name}={value}")]
 
         # delete base network if it exists
         run_cmd_bg(
@@ -266,6 +267,7 @@ class ClusterConductor:
                 node_name,
                 "--env",
                 f"NODE_IDENTIFIER={i}",
+                *env_args,
                 "-p",
                 f"{external_port}:{port}",
                 self.base_image,
@@ -341,6 +343,24 @@ class ClusterConductor:
 
         self.log("all nodes online")
 
+    # restart a node's container: its filesystem (and so the storage engine's data) is kept
+    def restart_node(self, index: int) -> None:
+        node = self.nodes[index]
+        self.log(f"restarting container {node.name}")
+        run_cmd_bg(
+            [CONTAINER_ENGINE, "restart", node.name],
+            verbose=True,
+            error_prefix=f"failed to restart container {node.name}",
+            log=self.log,
+        )
+
+        restart_start = time.time()
+        while not self._is_online(node):
+            if time.time() - restart_start > 10:
+                raise RuntimeError(f"node {node.name} did not come back online")
+            time.sleep(0.2)
+        self.log(f"  node {node.name} online")
+
     def destroy_cluster(self) -> None:
         # clean up after this group
         if not debug: self.cleanup_hanging(group_only=True)
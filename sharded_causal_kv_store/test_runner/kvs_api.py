@@ -125,14 +125,57 @@ class KVSClient:
                     f"failed to delete key {key}: {delete_response.status_code}"
                 )
 
+    def batch(
+        self,
+        gets: List[str],
+        puts: Dict[str, str],
+        metadata: str,
+        timeout: float = DEFAULT_TIMEOUT,
+    ) -> requests.Response:
+        request_body = create_json(metadata)
+        request_body["get"] = list(gets)
+        request_body["put"] = dict(puts)
+        if timeout is not None:
+            try:
+                return requests.post(
+                    f"{self.base_url}/data/batch", json=request_body, timeout=timeout
+                )
+            except requests.exceptions.Timeout:
+                r = requests.Response()
+                r.status_code = REQUEST_TIMEOUT_STATUS_CODE
+                return r
+        else:
+            return requests.post(f"{self.base_url}/data/batch", json=request_body)
+
+    def mget(
+        self, keys: List[str], metadata: str, timeout: float = DEFAULT_TIMEOUT
+    ) -> requests.Response:
+        return self.batch(keys, {}, metadata, timeout=timeout)
+
+    def mput(
+        self, items: Dict[str, str], metadata: str, timeout: float = DEFAULT_TIMEOUT
+    ) -> requests.Response:
+        return self.batch([], items, metadata, timeout=timeout)
+
+    def get_distribution(self, timeout: float = DEFAULT_TIMEOUT) -> requests.Response:
+        return requests.get(f"{self.base_url}/view/distribution", timeout=timeout)
+
+    def get_stats(self, timeout: float = DEFAULT_TIMEOUT) -> requests.Response:
+        return requests.get(f"{self.base_url}/stats", timeout=timeout)
+
+    def get_view_status(self, timeout: float = DEFAULT_TIMEOUT) -> requests.Response:
+        return requests.get(f"{self.base_url}/view/status", timeout=timeout)
+
     def send_view(
-        self, view: dict[str, List[Dict[str, Any]]], timeout: float = DEFAULT_TIMEOUT
+        self, view: dict[str, List[Dict[str, Any]]], timeout: float = DEFAULT_TIMEOUT, epoch: int = None
     ) -> requests.Response:
         if not isinstance(view, dict):
             raise ValueError("view must be a dict")
 
         self.last_view = view
         request_body = {"view": view}
+        if epoch is not None:
+            request_body["epoch"] = epoch
         return requests.put(f"{self.base_url}/view", json=request_body, timeout=timeout)
 
     async def async_send_view(
@@ -0,0 +1,44 @@
+from ..containers import ClusterConductor
+from ..util import log, Logger
+from ..testcase import TestCase
+from .helper import KVSTestFixture, KVSMultiClient
+
+DEFAULT_TIMEOUT = 10
+
+def batch_across_shards(conductor: ClusterConductor, dir, log: Logger):
+    with KVSTestFixture(conductor, dir, log, node_count=6) as fx:
+        c = KVSMultiClient(fx.clients, "client", log)
+        conductor.add_shard("shard1", conductor.get_nodes([0, 1]))
+        conductor.add_shard("shard2", conductor.get_nodes([2, 3]))
+        conductor.add_shard("shard3", conductor.get_nodes([4, 5]))
+        fx.broadcast_view(conductor.get_shard_view())
+
+        # one batch writes keys of every shard
+        items = {f"key{i}": f"{i}" for i in range(60)}
+        r = c.batch(0, puts=items, timeout=DEFAULT_TIMEOUT)
+        assert r.ok, f"expected ok for batch put, got {r.status_code}"
+
+        # reading them back from any node sees every write (the client's metadata carries them)
+        for node in range(6):
+            r = c.batch(node, gets=list(items) + ["missing-key"], timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for batch get, got {r.status_code}"
+            assert r.json()["items"] == items, f"wrong items returned: {r.json()}"
+            assert r.json()["missing"] == ["missing-key"], f"wrong missing keys: {r.json()}"
+
+        # the batch's metadata works with single-key reads, and a batch reads a key it writes
+        r = c.get(3, "key7", timeout=DEFAULT_TIMEOUT)
+        assert r.ok and r.json()["value"] == "7", f"wrong value returned: {r.json()}"
+        r = c.batch(5, gets=["key7", "key8"], puts={"key7": "seven"}, timeout=DEFAULT_TIMEOUT)
+        assert r.ok, f"expected ok for batch, got {r.status_code}"
+        assert r.json()["items"] == {"key7": "seven", "key8": "8"}, f"wrong items returned: {r.json()}"
+
+        # invalid bodies are rejected
+        r = fx.clients[0].batch(["key1", 2], {}, None)
+        assert r.status_code == 400, f"expected 400 for invalid batch, got {r.status_code}"
+
+        return True, "ok"
+
+
+BATCH_TESTS = [
+    TestCase("batch_across_shards", batch_across_shards),
+]
@@ -0,0 +1,58 @@
+import time
+
+from ..containers import ClusterConductor
+from ..util import log, Logger
+from ..testcase import TestCase
+from .helper import KVSTestFixture, KVSMultiClient
+
+DEFAULT_TIMEOUT = 10
+BOOTSTRAP_TIMEOUT = 15
+
+def snapshot_bootstrap(conductor: ClusterConductor, dir, log: Logger):
+    # small chunks, so the snapshot takes several pages
+    with KVSTestFixture(conductor, dir, log, node_count=4, env={"SNAPSHOT_CHUNK_SIZE": "50"}) as fx:
+        c = KVSMultiClient(fx.clients, "client", log)
+        conductor.add_shard("shard1", conductor.get_nodes([0, 1]))
+        conductor.add_shard("shard2", conductor.get_nodes([2]))
+        fx.broadcast_view(conductor.get_shard_view())
+
+        items = {f"key{i}": f"{i}" for i in range(300)}
+        for i, (key, value) in enumerate(items.items()):
+            r = c.put(i % 3, key, value, timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for put, got {r.status_code}"
+        r = c.get_all(0, timeout=DEFAULT_TIMEOUT)
+        assert r.ok, f"expected ok for get_all, got {r.status_code}"
+        shard_items = r.json()["items"]
+        assert shard_items, "expected shard1 to hold keys"
+
+        # node 3 joins shard1 and pulls a snapshot of it from node 0 or 1 (no writes from here on)
+        conductor.add_node_to_shard("shard1", conductor.get_node(3))
+        fx.broadcast_view(conductor.get_shard_view())
+
+        deadline = time.time() + BOOTSTRAP_TIMEOUT
+        while True:
+            r = fx.clients[3].get_view_status(timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for view status, got {r.status_code}"
+            bootstrap = r.json()["bootstrap"]
+            if bootstrap["state"] == "done":
+                break
+            assert bootstrap["state"] != "failed" and time.time() < deadline, f"snapshot bootstrap didn't finish: {r.json()}"
+            time.sleep(0.2)
+        sources = {node.get_view()["address"] for node in conductor.get_nodes([0, 1])}
+        assert bootstrap["source"] in sources and bootstrap["keys"] == len(shard_items), f"wrong snapshot: {bootstrap}"
+
+        # the new node holds the shard's keys (as its old replicas do), and serves them to clients
+        # that have seen every write
+        for node in (0, 3):
+            r = KVSMultiClient(fx.clients, "reader", log).get_all(node, timeout=DEFAULT_TIMEOUT)
+            assert r.ok and r.json()["items"] == shard_items, f"wrong items on node {node}: {r.text}"
+        for key, value in items.items():
+            r = c.get(3, key, timeout=DEFAULT_TIMEOUT)
+            assert r.ok and r.json()["value"] == value, f"wrong value returned for {key}: {r.text}"
+
+        return True, "ok"
+
+
+BOOTSTRAP_TESTS = [
+    TestCase("snapshot_bootstrap", snapshot_bootstrap),
+]
@@ -13,17 +13,18 @@ DEFAULT_TIMEOUT = 5
 import asyncio
 
 class KVSTestFixture:
-    def __init__(self, conductor: ClusterConductor, dir, log: Logger, node_count: int):
+    def __init__(self, conductor: ClusterConductor, dir, log: Logger, node_count: int, env: Dict[str, str] = None):
         conductor._parent = self
         self.conductor = conductor
         self.dir = dir
         self.node_count = node_count
+        self.env = env
         self.clients: list[KVSClient] = []
         self.log = log
 
     def spawn_cluster(self):
         self.log("\n> SPAWN CLUSTER")
-        self.conductor.spawn_cluster(node_count=self.node_count)
+        self.conductor.spawn_cluster(node_count=self.node_count, env=self.env)
 
         for i in range(self.node_count):
             ep = self.conductor.node_external_endpoint(i)
@@ -163,3 +164,23 @@ class KVSMultiClient:
 
         self.req += 1
         return r
+
+    def batch(self, node_id: int, gets: List[str] = (), puts: Dict[str, str] = None, timeout: float = DEFAULT_TIMEOUT):
+        puts = puts or {}
+        self.log(
+            f" {self.name} req_id:{self.req} > {node_id} > kvs.batch get {list(gets)} put {puts}"
+        )
+        r = self.clients[node_id].batch(gets, puts, self.metadata, timeout=timeout)
+        if r.status_code // 100 == 2:
+            self._kvs_model.update(puts)
+            self.log(
+                f" {self.name} req_id:{self.req} > {node_id}> kvs.batch -> {r.json()}"
+            )
+            self.metadata = r.json()["causal-metadata"]
+        else:
+            self.log(
+                f" {self.name} req_id:{self.req} > {node_id} > kvs.batch -> HTTP ERROR {r.status_code}"
+            )
+
+        self.req += 1
+        return r
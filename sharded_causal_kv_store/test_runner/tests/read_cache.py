@@ -0,0 +1,83 @@
+from ..containers import ClusterConductor
+from ..util import log, Logger
+from ..testcase import TestCase
+from .helper import KVSTestFixture, KVSMultiClient
+
+DEFAULT_TIMEOUT = 10
+
+def cache_stats(fx: KVSTestFixture, node: int) -> dict:
+    r = fx.clients[node].get_stats(timeout=DEFAULT_TIMEOUT)
+    assert r.ok, f"expected ok for stats, got {r.status_code}"
+    return r.json()["read-cache"]
+
+# a key of shard2 and its value, written through node 2
+def remote_key(fx: KVSTestFixture, c: KVSMultiClient) -> tuple[str, str]:
+    for i in range(20):
+        r = c.put(2, f"key{i}", f"{i}", timeout=DEFAULT_TIMEOUT)
+        assert r.ok, f"expected ok for put, got {r.status_code}"
+    r = c.get_all(2, timeout=DEFAULT_TIMEOUT)
+    assert r.ok and r.json()["items"], f"expected shard2 to hold keys, got {r.text}"
+    return sorted(r.json()["items"].items())[0]
+
+def cache_respects_metadata(conductor: ClusterConductor, dir, log: Logger):
+    # no pushes and a long TTL: a stale entry is only ever refreshed by the causal check
+    env = {"READ_CACHE_KEYS": "all", "READ_CACHE_PUSH": "false", "READ_CACHE_TTL": "60"}
+    with KVSTestFixture(conductor, dir, log, node_count=4, env=env) as fx:
+        c = KVSMultiClient(fx.clients, "client", log)
+        conductor.add_shard("shard1", conductor.get_nodes([0, 1]))
+        conductor.add_shard("shard2", conductor.get_nodes([2, 3]))
+        fx.broadcast_view(conductor.get_shard_view())
+        key, value = remote_key(fx, c)
+
+        # the first read through node 0 is proxied, the second one is a hit
+        for _ in range(2):
+            r = c.get(0, key, timeout=DEFAULT_TIMEOUT)
+            assert r.ok and r.json()["value"] == value, f"wrong value returned: {r.text}"
+        stats = cache_stats(fx, 0)
+        assert stats["hits"] >= 1, f"expected a cache hit, got {stats}"
+
+        # a write through the owner leaves node 0's entry stale: with the write in its metadata,
+        # the client gets the new value (the read is proxied), not the cached one
+        r = c.put(2, key, "new", timeout=DEFAULT_TIMEOUT)
+        assert r.ok, f"expected ok for put, got {r.status_code}"
+        r = c.get(0, key, timeout=DEFAULT_TIMEOUT)
+        assert r.ok and r.json()["value"] == "new", f"expected the new value, got {r.text}"
+        after = cache_stats(fx, 0)
+        assert after["hits"] == stats["hits"] and after["misses"] > stats["misses"], f"expected a miss, got {after}"
+
+        # the proxied read refreshed the entry: the next read is a hit again
+        r = c.get(0, key, timeout=DEFAULT_TIMEOUT)
+        assert r.ok and r.json()["value"] == "new", f"expected the new value, got {r.text}"
+        assert cache_stats(fx, 0)["hits"] == after["hits"] + 1, "expected a cache hit after the refresh"
+
+        return True, "ok"
+
+def cache_hot_keys_only(conductor: ClusterConductor, dir, log: Logger):
+    env = {"HOT_KEYS_SAMPLE": "1", "HOT_KEY_THRESHOLD": "5"}
+    with KVSTestFixture(conductor, dir, log, node_count=4, env=env) as fx:
+        c = KVSMultiClient(fx.clients, "client", log)
+        conductor.add_shard("shard1", conductor.get_nodes([0, 1]))
+        conductor.add_shard("shard2", conductor.get_nodes([2, 3]))
+        fx.broadcast_view(conductor.get_shard_view())
+        key, value = remote_key(fx, c)
+
+        # a key read once isn't cached
+        r = c.get(0, key, timeout=DEFAULT_TIMEOUT)
+        assert r.ok, f"expected ok for get, got {r.status_code}"
+        stats = cache_stats(fx, 0)
+        assert stats["keys"] == "hot" and stats["entries"] == 0, f"expected nothing cached, got {stats}"
+
+        # once the key is hot, its reads are served from the cache
+        for _ in range(20):
+            r = c.get(0, key, timeout=DEFAULT_TIMEOUT)
+            assert r.ok and r.json()["value"] == value, f"wrong value returned: {r.text}"
+        stats = cache_stats(fx, 0)
+        assert stats["entries"] == 1 and stats["hits"] > 0, f"expected the hot key cached, got {stats}"
+
+        return True, "ok"
+
+
+READ_CACHE_TESTS = [
+    TestCase("cache_respects_metadata", cache_respects_metadata),
+    TestCase("cache_hot_keys_only", cache_hot_keys_only),
+]
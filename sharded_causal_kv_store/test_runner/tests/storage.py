@@ -0,0 +1,55 @@
+from ..containers import ClusterConductor
+from ..util import log, Logger
+from ..testcase import TestCase
+from .helper import KVSTestFixture, KVSMultiClient
+
+DEFAULT_TIMEOUT = 10
+
+def restart_recovers(engine: str):
+    def test(conductor: ClusterConductor, dir, log: Logger):
+        with KVSTestFixture(conductor, dir, log, node_count=2, env={"STORAGE_ENGINE": engine}) as fx:
+            c = KVSMultiClient(fx.clients, "client", log)
+            # one node per shard: a restarted node has no replica to be refilled from, only its disk
+            conductor.add_shard("shard1", conductor.get_nodes([0]))
+            conductor.add_shard("shard2", conductor.get_nodes([1]))
+            fx.broadcast_view(conductor.get_shard_view())
+
+            r = fx.clients[0].get_stats(timeout=DEFAULT_TIMEOUT)
+            assert r.ok and r.json()["storage"]["engine"] == engine, f"expected the {engine} engine, got {r.text}"
+
+            items = {f"key{i}": f"{i}" for i in range(40)}
+            for key, value in items.items():
+                r = c.put(int(value) % 2, key, value, timeout=DEFAULT_TIMEOUT)
+                assert r.ok, f"expected ok for put, got {r.status_code}"
+            r = c.get_all(0, timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for get_all, got {r.status_code}"
+            held = r.json()["items"]
+            assert held, "expected node 0 to hold some keys"
+
+            conductor.restart_node(0)
+
+            # the node is back in its view with the keys it held, without being sent the view again
+            fresh = KVSMultiClient(fx.clients, "fresh", log)
+            r = fresh.get_all(0, timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for get_all after restart, got {r.status_code}"
+            assert r.json()["items"] == held, f"wrong items after restart: {r.json()}"
+
+            # every key reads back (the client's metadata from before the restart is satisfied)
+            for key, value in items.items():
+                r = c.get(0, key, timeout=DEFAULT_TIMEOUT)
+                assert r.ok and r.json()["value"] == value, f"wrong value returned for {key}: {r.text}"
+
+            # and the node takes writes again
+            r = c.put(0, "key0", "after-restart", timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for put after restart, got {r.status_code}"
+            r = c.get(1, "key0", timeout=DEFAULT_TIMEOUT)
+            assert r.ok and r.json()["value"] == "after-restart", f"wrong value returned: {r.text}"
+
+            return True, "ok"
+    return test
+
+
+STORAGE_TESTS = [
+    TestCase("restart_recovers_wal", restart_recovers("wal")),
+    TestCase("restart_recovers_bitcask", restart_recovers("bitcask")),
+]
@@ -20,8 +20,14 @@ def shard_key_distribution(conductor: ClusterConductor, dir, log: Logger):
     NUM_KEYS = 5000
     NODE_COUNT = 8
     SHARD_COUNT = 4
-
-    with KVSTestFixture(conductor, dir, log, node_count=NODE_COUNT) as fx:
+    # the ring with each shard's arc capped at capacity x its share, so /view/distribution's max_load has a bound to hold to
+    STRATEGY = "bounded"
+    # how far a shard's sampled share of keys may be from its expected share (relative)
+    SHARE_TOLERANCE = 0.4
+    # slack on the capacity for the sampling error of /view/distribution
+    SAMPLING_SLACK = 1.05
+
+    with KVSTestFixture(conductor, dir, log, node_count=NODE_COUNT, env={"HASH_STRATEGY": STRATEGY}) as fx:
         c = KVSMultiClient(fx.clients, "client", log)
 
         for i in range(SHARD_COUNT):
@@ -80,6 +86,21 @@ def shard_key_distribution(conductor: ClusterConductor, dir, log: Logger):
             log(f"Key distribution: min={min_keys}, max={max_keys}, avg={avg_keys:.1f}")
             log(f"Max deviation: {deviation} keys ({deviation_percent:.1f}%)")
 
+            r = fx.clients[0].get_distribution()
+            assert r.ok, f"expected ok for distribution report, got {r.status_code}"
+            report = r.json()
+            log(f"Placement ({report['strategy']}): max load {report['max_load']:.2f}, capacity {report['capacity']:.2f}")
+            assert report["strategy"] == STRATEGY, f"expected the {STRATEGY} strategy, got {report['strategy']}"
+            assert len(report["shards"]) == SHARD_COUNT, f"expected {SHARD_COUNT} shards in the report, got {report['shards']}"
+            for shard, entry in report["shards"].items():
+                log(f"  {shard}: expected {entry['expected']:.3f}, sampled {entry['sampled']:.3f}")
+                assert abs(entry["sampled"] - entry["expected"]) <= SHARE_TOLERANCE * entry["expected"], (
+                    f"{shard} got {entry['sampled']:.3f} of the keys, expected {entry['expected']:.3f}"
+                )
+            assert report["max_load"] <= report["capacity"] * SAMPLING_SLACK, (
+                f"max load {report['max_load']:.2f} above the capacity {report['capacity']:.2f}"
+            )
+
             is_good_distribution = deviation_percent < 40
 
             return (
@@ -0,0 +1,69 @@
+import time
+
+from ..containers import ClusterConductor
+from ..util import log, Logger
+from ..testcase import TestCase
+from .helper import KVSTestFixture, KVSMultiClient
+
+DEFAULT_TIMEOUT = 10
+MIGRATION_TIMEOUT = 15
+
+def stale_epoch_rejected(conductor: ClusterConductor, dir, log: Logger):
+    with KVSTestFixture(conductor, dir, log, node_count=4) as fx:
+        c = KVSMultiClient(fx.clients, "client", log)
+        conductor.add_shard("shard1", conductor.get_nodes([0, 1]))
+        conductor.add_shard("shard2", conductor.get_nodes([2, 3]))
+        fx.broadcast_view(conductor.get_shard_view())
+        old_view = conductor.get_shard_view()
+
+        items = {f"key{i}": f"{i}" for i in range(100)}
+        for i, (key, value) in enumerate(items.items()):
+            r = c.put(i % 4, key, value, timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for put, got {r.status_code}"
+
+        # a third shard takes keys of both: the view change is numbered 5 on every node
+        conductor.add_shard("shard1", conductor.get_nodes([0]))
+        conductor.add_shard("shard2", conductor.get_nodes([2]))
+        conductor.add_shard("shard3", conductor.get_nodes([1, 3]))
+        for client in fx.clients:
+            r = client.send_view(conductor.get_shard_view(), epoch=5)
+            assert r.status_code == 200 and r.json()["epoch"] == 5, f"expected the view of epoch 5, got {r.status_code} {r.text}"
+
+        # a view change numbered below it is stale
+        for client in fx.clients:
+            r = client.send_view(old_view, epoch=3)
+            assert r.status_code == 409, f"expected 409 for a stale epoch, got {r.status_code}"
+
+        # the migration of epoch 5 runs to completion on every node
+        deadline = time.time() + MIGRATION_TIMEOUT
+        for node, client in enumerate(fx.clients):
+            while True:
+                r = client.get_view_status(timeout=DEFAULT_TIMEOUT)
+                assert r.ok, f"expected ok for view status, got {r.status_code}"
+                status = r.json()
+                assert status["epoch"] == 5, f"expected node {node} at epoch 5, got {status}"
+                if status["state"] == "idle" and status["incoming"]["complete"]:
+                    break
+                assert time.time() < deadline, f"migration on node {node} didn't finish: {status}"
+                time.sleep(0.2)
+
+        # then every key is on its new shard only, and reads back from any node for a new client
+        held = {}
+        for node in (0, 2, 1):
+            r = KVSMultiClient(fx.clients, "reader", log).get_all(node, timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for get_all, got {r.status_code}"
+            assert not set(r.json()["items"]) & set(held), "keys held by two shards"
+            held.update(r.json()["items"])
+        assert held == items, f"wrong items after the view change: {held}"
+        for node in range(4):
+            reader = KVSMultiClient(fx.clients, "reader", log)
+            for key, value in items.items():
+                r = reader.get(node, key, timeout=DEFAULT_TIMEOUT)
+                assert r.ok and r.json()["value"] == value, f"wrong value returned for {key} by node {node}: {r.text}"
+
+        return True, "ok"
+
+
+VIEW_EPOCH_TESTS = [
+    TestCase("stale_epoch_rejected", stale_epoch_rejected),
+]
@@ -0,0 +1,90 @@
+import os
+import time
+
+from ..containers import ClusterConductor
+from ..util import log, Logger
+from ..testcase import TestCase
+from .helper import KVSTestFixture, KVSMultiClient
+
+DEFAULT_TIMEOUT = 10
+CONVERGENCE_TIMEOUT = 15
+
+# the same writes, batch and view change with WIRE_FORMAT=`wire_format`: returns what every node
+# holds once the replicas converged, and the nodes' wire stats summed up
+def replicated_workload(conductor: ClusterConductor, dir, log: Logger, wire_format: str):
+    log(f"\n> WORKLOAD WITH WIRE_FORMAT={wire_format}")
+    # the cluster is spawned once per format, keep both sets of container logs
+    dir = os.path.join(dir, wire_format)
+    os.makedirs(dir, exist_ok=True)
+    with KVSTestFixture(conductor, dir, log, node_count=4, env={"WIRE_FORMAT": wire_format}) as fx:
+        c = KVSMultiClient(fx.clients, "client", log)
+        conductor.add_shard("shard1", conductor.get_nodes([0, 1, 2]))
+        conductor.add_shard("shard2", conductor.get_nodes([3]))
+        fx.broadcast_view(conductor.get_shard_view())
+
+        expected = {}
+        for i in range(60):
+            r = c.put(i % 4, f"key{i}", f"{i}", timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for put, got {r.status_code}"
+            expected[f"key{i}"] = f"{i}"
+        for i in range(0, 60, 3):
+            r = c.put((i + 1) % 4, f"key{i}", f"{i}-again", timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for put, got {r.status_code}"
+            expected[f"key{i}"] = f"{i}-again"
+        items = {f"batch{i}": f"{i}" for i in range(20)}
+        r = c.batch(1, puts=items, timeout=DEFAULT_TIMEOUT)
+        assert r.ok, f"expected ok for batch put, got {r.status_code}"
+        expected.update(items)
+
+        # node 2 moves to shard2: keys are handed over between the shards
+        conductor.add_shard("shard1", conductor.get_nodes([0, 1]))
+        conductor.add_shard("shard2", conductor.get_nodes([2, 3]))
+        fx.broadcast_view(conductor.get_shard_view())
+        for i in range(60, 80):
+            r = c.put(i % 4, f"key{i}", f"{i}", timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for put, got {r.status_code}"
+            expected[f"key{i}"] = f"{i}"
+
+        # every key reads back from every node
+        for node in range(4):
+            for key, value in expected.items():
+                r = c.get(node, key, timeout=DEFAULT_TIMEOUT)
+                assert r.ok and r.json()["value"] == value, f"wrong value returned for {key} by node {node}: {r.text}"
+
+        # the replicas of each shard converge
+        deadline = time.time() + CONVERGENCE_TIMEOUT
+        while True:
+            held = {}
+            for node in range(4):
+                r = KVSMultiClient(fx.clients, "reader", log).get_all(node, timeout=DEFAULT_TIMEOUT)
+                assert r.ok, f"expected ok for get_all, got {r.status_code}"
+                held[node] = r.json()["items"]
+            if held[0] == held[1] and held[2] == held[3]:
+                break
+            assert time.time() < deadline, f"replicas did not converge: {held}"
+            time.sleep(0.5)
+        assert {**held[0], **held[2]} == expected, f"wrong items held: {held}"
+
+        stats = {}
+        for client in fx.clients:
+            r = client.get_stats(timeout=DEFAULT_TIMEOUT)
+            assert r.ok, f"expected ok for stats, got {r.status_code}"
+            for name, count in r.json()["wire"].items():
+                stats[name] = stats.get(name, 0) + count
+        return held, stats
+
+def binary_matches_json(conductor: ClusterConductor, dir, log: Logger):
+    binary_held, binary_stats = replicated_workload(conductor, dir, log, "binary")
+    json_held, json_stats = replicated_workload(conductor, dir, log, "json")
+
+    # the nodes negotiated the binary format in the first run only
+    assert binary_stats["binary"] > 0, f"expected binary messages between nodes, got {binary_stats}"
+    assert json_stats["binary"] == 0, f"expected no binary messages with WIRE_FORMAT=json, got {json_stats}"
+    assert binary_held == json_held, f"binary and json runs differ: {binary_held} vs {json_held}"
+
+    return True, "ok"
+
+
+WIRE_TESTS = [
+    TestCase("binary_matches_json", binary_matches_json),
+]
@@ -2,8 +2,12 @@
 import os
 
 from shared_data import SharedData
+from packages.storage import Storage
 from flask import Flask, request, jsonify
 
+# Load the data kept before a restart (see packages/storage.py)
+Storage.recover()
+
 app = Flask(__name__)
 
 # Register all blueprints into the API. 
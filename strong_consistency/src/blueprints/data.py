@@ -2,11 +2,14 @@ from flask import Blueprint, request, jsonify
 from shared_data import SharedData
 from helper import ReqHelper
 from packages.fifo import FifoDelivery
+from packages.storage import Storage
 
 import requests
 
 import util
+from log import get_logger
 
+logger = get_logger(__name__)
 
 data_api = Blueprint('data_api', __name__)
 
@@ -75,13 +78,14 @@ def replicate():
 
     if operation == "PUT":
         val = data["value"]
-        SharedData.kvstore[key] = val
-        print(SharedData.kvstore[key])
+        position = Storage.put(key, val)
         FifoDelivery.finished_delivering(sender_node_id)
+        Storage.durable(position)
         return jsonify(message=f"Replicated data with key {key} and value {val}"), 200
     elif operation == "DELETE":
-        SharedData.kvstore.pop(key, None)
+        _, position = Storage.delete(key)
         FifoDelivery.finished_delivering(sender_node_id)
+        Storage.durable(position)
         return jsonify(message=f"Deleted {key} from backup ${util.get_node_address_by_id(SharedData.NODE_IDENTIFIER)}"), 200
 
 def replicate_to_backup(backup_address, operation, headers, key, value=None):
@@ -97,12 +101,12 @@ def replicate_to_backup(backup_address, operation, headers, key, value=None):
         payload["value"] = value
     
     try:
-        print(f"http://{backup_address}/replicate", payload)
+        logger.debug("Replicating %s of %s to %s", operation, key, backup_address)
         r = requests.post(f"http://{backup_address}/replicate", json=payload, headers=headers)
-        print(r.status_code)
+        logger.debug("Replication to %s returned %s", backup_address, r.status_code)
         return r.status_code == 200
     except requests.exceptions.RequestException as error:
-        print(f"ERROR {error}")
+        logger.warning("Replication to %s failed: %s", backup_address, error)
         return False
 
 @data_api.route('/data/<key>', methods=['PUT'])
@@ -129,8 +133,10 @@ def put_data(key):
         # Primary needs to deliver in order based on what it sent backup
         FifoDelivery.primary_can_deliver(msg_num)
         key_in_kvs = key in SharedData.kvstore
-        SharedData.kvstore[key] = value # Commit Point
+        position = Storage.put(key, value) # Commit Point
         FifoDelivery.primary_finished_delivering()
+        # ack once the write is on disk (a single fsync covers the writes delivered meanwhile)
+        Storage.durable(position)
 
         if not key_in_kvs:
             return jsonify(message='Key created successfully.'), 201, headers
@@ -178,10 +184,11 @@ def delete_data(key):
 
         # Primary needs to deliver in order based on what it sent backup
         FifoDelivery.primary_can_deliver(msg_num)
-        print("Will be handling delete request from", request.url)
-        deleted_val = SharedData.kvstore.pop(key, None) # commit point
-        print("deleted_val =", deleted_val)
+        logger.debug("Will be handling delete request from %s", request.url)
+        deleted_val, position = Storage.delete(key) # commit point
+        logger.debug("deleted_val = %s", deleted_val)
         FifoDelivery.primary_finished_delivering()
+        Storage.durable(position)
 
         # Check if key exsited at the moment of deletion
         if not deleted_val:
@@ -0,0 +1,85 @@
+"""
+Logging for this node.
+
+Records are put on a queue and written out by a background thread (QueueHandler + QueueListener),
+so logging never blocks a request thread on a write to stdout (or on another thread's write). Messages use %-style arguments,
+which are only formatted if the record is actually emitted:
+
+    from log import get_logger
+    logger = get_logger(__name__)
+    logger.debug("Primary (id=%s) is ready for delivery.", msg_id)
+
+Configured with environment variables:
+    LOG_LEVEL: level of this node's loggers (DEBUG, INFO, WARNING, ERROR, OFF), default INFO
+    LOG_MODULES: per-module levels, e.g. "packages.fifo=DEBUG,blueprints.data=WARNING,gunicorn.access=OFF"
+        (module names as in `get_logger(__name__)`, a package applies to all its modules)
+    LOG_SAMPLE: fraction (0-1) of records below WARNING that are kept, default 1
+"""
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_MODULES = os.environ.get("LOG_MODULES", "")
+LOG_SAMPLE = float(os.environ.get("LOG_SAMPLE", 1))
+
+# All of this node's loggers are children of this one
+ROOT = "kvs"
+
+# Loggers of libraries that are configured by LOG_MODULES under their own name, and routed through our queue
+EXTERNAL = ("gunicorn.access", "gunicorn.error", "werkzeug")
+
+FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a `rate` fraction of the records below WARNING."""
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+def parse_level(level: str) -> int:
+    level = level.strip().upper()
+    if level == "OFF":
+        return logging.CRITICAL + 1
+    level = logging.getLevelName(level)
+    return level if isinstance(level, int) else logging.INFO
+
+def setup():
+    """Routes our (and the server's) loggers through a queue to a background writer thread. Runs once, on import."""
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    if LOG_SAMPLE < 1:
+        queue_handler.addFilter(SamplingFilter(LOG_SAMPLE))
+
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter(FORMAT))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    root = logging.getLogger(ROOT)
+    root.setLevel(parse_level(LOG_LEVEL))
+    root.handlers = [queue_handler]
+    root.propagate = False
+
+    for name in EXTERNAL:
+        logger = logging.getLogger(name)
+        if logger.handlers:
+            logger.handlers = [queue_handler]
+
+    for entry in filter(None, (entry.strip() for entry in LOG_MODULES.split(","))):
+        name, _, level = entry.partition("=")
+        name = name.strip()
+        logging.getLogger(name if name in EXTERNAL else f"{ROOT}.{name}").setLevel(parse_level(level))
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"{ROOT}.{name}")
+
+setup()
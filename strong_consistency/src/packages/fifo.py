@@ -1,5 +1,8 @@
 """Implementation of FIFO Delivery Protocol."""
 from threading import Lock, Condition
+from log import get_logger
+
+logger = get_logger(__name__)
 
 class FifoDelivery:
   # used for max_msg_num and curr_msg_num
@@ -40,14 +43,14 @@ class FifoDelivery:
   # All delivery logic should happen in the "critical region".
   @classmethod
   def can_deliver(cls, sender_node_id: int, msg_id: int) -> None:
-    print(f"Node {sender_node_id}'s message (id={msg_id}) waiting for delivery...")
+    logger.debug("Node %s's message (id=%s) waiting for delivery...", sender_node_id, msg_id)
     # Keep waiting until it's the message's turn to deliver.
     with cls.cv:
       if sender_node_id not in cls.curr_msg_num:
         cls.curr_msg_num[sender_node_id] = 0
 
       cls.cv.wait_for(lambda: msg_id == cls.curr_msg_num[sender_node_id])
-      print(f"Node {sender_node_id}'s message (id={msg_id}) is ready for delivery.")
+      logger.debug("Node %s's message (id=%s) is ready for delivery.", sender_node_id, msg_id)
       return
 
   # Call once delivery is done to allow for next message to be delivered.
@@ -58,18 +61,18 @@ class FifoDelivery:
     with cls.cv:
       cls.curr_msg_num[sender_node_id] += 1
       cls.cv.notify_all()
-      print(f"Node {sender_node_id}'s msg_num incremented to {cls.curr_msg_num[sender_node_id]}")
+      logger.debug("Node %s's msg_num incremented to %s", sender_node_id, cls.curr_msg_num[sender_node_id])
       return
 
   # Same as can_deliver(), but this is for primary
   @classmethod
   def primary_can_deliver(cls, msg_id: int) -> None:
-    print(f"Primary (id={msg_id}) waiting for delivery...")
+    logger.debug("Primary (id=%s) waiting for delivery...", msg_id)
     # Keep waiting until it's the message's turn to deliver.
     with cls.primary_cv:
       
       cls.primary_cv.wait_for(lambda: msg_id == cls.primary_curr_num)
-      print(f"Primary (id={msg_id}) is ready for delivery.")
+      logger.debug("Primary (id=%s) is ready for delivery.", msg_id)
       return
   
   # Same as finished_delivering, but this is for primary
@@ -79,5 +82,5 @@ class FifoDelivery:
     with cls.primary_cv:
       cls.primary_curr_num += 1
       cls.primary_cv.notify_all()
-      print(f"Primary's curr_num incremented to {cls.primary_curr_num}")
+      logger.debug("Primary's curr_num incremented to %s", cls.primary_curr_num)
       return
\ No newline at end of file
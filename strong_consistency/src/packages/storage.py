@@ -0,0 +1,220 @@
+"""
+Durable storage of SharedData.kvstore, so a restarted node recovers its data from its disk.
+
+STORAGE_ENGINE picks the engine:
+- memory: nothing is kept across restarts.
+- wal: every PUT and DELETE is appended to a write-ahead log in DATA_DIR before it is acknowledged.
+
+Writes go through `Storage.put` / `Storage.delete`, which change the kvstore and log the change
+under one lock, and return the change's log position. `Storage.durable(position)` blocks until the
+log is on disk up to it. Group commit: the first thread that needs the log on disk writes and
+fsyncs everything buffered so far, while the others wait for it (and are usually covered by it).
+
+Snapshots: once the current log segment holds STORAGE_SNAPSHOT_BYTES (or every
+STORAGE_SNAPSHOT_INTERVAL secs if anything changed), a background thread moves the log on to a
+new segment and writes a copy of the kvstore beside it; older segments and snapshots are then
+deleted. On startup the latest snapshot is loaded and the segments after it are replayed in
+order (a torn record at the end of a segment, from a crash mid-write, ends its replay).
+"""
+import json
+import os
+import re
+import struct
+import zlib
+from threading import Condition, Lock, Thread, Event
+from shared_data import SharedData
+from log import get_logger
+
+logger = get_logger(__name__)
+
+STORAGE_ENGINE = os.environ.get("STORAGE_ENGINE", "memory")
+DATA_DIR = os.environ.get("DATA_DIR", os.path.join("data", SharedData.NODE_IDENTIFIER))
+WAL_FSYNC = os.environ.get("WAL_FSYNC", "true").lower() in ("1", "true", "yes")
+STORAGE_SNAPSHOT_BYTES = int(os.environ.get("STORAGE_SNAPSHOT_BYTES", 64 * 1024 * 1024))
+STORAGE_SNAPSHOT_INTERVAL = float(os.environ.get("STORAGE_SNAPSHOT_INTERVAL", 300))
+
+# Log record header: length and CRC32 of the payload that follows.
+RECORD = struct.Struct("<II")
+
+class Storage:
+  lock = Lock()
+  cv = Condition(lock)
+
+  wal = STORAGE_ENGINE == "wal"
+  file = None
+  segment = 0
+  segment_bytes = 0
+  buffer = bytearray()
+
+  # Records appended, records known to be on disk, and whether a thread is writing the log
+  appended = 0
+  synced = 0
+  flushing = False
+  changes = 0
+
+  # Set if writing the log failed: nothing appended since can be made durable
+  error = None
+
+  # Wakes the snapshot thread early (the log got big)
+  snapshot_due = Event()
+
+  @classmethod
+  def put(cls, key: str, value: str) -> int:
+    """Sets `key` and logs it. Returns the log position to pass to `durable`."""
+    with cls.lock:
+      SharedData.kvstore[key] = value
+      return cls._append([key, value])
+
+  @classmethod
+  def delete(cls, key: str):
+    """Deletes `key` and logs it. Returns (the deleted value or None, the log position to pass to `durable`)."""
+    with cls.lock:
+      value = SharedData.kvstore.pop(key, None)
+      return value, cls._append([key])
+
+  @classmethod
+  def _append(cls, record: list) -> int:
+    if not cls.wal:
+      return 0
+    payload = json.dumps(record, separators=(",", ":")).encode("utf-8")
+    cls.buffer += RECORD.pack(len(payload), zlib.crc32(payload))
+    cls.buffer += payload
+    cls.appended += 1
+    cls.changes += 1
+    return cls.appended
+
+  @classmethod
+  def durable(cls, position: int) -> None:
+    """Blocks until the log is on disk up to `position`."""
+    with cls.cv:
+      while cls.synced < position:
+        if cls.error is not None:
+          raise RuntimeError(f"Writing the log failed: {cls.error!r}")
+        if cls.flushing:
+          cls.cv.wait()
+          continue
+        cls._flush_locked()
+
+  @classmethod
+  def _flush_locked(cls) -> None:
+    """Writes the buffer to the current segment. Called holding the lock, which is released during the write."""
+    cls.flushing = True
+    data, cls.buffer = cls.buffer, bytearray()
+    target = cls.appended
+    cls.lock.release()
+    try:
+      cls.file.write(data)
+      cls.file.flush()
+      if WAL_FSYNC:
+        os.fsync(cls.file.fileno())
+    except Exception as e:
+      logger.error("Writing the log failed: %r", e)
+      cls.error = e
+      raise
+    finally:
+      cls.lock.acquire()
+      cls.flushing = False
+      cls.cv.notify_all()
+    cls.synced = max(cls.synced, target)
+    cls.segment_bytes += len(data)
+    if cls.segment_bytes >= STORAGE_SNAPSHOT_BYTES:
+      cls.snapshot_due.set()
+
+  @classmethod
+  def _path(cls, kind: str, number: int) -> str:
+    return os.path.join(DATA_DIR, f"wal-{number:08d}.log" if kind == "wal" else f"snapshot-{number:08d}.json")
+
+  @classmethod
+  def _numbers(cls, kind: str) -> list:
+    pattern = re.compile(r"wal-(\d+)\.log$" if kind == "wal" else r"snapshot-(\d+)\.json$")
+    return sorted(int(match.group(1)) for match in map(pattern.match, os.listdir(DATA_DIR)) if match)
+
+  @classmethod
+  def recover(cls) -> None:
+    """Loads the data kept before a restart into SharedData.kvstore, and starts taking snapshots."""
+    if STORAGE_ENGINE not in ("memory", "wal"):
+      raise ValueError(f"Unknown STORAGE_ENGINE {STORAGE_ENGINE!r}, expected memory or wal")
+    if not cls.wal:
+      return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    start = 0
+    snapshots = cls._numbers("snapshot")
+    if snapshots:
+      start = snapshots[-1]
+      with open(cls._path("snapshot", start)) as file:
+        SharedData.kvstore.update(json.load(file))
+    segments = [number for number in cls._numbers("wal") if number >= start]
+    replayed = sum(cls._replay(cls._path("wal", number)) for number in segments)
+    logger.info("Recovered %d keys from %s (snapshot %s, %d log records)", len(SharedData.kvstore), DATA_DIR, start if snapshots else None, replayed)
+
+    # a new segment for this run, after anything a torn record may have cut short
+    cls.segment = max(segments[-1] + 1 if segments else 0, start)
+    cls.file = open(cls._path("wal", cls.segment), "ab")
+    Thread(target=cls._snapshot_loop, daemon=True).start()
+
+  @classmethod
+  def _replay(cls, path: str) -> int:
+    with open(path, "rb") as file:
+      data = file.read()
+    offset = count = 0
+    while offset + RECORD.size <= len(data):
+      length, crc = RECORD.unpack_from(data, offset)
+      payload = data[offset + RECORD.size:offset + RECORD.size + length]
+      if not length or len(payload) < length or zlib.crc32(payload) != crc:
+        logger.warning("Torn record at %s:%d, ignoring the rest of the segment", path, offset)
+        break
+      record = json.loads(payload)
+      if len(record) == 1:
+        SharedData.kvstore.pop(record[0], None)
+      else:
+        SharedData.kvstore[record[0]] = record[1]
+      offset += RECORD.size + length
+      count += 1
+    return count
+
+  @classmethod
+  def _snapshot_loop(cls) -> None:
+    while True:
+      cls.snapshot_due.wait(STORAGE_SNAPSHOT_INTERVAL)
+      cls.snapshot_due.clear()
+      if cls.changes:
+        try:
+          cls.snapshot()
+        except Exception as e:
+          logger.error("Snapshot failed: %r", e)
+
+  @classmethod
+  def snapshot(cls) -> None:
+    """Moves the log on to a new segment and writes a copy of the kvstore from that point."""
+    with cls.cv:
+      while cls.flushing:
+        cls.cv.wait()
+      if cls.buffer:
+        cls._flush_locked()
+      old = cls.file
+      cls.segment += 1
+      cls.segment_bytes = 0
+      cls.changes = 0
+      cls.file = open(cls._path("wal", cls.segment), "ab")
+      number = cls.segment
+      image = dict(SharedData.kvstore)
+    old.close()
+
+    path = cls._path("snapshot", number)
+    with open(path + ".tmp", "w") as file:
+      json.dump(image, file, separators=(",", ":"))
+      file.flush()
+      os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+    fd = os.open(DATA_DIR, os.O_RDONLY)
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    for old_number in cls._numbers("wal"):
+      if old_number < number:
+        os.remove(cls._path("wal", old_number))
+    for old_number in cls._numbers("snapshot"):
+      if old_number < number:
+        os.remove(cls._path("snapshot", old_number))
+    logger.info("Snapshot of %d keys before log segment %d", len(image), number)